@@ -3,6 +3,11 @@ import elikopy.individual_subject_processing
 import elikopy.utils
 import elikopy.utilsSynb0Disco
 import elikopy.registration
+import elikopy.storage
+import elikopy.resources
+import elikopy.stats
+import elikopy.odf
+import elikopy.microstructure
 
 
 try:
@@ -19,6 +19,7 @@ from elikopy.individual_subject_processing import (preproc_solo, dti_solo,
     ivim_solo, odf_csd_solo, odf_msmtcsd_solo, tracking_solo, sift_solo,
     verdict_solo, clean_study_solo)
 
+from elikopy.resources import cpu_allowance, thread_exports
 from elikopy.utils import submit_job, get_job_state, makedir, tbss_utils, regall_FA, regall, randomise_all
 
 
@@ -66,7 +67,8 @@ class Elikopy:
     Main class containing all the necessary function to process and preprocess a specific study.
     '''
 
-    def __init__(self, folder_path, cuda=False, slurm=False, slurm_email=None, static_files_path=None):
+    def __init__(self, folder_path, cuda=False, slurm=False, slurm_email=None, static_files_path=None,
+                 precision=None, output_dtype=None, compression=None, compact_outputs=None):
         """ Creates the study class
             example : study = Elikopy(my_floder, slurm=True, slurm_email='my_email_address')
 
@@ -74,7 +76,23 @@ class Elikopy:
             :param cuda: wether or not run on cuda when possible. default = FALSE
             :param slurm: wether or not use the slurm job scheduler (e.g. for computer clusters). default = FALSE
             :param slurm_email: the email for the slurm jobs (e.g. for computer clusters)
+            :param precision: In-memory precision of the loaded images: 'float32', 'float64' or 'native' (on-disk
+            integer type kept when possible). default = ELIKOPY_PRECISION environment variable or 'float32'
+            :param output_dtype: On-disk dtype of the floating point maps written by the pipeline, 'float32' or
+            'float64'. default = ELIKOPY_OUTPUT_DTYPE environment variable or 'float32'
+            :param compression: Dictionary mapping folders of the subjects (e.g. 'dMRI/microstructure/', or '*' for
+            all the other files) to the codec of their .nii.gz files: 'none', 'gzip:<level>' or 'pigz:<level>'
+            (multi-threaded). See elikopy.storage.DEFAULT_COMPRESSION_POLICY. default = None
+            :param compact_outputs: List of output suffixes (e.g. ['_residual.nii.gz']) that the microstructure steps
+            store as mask + voxel table instead of a dense NIfTI. See elikopy.storage.CompactVolume. default = None
         """
+        from elikopy.storage import set_precision_policy, set_compression_policy, set_compact_outputs
+        set_precision_policy(precision=precision, output_dtype=output_dtype)
+        if compression is not None:
+            set_compression_policy(compression)
+        if compact_outputs is not None:
+            set_compact_outputs(compact_outputs)
+
         self._folder_path = folder_path
         self._slurm = slurm
         if slurm:
@@ -339,40 +357,17 @@ class Elikopy:
                             dw_mri_path = folder_path + "/subjects/" + name + "/dMRI/raw/" + name + "_raw_dmri.nii.gz"
                             b0_path = folder_path + "/subjects/" + name + "/dMRI/raw/" + name +"_b0_reverse.nii.gz"
 
-                            #Copy b0 to patient path:
-                            fslroi = "fslroi " + reverse_path + " " + b0_path + " 0 1"
+                            #Copy b0 to patient path and merge it with the original DW-MRI:
                             reverse_log = open(folder_path + "/logs.txt","a+")
+                            from elikopy.utils import append_volume
                             try:
-                                output = ""
-                                output = subprocess.check_output(fslroi, universal_newlines=True, shell=True, stderr=subprocess.STDOUT)
-                            except subprocess.CalledProcessError as e:
-                                print("Error when calling fslroi, no reverse direction will be available")
-                                reverse_log.write("Error when calling fslroi, no reverse direction will be available\n")
-                                print(e.returncode)
-                                print(e.cmd)
-                                print(e.output)
-                                reverse_log.write(e.output + "\n")
-                            finally:
-                                print(output)
-                                reverse_log.write(output)
-                            #print(error_log)
-
-
-                            #Merge b0 with original DW-MRI:
-                            merge_b0 = "fslmerge -t " + dw_mri_path + " " + dw_mri_path + " " + b0_path + " "
-                            try:
-                                output = ""
-                                output = subprocess.check_output(merge_b0, universal_newlines=True, shell=True, stderr=subprocess.STDOUT)
-                            except subprocess.CalledProcessError as e:
-                                print("Error when calling fslmerge, no reverse direction will be available")
-                                reverse_log.write("Error when calling fslmerge, no reverse direction will be available\n")
-                                print(e.returncode)
-                                print(e.cmd)
-                                print(e.output)
-                                reverse_log.write(e.output + "\n")
-                            finally:
-                                print(output)
-                                reverse_log.write(output)
+                                append_volume(dw_mri_path, reverse_path, volume=0, volume_out_path=b0_path)
+                            except Exception as e:
+                                print("Error when merging the reverse b0, no reverse direction will be available")
+                                reverse_log.write("Error when merging the reverse b0, no reverse direction will be available\n")
+                                print(e)
+                                reverse_log.write(str(e) + "\n")
+
 
                             #Edit bvec:
                             with open(folder_path + "/subjects/" + name + "/dMRI/raw/" + name + "_raw_dmri.bvec", "r") as file_object:
@@ -459,7 +454,7 @@ class Elikopy:
         f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Patient list generated\n")
         f.close()
 
-    def preproc(self, folder_path=None, reslice=False, reslice_addSlice=False, denoising=False, gibbs=False, topup=False, topupConfig=None, forceSynb0DisCo=False, useGPUsynb0DisCo=False, eddy=False, biasfield=False, biasfield_bsplineFitting=[100,3], biasfield_convergence=[1000,0.001], patient_list_m=None, starting_state=None, bet_median_radius=2, bet_numpass=1, bet_dilate=2, static_files_path=None, cuda=None, cuda_name="eddy_cuda10.1", s2v=[0,5,1,'trilinear'], olrep=[False, 4, 250, 'sw'], eddy_additional_arg="", slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None, qc_reg=True, niter=5, slspec_gc_path=None, report=True):
+    def preproc(self, folder_path=None, reslice=False, reslice_addSlice=False, denoising=False, gibbs=False, topup=False, topupConfig=None, forceSynb0DisCo=False, useGPUsynb0DisCo=False, eddy=False, biasfield=False, biasfield_bsplineFitting=[100,3], biasfield_convergence=[1000,0.001], patient_list_m=None, starting_state=None, bet_median_radius=2, bet_numpass=1, bet_dilate=2, bet_mode="all", static_files_path=None, cuda=None, cuda_name="eddy_cuda10.1", s2v=[0,5,1,'trilinear'], olrep=[False, 4, 250, 'sw'], eddy_additional_arg="", slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None, qc_reg=True, niter=5, slspec_gc_path=None, report=True):
         """ Performs data preprocessing. By default only the brain extraction is enabled. Optional preprocessing steps include : reslicing,
         denoising, gibbs ringing correction, susceptibility field estimation, EC-induced distortions and motion correction, bias field correction.
         The results are stored in the preprocessing subfolder of each study subject <folder_path>/subjects/<subjects_ID>/dMRI/preproc.
@@ -483,6 +478,7 @@ class Elikopy:
         :param bet_median_radius: Radius (in voxels) of the applied median filter during brain extraction. default=2
         :param bet_numpass: Number of pass of the median filter during brain extraction. default=1
         :param bet_dilate: Number of iterations for binary dilation during brain extraction. default=2
+        :param bet_mode: Either 'all' (median_otsu on the mean of every volume) or 'b0' (faster, median_otsu on the mean b0 image only). default='all'
         :param cuda: If true, eddy will run on cuda with the command name specified in cuda_name. default=False
         :param cuda_name: name of the eddy command to run when cuda==True. default="eddy_cuda10.1"
         :param s2v: list of parameters of Eddy for slice-to-volume motion correction (see Eddy FSL documentation): [mporder,s2v_niter,s2v_lambda,s2v_interp]. The slice-to-volume motion correction is performed if mporder>0, cuda is used and a slspec file is provided during the patient_list command. default=[0,5,1,'trilinear']
@@ -544,11 +540,11 @@ class Elikopy:
                     tot_cpu = 8 if cpus is None else cpus
                     core_count = tot_cpu
                     p_job = {
-                        "wrap": "export OMP_NUM_THREADS="+str(tot_cpu)+" ; export FSLPARALLEL="+str(tot_cpu)+" ; python -c 'from elikopy.individual_subject_processing import preproc_solo; preproc_solo(\"" + folder_path + "/\",\"" + p + "\",eddy=" + str(
+                        "wrap": thread_exports(tot_cpu) + "python -c 'from elikopy.individual_subject_processing import preproc_solo; preproc_solo(\"" + folder_path + "/\",\"" + p + "\",eddy=" + str(
                             eddy) + ",biasfield=" + str(biasfield)  + ",biasfield_convergence=[" + str(biasfield_convergence[0]) + "," + str(biasfield_convergence[1]) + "],biasfield_bsplineFitting=[" + str(biasfield_bsplineFitting[0]) + "," + str(biasfield_bsplineFitting[1]) + "],denoising=" + str(
                             denoising) + ",reslice=" + str(reslice) + ",reslice_addSlice=" + str(reslice_addSlice) + ",gibbs=" + str(
                             gibbs) + ",topup=" + str(topup) + ",forceSynb0DisCo=" + str(forceSynb0DisCo) + ",useGPUsynb0DisCo=" + str(useGPUsynb0DisCo) + ",topupConfig=\"" + str(topupConfig) + "\",starting_state=\"" + str(starting_state) + "\",static_files_path=\""+ static_files_path +"\" ,bet_median_radius=" + str(
-                            bet_median_radius) + ",bet_dilate=" + str(bet_dilate) + ", qc_reg=" + str(qc_reg) + ", report=" + str(report) + ", slspec_gc_path=" + str(slspec_gc_path) + ", core_count=" + str(core_count)+ ", niter=" + str(niter)+",bet_numpass=" + str(
+                            bet_median_radius) + ",bet_dilate=" + str(bet_dilate) + ",bet_mode=\"" + str(bet_mode) + "\", qc_reg=" + str(qc_reg) + ", report=" + str(report) + ", slspec_gc_path=" + str(slspec_gc_path) + ", core_count=" + str(core_count)+ ", niter=" + str(niter)+",bet_numpass=" + str(
                             bet_numpass) + ",cuda=" + str(cuda) + ",cuda_name=\"" + str(cuda_name) + "\",s2v=[" + str(s2v[0]) + "," + str(s2v[1]) + "," + str(s2v[2]) + ",\"" + str(s2v[3]) + "\"],olrep=[" + str(olrep[0]) + "," + str(olrep[1]) + "," + str(olrep[2]) + ",\"" + str(olrep[3]) + "\"], " + "eddy_additional_arg=\"" + str(eddy_additional_arg) + "\" )'",
                         "job_name": "preproc_" + p,
                         "ntasks": 1,
@@ -597,7 +593,7 @@ class Elikopy:
                                  topup=topup, topupConfig=topupConfig, forceSynb0DisCo=forceSynb0DisCo, useGPUsynb0DisCo=useGPUsynb0DisCo,
                                  eddy=eddy,biasfield=biasfield, biasfield_bsplineFitting=biasfield_bsplineFitting, biasfield_convergence=biasfield_convergence,
                                  starting_state=starting_state,
-                                 bet_median_radius=bet_median_radius,bet_dilate=bet_dilate,bet_numpass=bet_numpass,cuda=self._cuda, qc_reg=qc_reg, core_count=core_count,
+                                 bet_median_radius=bet_median_radius,bet_dilate=bet_dilate,bet_numpass=bet_numpass,bet_mode=bet_mode,cuda=self._cuda, qc_reg=qc_reg, core_count=core_count,
                                  cuda_name=cuda_name, s2v=s2v, olrep=olrep, niter=niter, slspec_gc_path=slspec_gc_path, report=report, static_files_path=static_files_path, eddy_additional_arg=eddy_additional_arg)
                     matplotlib.pyplot.close(fig='all')
                     f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully preprocessed patient %s\n" % p)
@@ -620,7 +616,7 @@ class Elikopy:
             f.close()
 
             shutil.rmtree(folder_path + '/eddy_squad', ignore_errors=True)
-            bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; eddy_squad "' + dest_list + '" --update -o ' + folder_path + '/eddy_squad'
+            bashCommand = thread_exports(cpu_allowance(core_count)) + 'eddy_squad "' + dest_list + '" --update -o ' + folder_path + '/eddy_squad'
             bashcmd = bashCommand.split()
             process = subprocess.Popen(bashCommand, universal_newlines=True, shell=True)
             output, error = process.communicate()
@@ -652,7 +648,7 @@ class Elikopy:
         f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": All the preprocessing operation are finished!\n")
         f.close()
 
-    def dti(self,folder_path=None, patient_list_m=None, maskType="brain_mask_dilated", use_all_shells: bool = False,
+    def dti(self,folder_path=None, patient_list_m=None, maskType="brain_mask_dilated", use_all_shells: bool = False, fit_method="WLS",
             slurm=None, slurm_email=None, slurm_timeout=None, slurm_cpus=None, slurm_mem=None):
         """Computes the DTI metrics for each subject using Weighted Least-Squares. The outputs are available in the directories <folder_path>/subjects/<subjects_ID>/dMRI/dti/.
 
@@ -664,6 +660,7 @@ class Elikopy:
         :param use_all_shells: Boolean. DTI will use all shells available, not just
         shells <= 2000, this will cause a more defined white matter at the cost of
         an erronous estimation of the CSF. The default is False.
+        :param fit_method: Tensor fitting method, either "WLS" or "NLLS". default="WLS"
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
         :param slurm_email: Email adress to send notification if a task fails. default=None
         :param slurm_timeout: Replace the default slurm timeout of 1h by a custom timeout.
@@ -689,6 +686,8 @@ class Elikopy:
         if patient_list_m:
             patient_list = patient_list_m
 
+        core_count = 1 if slurm_cpus is None else slurm_cpus
+
         job_list = []
         f=open(folder_path + "/logs.txt", "a+")
         for p in patient_list:
@@ -700,7 +699,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "python -c 'from elikopy.individual_subject_processing import dti_solo; dti_solo(\"" + folder_path + "/\",\"" + p + "\",maskType=\"" + str(maskType) + "\", use_all_shells=" + str(use_all_shells) +")'",
+                        "wrap": "python -c 'from elikopy.individual_subject_processing import dti_solo; dti_solo(\"" + folder_path + "/\",\"" + p + "\",maskType=\"" + str(maskType) + "\", use_all_shells=" + str(use_all_shells) + ", fit_method=\"" + str(fit_method) + "\", core_count=" + str(core_count) + ")'",
                         "job_name": "dti_" + p,
                         "ntasks": 1,
                         "cpus_per_task": 1,
@@ -722,7 +721,7 @@ class Elikopy:
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Patient %s is ready to be processed\n" % p)
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
             else:
-                dti_solo(folder_path + "/",p,maskType=maskType,use_all_shells=use_all_shells)
+                dti_solo(folder_path + "/",p,maskType=maskType,use_all_shells=use_all_shells,fit_method=fit_method,core_count=core_count)
                 matplotlib.pyplot.close(fig='all')
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully applied DTI on patient %s\n" % p)
                 f.flush()
@@ -790,7 +789,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export MKL_NUM_THREADS="+ str(core_count)+" ; export OMP_NUM_THREADS="+ str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import mf_solo; mf_solo(\"" + folder_path + "/\",\"" + p + "\", \"" + dictionary_path + "\", peaksType=\"" + str(peaksType) + "\", core_count=" + str(core_count) + ", maskType=\"" + str(maskType) + "\", mfdir=\"" + str(mfdir)+ "\", csf_mask=" + str(csf_mask) + ", ear_mask=" + str(ear_mask) + ", output_filename= \"" + output_filename + "\"" + ")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import mf_solo; mf_solo(\"" + folder_path + "/\",\"" + p + "\", \"" + dictionary_path + "\", peaksType=\"" + str(peaksType) + "\", core_count=" + str(core_count) + ", maskType=\"" + str(maskType) + "\", mfdir=\"" + str(mfdir)+ "\", csf_mask=" + str(csf_mask) + ", ear_mask=" + str(ear_mask) + ", output_filename= \"" + output_filename + "\"" + ")'",
                         "job_name": "mf_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -825,7 +824,7 @@ class Elikopy:
         f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": End of microstructure fingerprinting\n")
         f.close()
 
-    def odf_csd(self, folder_path=None, CSD_bvalue = None, maskType="brain_mask_dilated", CSD_FA_treshold=0.7,  num_peaks = 2, peaks_threshold=.25, slurm=None, patient_list_m=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+    def odf_csd(self, folder_path=None, CSD_bvalue = None, maskType="brain_mask_dilated", CSD_FA_treshold=0.7,  num_peaks = 2, peaks_threshold=.25, group_response=False, slurm=None, patient_list_m=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
         """Computes the odf using CSD for each subject. The outputs are available in the directories <folder_path>/subjects/<subjects_ID>/dMRI/ODF/CSD/.
 
         example : study.odf_csd()
@@ -833,6 +832,7 @@ class Elikopy:
         :param folder_path: the path to the root directory. default=study_folder
         :param CSD_bvalue: If the DIAMOND outputs are not available, the fascicles directions are estimated using a CSD with the images at the b-values specified in this argument. default=None
         :param maskType: Define which mask to use during processing. default="brain_mask_dilated"
+        :param group_response: If true, a group response is computed once per acquisition scheme (average of the subjects responses) and used for every subject. The responses are stored in <folder_path>/responses/. default=False
         :param patient_list_m: Define a subset of subjects to process instead of all the available subjects. example : ['patientID1','patientID2','patientID3']. default=None
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
         :param slurm_email: Email adress to send notification if a task fails. default=None
@@ -863,6 +863,13 @@ class Elikopy:
 
         core_count = 4 if cpus is None else cpus
 
+        if group_response:
+            from elikopy.odf import ResponseRegistry
+            ResponseRegistry(folder_path).compute_group_csd_response(patient_list, CSD_bvalue=CSD_bvalue, fa_thr=CSD_FA_treshold)
+            f=open(folder_path + "/logs.txt", "a+")
+            f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Group CSD responses computed\n")
+            f.close()
+
         job_list = []
         f=open(folder_path + "/logs.txt", "a+")
         for p in patient_list:
@@ -873,7 +880,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export MKL_NUM_THREADS="+ str(core_count)+" ; export OMP_NUM_THREADS="+ str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import odf_csd_solo; odf_csd_solo(\"" + folder_path + "/\",\"" + p + "\", CSD_bvalue =" + str(CSD_bvalue) + ", core_count=" + str(core_count) + ", CSD_FA_treshold="+ str(CSD_FA_treshold) + ", num_peaks="+ str(num_peaks) + ", peaks_threshold="+ str(peaks_threshold) + ", maskType=\"" + str(maskType) + "\")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import odf_csd_solo; odf_csd_solo(\"" + folder_path + "/\",\"" + p + "\", CSD_bvalue =" + str(CSD_bvalue) + ", core_count=" + str(core_count) + ", CSD_FA_treshold="+ str(CSD_FA_treshold) + ", num_peaks="+ str(num_peaks) + ", peaks_threshold="+ str(peaks_threshold) + ", maskType=\"" + str(maskType) + "\", group_response=" + str(group_response) + ")'",
                         "job_name": "CSD_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -894,7 +901,7 @@ class Elikopy:
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Patient %s is ready to be processed\n" % p)
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
             else:
-                odf_csd_solo(folder_path + "/", p, CSD_bvalue = CSD_bvalue, num_peaks = num_peaks, peaks_threshold=peaks_threshold, core_count=core_count, maskType=maskType, CSD_FA_treshold=CSD_FA_treshold)
+                odf_csd_solo(folder_path + "/", p, CSD_bvalue = CSD_bvalue, num_peaks = num_peaks, peaks_threshold=peaks_threshold, core_count=core_count, maskType=maskType, CSD_FA_treshold=CSD_FA_treshold, group_response=group_response)
                 matplotlib.pyplot.close(fig='all')
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully applied ODF CSD on patient %s\n" % p)
                 f.flush()
@@ -908,12 +915,13 @@ class Elikopy:
         f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": End of ODF CSD\n")
         f.close()
 
-    def odf_msmtcsd(self, folder_path=None, num_peaks = 2, peaks_threshold=0.25, maskType="brain_mask_dilated", slurm=None, patient_list_m=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+    def odf_msmtcsd(self, folder_path=None, num_peaks = 2, peaks_threshold=0.25, maskType="brain_mask_dilated", group_response=False, slurm=None, patient_list_m=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
         """Computes the odf using MSMT-CSD for each subject. The outputs are available in the directories <folder_path>/subjects/<subjects_ID>/dMRI/ODF/MSMT-CSD/.
 
         example : study.odf_msmtcsd()
 
         :param folder_path: the path to the root directory. default=study_folder
+        :param group_response: If true, group responses are computed once per acquisition scheme (responsemean of the subjects responses) and used for every subject. The responses are stored in <folder_path>/responses/. default=False
         :param patient_list_m: Define a subset of subjects to process instead of all the available subjects. example : ['patientID1','patientID2','patientID3']. default=None
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
         :param slurm_email: Email adress to send notification if a task fails. default=None
@@ -943,6 +951,13 @@ class Elikopy:
 
         core_count = 4 if cpus is None else cpus
 
+        if group_response:
+            from elikopy.odf import ResponseRegistry
+            f=open(folder_path + "/logs.txt", "a+")
+            ResponseRegistry(folder_path).compute_group_msmt_response(patient_list, core_count=core_count, log_file=f)
+            f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Group MSMT-CSD responses computed\n")
+            f.close()
+
         job_list = []
         f=open(folder_path + "/logs.txt", "a+")
         for p in patient_list:
@@ -953,7 +968,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export MKL_NUM_THREADS="+ str(core_count)+" ; export OMP_NUM_THREADS="+ str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import odf_msmtcsd_solo; odf_msmtcsd_solo(\"" + folder_path + "/\",\"" + p + "\", num_peaks =" + str(num_peaks) + ", core_count=" + str(core_count) + ", maskType=\"" + str(maskType) + "\", peaks_threshold="+ str(peaks_threshold) + ")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import odf_msmtcsd_solo; odf_msmtcsd_solo(\"" + folder_path + "/\",\"" + p + "\", num_peaks =" + str(num_peaks) + ", core_count=" + str(core_count) + ", maskType=\"" + str(maskType) + "\", peaks_threshold="+ str(peaks_threshold) + ", group_response=" + str(group_response) + ")'",
                         "job_name": "MSMTCSD_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -974,7 +989,7 @@ class Elikopy:
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Patient %s is ready to be processed\n" % p)
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
             else:
-                odf_msmtcsd_solo(folder_path + "/", p, num_peaks=num_peaks, peaks_threshold=peaks_threshold, core_count=core_count, maskType=maskType)
+                odf_msmtcsd_solo(folder_path + "/", p, num_peaks=num_peaks, peaks_threshold=peaks_threshold, core_count=core_count, maskType=maskType, group_response=group_response)
                 matplotlib.pyplot.close(fig='all')
                 f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully applied ODF MSMT-CSD on patient %s\n" % p)
                 f.flush()
@@ -1034,7 +1049,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export MKL_NUM_THREADS="+ str(core_count)+" ; export OMP_NUM_THREADS="+ str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import tracking_solo; tracking_solo(\"" + folder_path + "/\",\"" + p + "\", streamline_number =" + str(streamline_number) + ", msmtCSD=" + str(msmtCSD) + ", core_count=" + str(core_count) + ", save_as_trk=" + str(save_as_trk) + ", cutoff=" + str(cutoff) + ", max_angle="+ str(max_angle) + ", maskType= \"" + maskType + "\"" + ", output_filename= \"" + output_filename + "\"" + ")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import tracking_solo; tracking_solo(\"" + folder_path + "/\",\"" + p + "\", streamline_number =" + str(streamline_number) + ", msmtCSD=" + str(msmtCSD) + ", core_count=" + str(core_count) + ", save_as_trk=" + str(save_as_trk) + ", cutoff=" + str(cutoff) + ", max_angle="+ str(max_angle) + ", maskType= \"" + maskType + "\"" + ", output_filename= \"" + output_filename + "\"" + ")'",
                         "job_name": "TRACKING_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1117,7 +1132,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export MKL_NUM_THREADS="+ str(core_count)+" ; export OMP_NUM_THREADS="+ str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import sift_solo; sift_solo(\"" + folder_path + "/\",\"" + p + "\", streamline_number =" + str(streamline_number) + ", msmtCSD=" + str(msmtCSD) + ", core_count=" + str(core_count) + ", save_as_trk=" + str(save_as_trk) + ", input_filename= \"" + input_filename + "\"" + ")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import sift_solo; sift_solo(\"" + folder_path + "/\",\"" + p + "\", streamline_number =" + str(streamline_number) + ", msmtCSD=" + str(msmtCSD) + ", core_count=" + str(core_count) + ", save_as_trk=" + str(save_as_trk) + ", input_filename= \"" + input_filename + "\"" + ")'",
                         "job_name": "SIFT_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1154,7 +1169,7 @@ class Elikopy:
         f.close()
 
 
-    def white_mask(self, maskType, folder_path=None, patient_list_m=None, corr_gibbs=True, debug=False, slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+    def white_mask(self, maskType, folder_path=None, patient_list_m=None, corr_gibbs=True, debug=False, slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None, registration_preset="accurate"):
         """ Computes a white matter mask for each subject based on the T1 structural images or on the anisotropic power maps
         (obtained from the diffusion images) if the T1 images are not available. The outputs are available in the directories <folder_path>/subjects/<subjects_ID>/masks/.
         The T1 images can be gibbs ringing corrected.
@@ -1171,6 +1186,7 @@ class Elikopy:
         :param slurm_timeout: Replace the default slurm timeout of 3h by a custom timeout.
         :param cpus: Replace the default number of slurm cpus of 1 by a custom number of cpus of using slum, or for standard processing, its the number of core available for processing.
         :param slurm_mem: Replace the default amount of ram allocated to the slurm task (8096MO by cpu) by a custom amount of ram.
+        :param registration_preset: Speed against accuracy trade-off of the T1 to diffusion registration, one of 'fast', 'balanced' or 'accurate'. default='accurate'
         """
 
         folder_path = self._folder_path if folder_path is None else folder_path
@@ -1199,7 +1215,7 @@ class Elikopy:
             if slurm:
                 core_count = 1 if cpus is None else cpus
                 p_job = {
-                        "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import white_mask_solo; white_mask_solo(\"" + folder_path + "/\",\"" + p + "\", \"" + maskType + "\" ,corr_gibbs=" + str(corr_gibbs) + ",debug=" + str(debug) + ",core_count=" + str(core_count) + " )'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import white_mask_solo; white_mask_solo(\"" + folder_path + "/\",\"" + p + "\", \"" + maskType + "\" ,corr_gibbs=" + str(corr_gibbs) + ",debug=" + str(debug) + ",core_count=" + str(core_count) + ",registration_preset=\"" + str(registration_preset) + "\" )'",
                         "job_name": "whitemask_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1221,7 +1237,7 @@ class Elikopy:
                 f.write("[White mask] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Patient %s is ready to be processed\n" % p)
                 f.write("[White mask] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
             else:
-                white_mask_solo(folder_path + "/", p, maskType, corr_gibbs=corr_gibbs, core_count=core_count, debug=debug)
+                white_mask_solo(folder_path + "/", p, maskType, corr_gibbs=corr_gibbs, core_count=core_count, debug=debug, registration_preset=registration_preset)
                 matplotlib.pyplot.close(fig='all')
                 f.write("[White mask] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully applied white mask on patient %s\n" % p)
                 f.flush()
@@ -1284,7 +1300,7 @@ class Elikopy:
             if slurm:
                 core_count = 1 if cpus is None else cpus
                 p_job = {
-                        "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import noddi_solo; noddi_solo(\"" + folder_path + "/\",\"" + p + "\", maskType=\"" + str(maskType) + "\",core_count="+str(core_count)+ ",lambda_iso_diff="+str(lambda_iso_diff) +", lambda_par_diff="+str(lambda_par_diff) + ")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import noddi_solo; noddi_solo(\"" + folder_path + "/\",\"" + p + "\", maskType=\"" + str(maskType) + "\",core_count="+str(core_count)+ ",lambda_iso_diff="+str(lambda_iso_diff) +", lambda_par_diff="+str(lambda_par_diff) + ")'",
                         "job_name": "noddi_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1447,7 +1463,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import diamond_solo; diamond_solo(\"" + folder_path + "/\",\"" + p + "\", reportOnly="+str(reportOnly) + ", core_count="+str(core_count) + ", maskType=\"" + str(maskType) + "\", customDiamond=\"" + customDiamond + "\")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import diamond_solo; diamond_solo(\"" + folder_path + "/\",\"" + p + "\", reportOnly="+str(reportOnly) + ", core_count="+str(core_count) + ", maskType=\"" + str(maskType) + "\", customDiamond=\"" + customDiamond + "\")'",
                         "job_name": "diamond_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1530,7 +1546,7 @@ class Elikopy:
             if slurm:
                 core_count = 1 if cpus is None else cpus
                 p_job = {
-                        "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import ivim_solo; ivim_solo(\"" + folder_path + "/\",\"" + p + "\",G1Ball_2_lambda_iso=" + str(G1Ball_2_lambda_iso) + ",core_count="+str(core_count)+ ", G1Ball_1_lambda_iso="+str(G1Ball_1_lambda_iso) + " ,maskType=\"" + str(maskType)+ "\")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import ivim_solo; ivim_solo(\"" + folder_path + "/\",\"" + p + "\",G1Ball_2_lambda_iso=" + str(G1Ball_2_lambda_iso) + ",core_count="+str(core_count)+ ", G1Ball_1_lambda_iso="+str(G1Ball_1_lambda_iso) + " ,maskType=\"" + str(maskType)+ "\")'",
                         "job_name": "ivim_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1610,7 +1626,7 @@ class Elikopy:
             if slurm:
                 core_count = 1 if cpus is None else cpus
                 p_job = {
-                        "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import verdict_solo; verdict_solo(\"" + folder_path + "/\",\"" + p + "\",G1Ball_1_lambda_iso=" + str(G1Ball_1_lambda_iso) + ",TumorCells_Dconst=" + str(TumorCells_Dconst) + ",big_delta=" + str(big_delta) + ",small_delta=" + str(small_delta) + ",core_count="+str(core_count)+ ", C1Stick_1_lambda_par="+str(C1Stick_1_lambda_par) + ")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import verdict_solo; verdict_solo(\"" + folder_path + "/\",\"" + p + "\",G1Ball_1_lambda_iso=" + str(G1Ball_1_lambda_iso) + ",TumorCells_Dconst=" + str(TumorCells_Dconst) + ",big_delta=" + str(big_delta) + ",small_delta=" + str(small_delta) + ",core_count="+str(core_count)+ ", C1Stick_1_lambda_par="+str(C1Stick_1_lambda_par) + ")'",
                         "job_name": "verdict_" + p,
                         "ntasks": 1,
                         "cpus_per_task": core_count,
@@ -1895,7 +1911,7 @@ class Elikopy:
         f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": End of Export\n")
         f.close()
 
-    def regall_FA(self, folder_path=None, starting_state=None, registration_type="-T", postreg_type="-S", prestats_treshold=0.2, slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+    def regall_FA(self, folder_path=None, starting_state=None, registration_type="-T", postreg_type="-S", prestats_treshold=0.2, engine="fsl", slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
         """ Register all the subjects Fractional Anisotropy into a common space, skeletonisedd and non skeletonised. This is performed based on TBSS of FSL.
         It is mandatory to have performed DTI prior to regall_FA.
 
@@ -1904,6 +1920,7 @@ class Elikopy:
         :param registration_type: Define the argument used by the tbss command tbss_2_reg. Could either by '-T', '-t' or '-n'. If '-T' is used, a FMRIB58_FA standard-space image is used. If '-t' is used, a custom image is used. If '-n' is used, every FA image is align to every other one, identify the "most representative" one, and use this as the target image.
         :param postreg_type: Define the argument used by the tbss command tbss_3_postreg. Could either by '-S' or '-T'. If you wish to use the FMRIB58_FA mean FA image and its derived skeleton, instead of the mean of your subjects in the study, use the '-T' option. Otherwise, use the '-S' option.
         :param prestats_treshold: Thresholds the mean FA skeleton image at the chosen threshold during prestats. default=0.2
+        :param engine: Engine of the postreg and prestats steps, either 'fsl' (tbss_3_postreg and tbss_4_prestats) or 'python' (in-process skeletonisation and projection of the subjects in parallel). The python engine requires the registration type '-T' or '-t'. default='fsl'
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
         :param slurm_email: Email adress to send notification if a task fails. default=None
         :param slurm_timeout: Replace the default slurm timeout of 20h by a custom timeout.
@@ -1914,7 +1931,7 @@ class Elikopy:
         assert registration_type in ("-T", "-t", "-n"), 'invalid registration type!'
         assert postreg_type in ("-S", "-T"), 'invalid postreg type!'
         assert starting_state in (None, "reg", "postreg", "prestats"), 'invalid starting state!'
-
+        assert engine in ("fsl", "python"), 'invalid engine!'
 
         log_prefix = "REGALL_FA"
         folder_path = self._folder_path if folder_path is None else folder_path
@@ -1934,7 +1951,7 @@ class Elikopy:
         f = open(folder_path + "/logs.txt", "a+")
         if slurm:
             job = {
-                "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.utils import regall_FA; regall_FA(\"" + str(folder_path) + "\",starting_state=\"" + str(starting_state) + "\",registration_type=\"" + str(registration_type) + "\",postreg_type=\"" + str(postreg_type) + "\",prestats_treshold=" + str(prestats_treshold) + ")'",
+                "wrap": thread_exports(core_count) + "python -c 'from elikopy.utils import regall_FA; regall_FA(\"" + str(folder_path) + "\",starting_state=\"" + str(starting_state) + "\",registration_type=\"" + str(registration_type) + "\",postreg_type=\"" + str(postreg_type) + "\",prestats_treshold=" + str(prestats_treshold) + ",core_count=" + str(core_count) + ",engine=\"" + str(engine) + "\")'",
                 "job_name": "regall_FA",
                 "ntasks": 1,
                 "cpus_per_task": core_count,
@@ -1953,7 +1970,7 @@ class Elikopy:
             job_list.append(p_job_id)
             f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
         else:
-            regall_FA(folder_path=folder_path, starting_state=starting_state, registration_type=registration_type, postreg_type=postreg_type, prestats_treshold=prestats_treshold, core_count=core_count)
+            regall_FA(folder_path=folder_path, starting_state=starting_state, registration_type=registration_type, postreg_type=postreg_type, prestats_treshold=prestats_treshold, core_count=core_count, engine=engine)
             f.write("["+log_prefix+"] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully applied REGALL_FA \n")
             f.flush()
         f.close()
@@ -1966,12 +1983,13 @@ class Elikopy:
         f.close()
 
     def regall(self, folder_path=None, metrics_dic={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'},
-               slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+               engine="fsl", slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
         """ Register all the subjects diffusion metrics specified in the argument metrics_dic into a common space using the transformation computed for the FA with the regall_FA function. This is performed based on TBSS of FSL.
         It is mandatory to have performed regall_FA prior to regall.
 
         :param folder_path: the path to the root directory. default=study_folder
         :param metrics_dic: Dictionnary containing the diffusion metrics to register in a common space. For each diffusion metric, the metric name is the key and the metric's folder is the value. default={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'}
+        :param engine: Either 'fsl' (tbss_non_FA) or 'python' (in-process projection reusing the skeleton projections of regall_FA, which must have been run with the python engine). default='fsl'
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
         :param slurm_email: Email adress to send notification if a task fails. default=None
         :param slurm_timeout: Replace the default slurm timeout of 20h by a custom timeout.
@@ -1998,9 +2016,9 @@ class Elikopy:
         f = open(folder_path + "/logs.txt", "a+")
         if slurm:
             job = {
-                "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.utils import regall; regall(\"" + str(
+                "wrap": thread_exports(core_count) + "python -c 'from elikopy.utils import regall; regall(\"" + str(
                     folder_path) + "\",metrics_dic=" + str(
-                    json.dumps(metrics_dic)) + ")'",
+                    json.dumps(metrics_dic)) + ",core_count=" + str(core_count) + ",engine=\"" + str(engine) + "\")'",
                 "job_name": "regall",
                 "ntasks": 1,
                 "cpus_per_task": core_count,
@@ -2020,7 +2038,7 @@ class Elikopy:
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
         else:
-            regall(folder_path=folder_path, core_count=core_count, metrics_dic=metrics_dic)
+            regall(folder_path=folder_path, core_count=core_count, metrics_dic=metrics_dic, engine=engine)
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Successfully applied REGALL \n")
             f.flush()
@@ -2035,8 +2053,86 @@ class Elikopy:
         f.close()
 
 
+    def register_study(self, function_name="regallDWIToT1wToT1wCommonSpace", folder_path=None, patient_list_m=None, registration_args=None, max_memory=None, slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+        """ Registers all the subjects to the common space with regallDWIToT1wToT1wCommonSpace or regallFAToMNI. Without slurm, the subjects are spread over a pool of cpus worker processes. With slurm, the subjects are submitted as one Slurm job array.
+        The mappings are written atomically in <folder_path>/subjects/<subjects_ID>/reg/ and reused when present, so that calling this function again after an interruption only registers the remaining subjects.
+
+        example : study.register_study(registration_args={'DWI_type': 'B0FSL', 'maskType': 'brain_mask'}, cpus=8, max_memory=12000)
+
+        :param function_name: Either 'regallDWIToT1wToT1wCommonSpace' or 'regallFAToMNI'. default='regallDWIToT1wToT1wCommonSpace'
+        :param folder_path: the path to the root directory. default=study_folder
+        :param patient_list_m: Define a subset of subjects to process instead of all the available subjects. example : ['patientID1','patientID2','patientID3']. default=None
+        :param registration_args: Dictionary of additional arguments of the registration function. default=None
+        :param max_memory: Maximum amount of memory in MB of each worker process (or of each array task with slurm). default=None
+        :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
+        :param slurm_email: Email adress to send notification if a task fails. default=None
+        :param slurm_timeout: Replace the default slurm timeout of 10h by a custom timeout.
+        :param cpus: Number of worker processes without slurm. With slurm, number of array tasks running simultaneously (all of them by default).
+        :param slurm_mem: Replace the default amount of ram allocated to each slurm task (8096MO by cpu) by a custom amount of ram.
+        """
+        from elikopy.registration import REGISTRATION_FUNCTIONS, regall_subjects, _registration_waves
+
+        assert function_name in REGISTRATION_FUNCTIONS, "The function_name parameter must be one of the following : " + ", ".join(REGISTRATION_FUNCTIONS)
+
+        log_prefix = "Registration"
+        folder_path = self._folder_path if folder_path is None else folder_path
+        slurm = self._slurm if slurm is None else slurm
+        slurm_email = self._slurm_email if slurm_email is None else slurm_email
+        registration_args = {} if registration_args is None else registration_args
+
+        f = open(folder_path + "/logs.txt", "a+")
+        f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Beginning of " + function_name + " with slurm:" + str(slurm) + "\n")
+        f.close()
+
+        dest_success = folder_path + "/subjects/subj_list.json"
+        with open(dest_success, 'r') as f:
+            patient_list = json.load(f)
+
+        if patient_list_m:
+            patient_list = patient_list_m
+
+        if slurm:
+            for i, wave in enumerate(_registration_waves(folder_path, patient_list, registration_args)):
+                if not wave:
+                    continue
+                task_file = folder_path + "/subjects/registration_tasks_" + str(i) + ".json"
+                with open(task_file + ".tmp", "w") as f:
+                    json.dump({"folder_path": folder_path, "function_name": function_name, "kwargs": registration_args, "patient_list": wave}, f)
+                os.replace(task_file + ".tmp", task_file)
+                job = {
+                    "wrap": thread_exports(1) + "python -c 'from elikopy.registration import regall_array_task; regall_array_task(\"" + task_file + "\")'",
+                    "job_name": "registration",
+                    "array": "0-" + str(len(wave) - 1) + ("" if cpus is None else "%" + str(cpus)),
+                    "ntasks": 1,
+                    "cpus_per_task": 1,
+                    "mem_per_cpu": 8096,
+                    "time": "10:00:00",
+                    "mail_user": slurm_email,
+                    "mail_type": "FAIL",
+                    "output": folder_path + "/subjects/slurm-registration-%A_%a.out",
+                    "error": folder_path + "/subjects/slurm-registration-%A_%a.err",
+                }
+                job["time"] = job["time"] if slurm_timeout is None else slurm_timeout
+                job["mem_per_cpu"] = job["mem_per_cpu"] if slurm_mem is None else slurm_mem
+                if max_memory is not None:
+                    del job["mem_per_cpu"]
+                    job["mem"] = max_memory
+                array_id = submit_job(job)
+                job_list = [{"id": str(array_id) + "_" + str(j), "name": p} for j, p in enumerate(wave)]
+                f = open(folder_path + "/logs.txt", "a+")
+                f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Successfully submited job array %s using slurm\n" % array_id)
+                f.close()
+                elikopy.utils.getJobsState(folder_path, job_list, log_prefix)
+        else:
+            core_count = 1 if cpus is None else cpus
+            regall_subjects(folder_path, patient_list, function_name=function_name, core_count=core_count, max_memory=max_memory, **registration_args)
+
+        f = open(folder_path + "/logs.txt", "a+")
+        f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": End of " + function_name + "\n")
+        f.close()
+
     def randomise_all(self, folder_path=None, grp1=None, grp2=None, randomise_numberofpermutation=5000,skeletonised=True,metrics_dic={'FA':'dti','_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'},
-               slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+               engine="randomise", slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
         """ Performs tract base spatial statistics (TBSS) between the data in grp1 and grp2 (groups are specified during the call to regall_FA) for each diffusion metric specified in the argument metrics_dic.
         The mean value of the diffusion metrics across atlases regions can also be reported in CSV files using the regionWiseMean flag. The used atlases are : the Harvard-Oxford cortical and subcortical structural atlases, the JHU DTI-based white-matter atlases and the MNI structural atlas
         It is mandatory to have performed regall_FA prior to randomise_all.
@@ -2045,6 +2141,7 @@ class Elikopy:
         :param randomise_numberofpermutation: Define the number of permutations. default=5000
         :param skeletonised: If True, randomize will be using only the white matter skeleton instead of the whole brain. default=True
         :param metrics_dic: Dictionnary containing the diffusion metrics to register in a common space. For each diffusion metric, the metric name is the key and the metric's folder is the value. default={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'}
+        :param engine: Permutation engine, either "randomise" (FSL randomise) or "python" (in-process elikopy.stats.permutation_glm with the same outputs). default="randomise"
         :param regionWiseMean: If true, csv containing atlas-based region wise mean will be generated.
         :param additional_atlases: Dic that define additional atlases to be used as segmentation template for csv generation (see regionWiseMean). Dictionary is in the form {'Atlas_name_1':["path to atlas 1 xml","path to atlas 1 nifti"],'Atlas_name_1':["path to atlas 2 xml","path to atlas 2 nifti"]}.
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
@@ -2076,8 +2173,8 @@ class Elikopy:
         f = open(folder_path + "/logs.txt", "a+")
         if slurm:
             job = {
-                "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.utils import randomise_all; randomise_all(\"" + str(
-                    folder_path) + "\",grp1=" + str(grp1) + ",grp2=" + str(grp2) + ",randomise_numberofpermutation=" + str(randomise_numberofpermutation) + ",skeletonised=" + str(skeletonised) + ",core_count=" + str(core_count) + ",metrics_dic=" + str(
+                "wrap": thread_exports(core_count) + "python -c 'from elikopy.utils import randomise_all; randomise_all(\"" + str(
+                    folder_path) + "\",grp1=" + str(grp1) + ",grp2=" + str(grp2) + ",randomise_numberofpermutation=" + str(randomise_numberofpermutation) + ",skeletonised=" + str(skeletonised) + ",core_count=" + str(core_count) + ",engine=\"" + str(engine) + "\",metrics_dic=" + str(
                     json.dumps(metrics_dic)) + ")'",
                 "job_name": "randomise_all",
                 "ntasks": 1,
@@ -2098,7 +2195,7 @@ class Elikopy:
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
         else:
-            randomise_all(folder_path=folder_path, grp1=grp1, grp2=grp2, randomise_numberofpermutation=randomise_numberofpermutation, skeletonised=skeletonised, metrics_dic=metrics_dic,core_count=cpus)
+            randomise_all(folder_path=folder_path, grp1=grp1, grp2=grp2, randomise_numberofpermutation=randomise_numberofpermutation, skeletonised=skeletonised, metrics_dic=metrics_dic,core_count=core_count, engine=engine)
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Successfully applied randomise_all \n")
             f.flush()
@@ -2113,7 +2210,7 @@ class Elikopy:
         f.close()
 
     def vbm(self, folder_path=None, grp1=None, grp2=None, randomise_numberofpermutation=5000,metrics_dic={'FA':'dti','_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'},maskType="brain_mask_dilated",
-               slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
+               engine="randomise", slurm=None, slurm_email=None, slurm_timeout=None, cpus=None, slurm_mem=None):
         """ Performs Voxel Based Morphometry 
 
         :param folder_path: the path to the root directory. default=study_folder
@@ -2121,6 +2218,7 @@ class Elikopy:
         :param grp1: Define the first group of subjects.
         :param grp2: Define the second group of subjects.
         :param maskType: Define the mask type to use for the analysis. default=brain_mask_dilated
+        :param engine: Permutation engine, either "randomise" (FSL randomise) or "python" (in-process elikopy.stats.permutation_glm with the same outputs). default="randomise"
         :param metrics_dic: Dictionnary containing the diffusion metrics to register in a common space. For each diffusion metric, the metric name is the key and the metric's folder is the value. default={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'}
         :param slurm: Whether to use the Slurm Workload Manager or not (for computer clusters). default=value_during_init
         :param slurm_email: Email adress to send notification if a task fails. default=None
@@ -2151,8 +2249,8 @@ class Elikopy:
         f = open(folder_path + "/logs.txt", "a+")
         if slurm:
             job = {
-                "wrap": "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; python -c 'from elikopy.utils import vbm; vbm(\"" + str(
-                    folder_path) + "\",grp1=" + str(grp1) + ",grp2=" + str(grp2) + ",randomise_numberofpermutation=" + str(randomise_numberofpermutation) + ",maskType=\"" + str(maskType) + "\",core_count=" + str(core_count) + ",metrics_dic=" + str(
+                "wrap": thread_exports(core_count) + "python -c 'from elikopy.utils import vbm; vbm(\"" + str(
+                    folder_path) + "\",grp1=" + str(grp1) + ",grp2=" + str(grp2) + ",randomise_numberofpermutation=" + str(randomise_numberofpermutation) + ",maskType=\"" + str(maskType) + "\",core_count=" + str(core_count) + ",engine=\"" + str(engine) + "\",metrics_dic=" + str(
                     json.dumps(metrics_dic)) + ")'",
                 "job_name": "vbm",
                 "ntasks": 1,
@@ -2173,7 +2271,7 @@ class Elikopy:
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Successfully submited job %s using slurm\n" % p_job_id)
         else:
-            elikopy.utils.vbm(folder_path=folder_path, grp1=grp1, grp2=grp2, randomise_numberofpermutation=randomise_numberofpermutation, maskType=maskType, metrics_dic=metrics_dic, core_count=cpus)
+            elikopy.utils.vbm(folder_path=folder_path, grp1=grp1, grp2=grp2, randomise_numberofpermutation=randomise_numberofpermutation, maskType=maskType, metrics_dic=metrics_dic, core_count=core_count, engine=engine)
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Successfully applied vbm \n")
             f.flush()
@@ -2198,7 +2296,7 @@ class Elikopy:
         :param maskType: Define which mask to use during processing. default="brain_mask_dilated"
         """
         import numpy as np
-        from dipy.io.image import load_nifti, save_nifti
+        from elikopy.storage import load_nifti, save_nifti
         folder_path = self._folder_path if folder_path is None else folder_path
 
         f = open(folder_path + "/logs.txt", "a+")
@@ -2317,7 +2415,7 @@ class Elikopy:
 
             if slurm:
                 p_job = {
-                        "wrap": "export MKL_NUM_THREADS="+ str(core_count)+" ; export OMP_NUM_THREADS="+ str(core_count)+" ; python -c 'from elikopy.individual_subject_processing import clean_study_solo; clean_study_solo(\"" + folder_path + "/\",\"" + p + "\")'",
+                        "wrap": thread_exports(core_count) + "python -c 'from elikopy.individual_subject_processing import clean_study_solo; clean_study_solo(\"" + folder_path + "/\",\"" + p + "\")'",
                         "job_name": "CLEAN-STUDY_" + p,
                         "ntasks": 1,
                         "cpus_per_task": 1,
@@ -2420,8 +2518,7 @@ class Elikopy:
             
             if slurm:
                 job = {
-                    "wrap": "export OMP_NUM_THREADS=" + str(core_count) + " ; export PYTHONUNBUFFERED=" + str(True) + " ; export FSLPARALLEL=" + str(
-                        core_count) + " ; python -c '" + baseImportCmd + "; "+function_name+"(\"" + str(
+                    "wrap": thread_exports(core_count) + "export PYTHONUNBUFFERED=" + str(True) + " ; python -c '" + baseImportCmd + "; "+function_name+"(\"" + str(
                         folder_path) + "\",\"" + str(
                         patient_path) + "\"",
                     "job_name": "wrapper_elikopy_" + str(patient_path) + "_" + str(function_name),
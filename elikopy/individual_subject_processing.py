@@ -8,13 +8,24 @@ import math
 from scipy.ndimage.morphology import binary_dilation
 
 import subprocess
+from elikopy.resources import cpu_allowance, thread_exports
 from elikopy.utils import makedir
 
 import functools
 print = functools.partial(print, flush=True)
 
 
-def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoising=False, gibbs=False, topup=False, topupConfig=None, forceSynb0DisCo=False, useGPUsynb0DisCo=False, eddy=False, biasfield=False, biasfield_bsplineFitting=[100,3], biasfield_convergence=[1000,0.001], static_files_path=None, starting_state=None, bet_median_radius=2, bet_numpass=1, bet_dilate=2, cuda=False, cuda_name="eddy_cuda10.1", s2v=[0,5,1,'trilinear'], olrep=[False, 4, 250, 'sw'], eddy_additional_arg="", qc_reg=True, core_count=1, niter=5, report=True, slspec_gc_path=None):
+# State of the QC motion registration workers, inherited by the forked processes
+_qc_motion_state = {}
+
+
+def _qc_motion_volume(i):
+    state = _qc_motion_state
+    return state["affreg"].optimize(np.copy(state["static"]), np.copy(state["moving"][..., i]), state["transform"],
+                                    state["params0"], state["affine"], state["affine"], ret_metric=True)[1]
+
+
+def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoising=False, gibbs=False, topup=False, topupConfig=None, forceSynb0DisCo=False, useGPUsynb0DisCo=False, eddy=False, biasfield=False, biasfield_bsplineFitting=[100,3], biasfield_convergence=[1000,0.001], static_files_path=None, starting_state=None, bet_median_radius=2, bet_numpass=1, bet_dilate=2, bet_mode="all", cuda=False, cuda_name="eddy_cuda10.1", s2v=[0,5,1,'trilinear'], olrep=[False, 4, 250, 'sw'], eddy_additional_arg="", qc_reg=True, core_count=1, niter=5, report=True, slspec_gc_path=None):
     """ Performs data preprocessing on a single subject. By default only the brain extraction is enabled. Optional preprocessing steps include : reslicing,
     denoising, gibbs ringing correction, susceptibility field estimation, EC-induced distortions and motion correction, bias field correction.
     The results are stored in the preprocessing subfolder of the study subject <folder_path>/subjects/<subjects_ID>/dMRI/preproc.
@@ -38,6 +49,7 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
     :param bet_median_radius: Radius (in voxels) of the applied median filter during brain extraction. default=2
     :param bet_numpass: Number of pass of the median filter during brain extraction. default=1
     :param bet_dilate: Number of iterations for binary dilation during brain extraction. default=2
+    :param bet_mode: Either 'all' (median_otsu on the mean of every volume) or 'b0' (median_otsu on the mean b0 image only, computed once when the data is already loaded and reused by the mask unions with dwi2mask and mri_synth_strip). default='all'
     :param cuda: If true, eddy will run on cuda with the command name specified in cuda_name. default=False
     :param cuda_name: name of the eddy command to run when cuda==True. default="eddy_cuda10.1"
     :param s2v: list of parameters of Eddy for slice-to-volume motion correction (see Eddy FSL documentation): [mporder,s2v_niter,s2v_lambda,s2v_interp]. The slice-to-volume motion correction is performed if mporder>0, cuda is used and a slspec file is provided during the patient_list command. default=[0,5,1,'trilinear']
@@ -48,8 +60,10 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
     :param report: If False, no quality report will be generated. default=True
     :param core_count: Number of allocated cpu cores. default=1
     """
+    core_count = cpu_allowance(core_count)
 
     in_reslice = reslice
+    assert bet_mode in ("all", "b0"), "bet_mode must be either 'all' or 'b0'"
     assert starting_state in (None,"None", "denoising", "gibbs", "topup", "eddy", "biasfield", "report", "topup_synb0DisCo_Registration", "topup_synb0DisCo_Inference", "topup_synb0DisCo_Apply", "topup_synb0DisCo_topup"), 'invalid starting state!'
     if starting_state == "denoising":
         assert denoising == True, 'if starting_state is denoising, denoising must be True!'
@@ -103,7 +117,7 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
                 # print to std err
                 print("T1 Brain extraction failed for patient %s" % p, file=sys.stderr)
 
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, save_nifti
     from dipy.segment.mask import median_otsu
 
     nifti_path = folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + patient_path + '_raw_dmri.nii.gz'
@@ -136,8 +150,14 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
     if starting_state == None:
         from elikopy.utils import clean_mask
 
-        _, mask = median_otsu(curr_dmri, median_radius=bet_median_radius, numpass=bet_numpass, vol_idx=range(0, np.shape(curr_dmri)[3]), dilate=bet_dilate)
-        mask = clean_mask(mask)
+        if bet_mode == "b0":
+            from elikopy.utils import b0_median_otsu
+            from dipy.io import read_bvals_bvecs
+            raw_bvals, _ = read_bvals_bvecs(folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + patient_path + "_raw_dmri.bval", None)
+            mask, _ = b0_median_otsu(curr_dmri, raw_bvals, median_radius=bet_median_radius, numpass=bet_numpass, dilate=bet_dilate, b0_threshold=max(50, np.min(raw_bvals) + 10))
+        else:
+            _, mask = median_otsu(curr_dmri, median_radius=bet_median_radius, numpass=bet_numpass, vol_idx=range(0, np.shape(curr_dmri)[3]), dilate=bet_dilate)
+            mask = clean_mask(mask)
 
         save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/preproc/bet/' + patient_path + '_binary_mask.nii.gz',mask.astype(np.float32), affine)
 
@@ -263,35 +283,15 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
         with open(folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + 'acqparams.txt') as f:
             topup_acq = [[float(x) for x in line2.split()] for line2 in f]
 
-        #Find all the bo to extract.
-        current_index = 0
-        all_index ={}
-        i=1
-        roi=[]
-        for ind in topup_index:
-            if ind!=current_index and ind not in all_index:
-                roi.append(i)
-                fslroi = "fslroi " + imain_tot + " " + topup_path + "/b0_"+str(i)+".nii.gz "+str(i-1)+" 1"
-                process = subprocess.Popen(fslroi, universal_newlines=True, shell=True, stdout=topup_log,
-                                           stderr=subprocess.STDOUT)
-                output, error = process.communicate()
-                print("B0 of index" + str(i) + " extracted!")
-            current_index=ind
-            all_index[ind] = all_index.get(ind,0) + 1
-            i=i+1
-
-        #Merge b0
-        if len(roi) == 1:
-            shutil.copyfile(topup_path + "/b0_"+str(roi[0])+".nii.gz", topup_path + "/b0.nii.gz")
-        else:
-            roi_to_merge=""
-            for r in roi:
-                roi_to_merge = roi_to_merge + " " + topup_path +"/b0_" + str(r) + ".nii.gz"
-            print("The following roi will be merged: " + roi_to_merge)
-            cmd = "fslmerge -t " + topup_path + "/b0.nii.gz" + roi_to_merge
-            process = subprocess.Popen(cmd, universal_newlines=True, shell=True, stdout=topup_log,
-                                       stderr=subprocess.STDOUT)
-            output, error = process.communicate()
+        #Extract and merge the b0 of each acquisition in a single pass over the data
+        from elikopy.utils import extract_topup_b0
+        roi = extract_topup_b0(imain_tot, folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + patient_path + "_raw_dmri.bval",
+                               folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + 'index.txt',
+                               folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + 'acqparams.txt',
+                               topup_path + "/b0.nii.gz", topup_path + "/acqparams.txt")
+        print("The following b0 were merged: " + str(roi))
+        topup_log.write("B0 volumes " + str(roi) + " merged in " + topup_path + "/b0.nii.gz\n")
+        topup_log.flush()
 
         #Check if multiple or single encoding direction
         curr_x=0.0
@@ -314,7 +314,7 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Patient %s \n" % p + " has multiple direction of gradient encoding, launching topup directly ")
             topupConfig = 'b02b0.cnf' if topupConfig is None else topupConfig
-            bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; topup --imain="' + topup_path + '/b0.nii.gz" --config="' + topupConfig + '" --datain="' + folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + 'acqparams.txt" --out="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_estimate" --fout="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_fout_estimate" --iout="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_iout_estimate" --verbose'
+            bashCommand = thread_exports(core_count) + 'topup --imain="' + topup_path + '/b0.nii.gz" --config="' + topupConfig + '" --datain="' + topup_path + '/acqparams.txt" --out="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_estimate" --fout="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_fout_estimate" --iout="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_iout_estimate" --verbose'
             bashcmd = bashCommand.split()
             print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Topup launched for patient %s \n" % p + " with bash command " + bashCommand)
@@ -357,8 +357,6 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
 
             shutil.copyfile(topup_path + "/b0.nii.gz",topup_path + "/synb0-DisCo/b0.nii.gz")
 
-            process = subprocess.Popen(fslroi, universal_newlines=True, shell=True, stdout=topup_log,stderr=subprocess.STDOUT)
-            output, error = process.communicate()
             synb0DisCo_starting_step = None
             if starting_state=="topup_synb0DisCo_Registration":
                 synb0DisCo_starting_step = "Registration"
@@ -368,9 +366,9 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
                 synb0DisCo_starting_step = "Apply"
             elif starting_state =="topup_synb0DisCo_topup":
                 synb0DisCo_starting_step = "topup"
-            synb0DisCo(folder_path,topup_path,patient_path,starting_step=synb0DisCo_starting_step,topup=True,gpu=useGPUsynb0DisCo, static_files_path=static_files_path)
+            synb0DisCo(folder_path,topup_path,patient_path,starting_step=synb0DisCo_starting_step,topup=True,gpu=useGPUsynb0DisCo, static_files_path=static_files_path, core_count=core_count)
 
-            bashCommand2 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; applytopup --imain="' + imain_tot + '" --inindex=1 --datain="' + folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + 'acqparams.txt" --topup="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_estimate" --method=jac --interp=spline --out="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_corr"'
+            bashCommand2 = thread_exports(core_count) + 'applytopup --imain="' + imain_tot + '" --inindex=1 --datain="' + folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + 'acqparams.txt" --topup="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_estimate" --method=jac --interp=spline --out="' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_corr"'
 
             process2 = subprocess.Popen(bashCommand2, universal_newlines=True, shell=True, stdout=topup_log,
                                         stderr=subprocess.STDOUT)
@@ -398,52 +396,53 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
         topup_corr_b0_ref = topup_corr[..., 0]
         dwiref_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_topup_corr_dwiref.nii.gz'
         save_nifti(dwiref_path, topup_corr_b0_ref.astype(np.float32), affine)
+        topup_otsu_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_type-otsu_dilate-2_brainmask.nii.gz'
+        if bet_mode == "b0":
+            from elikopy.utils import b0_median_otsu
+            from dipy.io import read_bvals_bvecs
+            raw_bvals, _ = read_bvals_bvecs(folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + patient_path + "_raw_dmri.bval", None)
+            mask, _ = b0_median_otsu(topup_corr, raw_bvals, median_radius=2, numpass=1, dilate=2, b0_threshold=max(50, np.min(raw_bvals) + 10))
+            save_nifti(topup_otsu_path, mask.astype(np.float32), affine)
+            mask = None
         topup_corr_b0_ref = None
         topup_corr = None
         gc.collect()
 
 
-        # Step 1 : dwi2mask
+        # Step 1 and 2 : dwi2mask and mri_synth_strip on dwiref, run concurrently
+        from elikopy.utils import run_command_graph
         bvec_path = folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + patient_path + '_raw_dmri.bvec'
         bval_path = folder_path + '/subjects/' + patient_path + '/dMRI/raw/' + patient_path + '_raw_dmri.bval'
         dwi2mask_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_space-dwi_type-dwi2mask_brainmask.nii.gz'
-        cmd = f"dwi2mask -fslgrad {bvec_path} {bval_path} {topup_corr_path} {dwi2mask_path} -force "
-        import subprocess
-        print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-            "%d.%b %Y %H:%M:%S") + ": dwi2mask launched for patient %s \n" % p + " with bash command " + cmd)
-        f = open(folder_path + '/subjects/' + patient_path + "/dMRI/preproc/preproc_logs.txt", "a+")
-        f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-            "%d.%b %Y %H:%M:%S") + ": dwi2mask launched for patient %s \n" % p + " with bash command " + cmd)
-        f.flush()
-        process = subprocess.Popen(cmd, universal_newlines=True, shell=True, stdout=f, stderr=subprocess.STDOUT)
-        # wait until dwi2mask finish
-        output, error = process.communicate()
-        f.flush()
-        f.close()
-
-        gc.collect()
-        # Step 2 : mri_synth_strip on dwiref
         mrisynthstrip_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_space-dwi_type-mrisynthstrip_brainmask.nii.gz'
-        cmd = f"mri_synth_strip -i {dwiref_path} -m {mrisynthstrip_path}"
-        print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-            "%d.%b %Y %H:%M:%S") + ": mri_synth_strip launched for patient %s \n" % p + " with bash command " + cmd)
+        dwi2mask_threads = max(1, core_count // 2)
+        synthstrip_threads = max(1, core_count - dwi2mask_threads)
+        mask_commands = {
+            "dwi2mask": (f"dwi2mask -fslgrad {bvec_path} {bval_path} {topup_corr_path} {dwi2mask_path} -force -nthreads {dwi2mask_threads}", (), dwi2mask_threads),
+            "mri_synth_strip": (f"mri_synth_strip -i {dwiref_path} -m {mrisynthstrip_path} -t {synthstrip_threads}", (), synthstrip_threads),
+        }
         f = open(folder_path + '/subjects/' + patient_path + "/dMRI/preproc/preproc_logs.txt", "a+")
-        f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-            "%d.%b %Y %H:%M:%S") + ": mri_synth_strip launched for patient %s \n" % p + " with bash command " + cmd)
-        f.flush()
-        process = subprocess.Popen(cmd, universal_newlines=True, shell=True, stdout=f, stderr=subprocess.STDOUT)
-        output, error = process.communicate()
+        for name, (cmd, _, _) in mask_commands.items():
+            print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+                "%d.%b %Y %H:%M:%S") + ": " + name + " launched for patient %s \n" % p + " with bash command " + cmd)
+            f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+                "%d.%b %Y %H:%M:%S") + ": " + name + " launched for patient %s \n" % p + " with bash command " + cmd)
         f.flush()
+        run_command_graph(mask_commands, core_count=core_count, log_dir=topup_path)
+        f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+            "%d.%b %Y %H:%M:%S") + ": dwi2mask and mri_synth_strip finished for patient %s \n" % p)
         f.close()
+        gc.collect()
 
         # Step 3 : median otsu on preprocess data
-        topup_corr, affine = load_nifti(topup_corr_path)
-        _, mask = median_otsu(topup_corr, median_radius=2, numpass=1, vol_idx=range(0, np.shape(topup_corr)[3]),
-                                           dilate=2)
-        mask = clean_mask(mask)
-        save_nifti(
-            folder_path + '/subjects/' + patient_path + '/dMRI/preproc/topup/' + patient_path + '_type-otsu_dilate-2_brainmask.nii.gz',
-            mask.astype(np.float32), affine)
+        if bet_mode == "b0":
+            mask, affine = load_nifti(topup_otsu_path)
+        else:
+            topup_corr, affine = load_nifti(topup_corr_path)
+            _, mask = median_otsu(topup_corr, median_radius=2, numpass=1, vol_idx=range(0, np.shape(topup_corr)[3]),
+                                               dilate=2)
+            mask = clean_mask(mask)
+            save_nifti(topup_otsu_path, mask.astype(np.float32), affine)
 
         # Step 4: Apply all masks to preprocess data
         dwi2mask_mask, _ = load_nifti(dwi2mask_path)
@@ -480,9 +479,9 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
         makedir(eddy_path, folder_path + '/subjects/' + patient_path + "/dMRI/preproc/preproc_logs.txt", log_prefix)
 
         if cuda:
-            eddycmd = "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; " + cuda_name
+            eddycmd = thread_exports(core_count) + cuda_name
         else:
-            eddycmd = "export OMP_NUM_THREADS="+str(core_count)+" ; export FSLPARALLEL="+str(core_count)+" ; eddy"
+            eddycmd = thread_exports(core_count) + "eddy"
 
         fwhm = '10'
         for _ in range(niter-1):
@@ -576,7 +575,7 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
         else:
             inputImage = nifti_path
 
-        bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; dwibiascorrect ants {} {} -fslgrad {} {} -bias {} -scratch {} -force -info -nthreads {}'.format(
+        bashCommand = thread_exports(core_count) + 'dwibiascorrect ants {} {} -fslgrad {} {} -bias {} -scratch {} -force -info -nthreads {}'.format(
             inputImage, folder_path + '/subjects/' + patient_path + '/dMRI/preproc/biasfield/' + patient_path + "_biasfield_corr.nii.gz",
             folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bvec",
             folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bval",
@@ -631,6 +630,13 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
     preproc, affine = load_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc_nomask.nii.gz')
     b0_ref = preproc[..., 0]
     save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dwiref.nii.gz', b0_ref.astype(np.float32), affine)
+    otsu_path = folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + '_type-otsu_dilate-2_brainmask.nii.gz'
+    if bet_mode == "b0":
+        from elikopy.utils import b0_median_otsu
+        from dipy.io import read_bvals_bvecs
+        preproc_bvals, _ = read_bvals_bvecs(folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bval", None)
+        mask, _ = b0_median_otsu(preproc, preproc_bvals, median_radius=2, numpass=1, dilate=2, b0_threshold=max(50, np.min(preproc_bvals) + 10))
+        save_nifti(otsu_path, mask.astype(np.float32), affine)
 
     preproc = None
     b0_ref = None
@@ -638,47 +644,41 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
     #### Generate final mask ####
     from elikopy.utils import clean_mask
 
-    # Step 1 : dwi2mask
+    # Step 1 and 2 : dwi2mask and mri_synth_strip on dwiref, run concurrently
+    from elikopy.utils import run_command_graph
     preproc_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc_nomask.nii.gz'
     bvec_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc.bvec'
     bval_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc.bval'
     dwi2mask_path = folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + '_space-dwi_type-dwi2mask_brainmask.nii.gz'
-    cmd = f"dwi2mask -fslgrad {bvec_path} {bval_path} {preproc_path} {dwi2mask_path} -force"
-    import subprocess
-    print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-        "%d.%b %Y %H:%M:%S") + ": dwi2mask launched for patient %s \n" % p + " with bash command " + cmd)
-    f = open(folder_path + '/subjects/' + patient_path + "/dMRI/preproc/preproc_logs.txt", "a+")
-    f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-        "%d.%b %Y %H:%M:%S") + ": dwi2mask launched for patient %s \n" % p + " with bash command " + cmd)
-    f.flush()
-    process = subprocess.Popen(cmd, universal_newlines=True, shell=True, stdout=f, stderr=subprocess.STDOUT)
-    # wait until dwi2mask finish
-    output, error = process.communicate()
-    f.flush()
-    f.close()
-
-    # Step 2 : mri_synth_strip on dwiref
     dwiref_path = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dwiref.nii.gz'
     mrisynthstrip_path = folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + '_space-dwi_type-mrisynthstrip_brainmask.nii.gz'
-    cmd = f"mri_synth_strip -i {dwiref_path} -m {mrisynthstrip_path}"
-    print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-        "%d.%b %Y %H:%M:%S") + ": mri_synth_strip launched for patient %s \n" % p + " with bash command " + cmd)
+    dwi2mask_threads = max(1, core_count // 2)
+    synthstrip_threads = max(1, core_count - dwi2mask_threads)
+    mask_commands = {
+        "dwi2mask": (f"dwi2mask -fslgrad {bvec_path} {bval_path} {preproc_path} {dwi2mask_path} -force -nthreads {dwi2mask_threads}", (), dwi2mask_threads),
+        "mri_synth_strip": (f"mri_synth_strip -i {dwiref_path} -m {mrisynthstrip_path} -t {synthstrip_threads}", (), synthstrip_threads),
+    }
     f = open(folder_path + '/subjects/' + patient_path + "/dMRI/preproc/preproc_logs.txt", "a+")
-    f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
-        "%d.%b %Y %H:%M:%S") + ": mri_synth_strip launched for patient %s \n" % p + " with bash command " + cmd)
-    f.flush()
-    process = subprocess.Popen(cmd, universal_newlines=True, shell=True, stdout=f, stderr=subprocess.STDOUT)
-    output, error = process.communicate()
+    for name, (cmd, _, _) in mask_commands.items():
+        print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+            "%d.%b %Y %H:%M:%S") + ": " + name + " launched for patient %s \n" % p + " with bash command " + cmd)
+        f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+            "%d.%b %Y %H:%M:%S") + ": " + name + " launched for patient %s \n" % p + " with bash command " + cmd)
     f.flush()
+    run_command_graph(mask_commands, core_count=core_count, log_dir=folder_path + '/subjects/' + patient_path + '/masks')
+    f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+        "%d.%b %Y %H:%M:%S") + ": dwi2mask and mri_synth_strip finished for patient %s \n" % p)
     f.close()
 
     # Step 3 : median otsu on preprocess data
     preproc, affine = load_nifti(
         folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc_nomask.nii.gz')
-    preproc_masked, mask = median_otsu(preproc, median_radius=2, numpass=1, vol_idx=range(0, np.shape(preproc)[3]), dilate=2)
-    mask = clean_mask(mask)
-    save_nifti(folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + '_type-otsu_dilate-2_brainmask.nii.gz',
-               mask.astype(np.float32), affine)
+    if bet_mode == "b0":
+        mask, _ = load_nifti(otsu_path)
+    else:
+        preproc_masked, mask = median_otsu(preproc, median_radius=2, numpass=1, vol_idx=range(0, np.shape(preproc)[3]), dilate=2)
+        mask = clean_mask(mask)
+        save_nifti(otsu_path, mask.astype(np.float32), affine)
 
     # Step 4: Apply all masks to preprocess data
     dwi2mask_mask, _ = load_nifti(dwi2mask_path)
@@ -716,7 +716,7 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
     # ==================================================================================================================
 
     """Imports"""
-    from dipy.io.image import load_nifti, load_nifti_data
+    from elikopy.storage import load_nifti, load_nifti_data
     from dipy.io import read_bvals_bvecs
     from dipy.core.gradients import gradient_table
     import matplotlib
@@ -1291,16 +1291,16 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
             f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": Starting Eddy QC_REG for patient %s with multicore enabled \n" % p)
             f.close()
-            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            from elikopy.resources import process_pool
             for i in range(np.shape(preproc_data)[3]):
                 #print('current iteration : ', i, end="\r")
                 volume.append(i)
 
-            def motion_raw_transform(i):
-                return affreg.optimize(np.copy(S0s_raw[..., 0]), np.copy(bet_data[..., i]), transform, params0, bet_affine,
-                                        bet_affine, ret_metric=True)[1]
-            with ProcessPoolExecutor(max_workers=int(core_count*0.8)) as executor:
-                for r in executor.map(motion_raw_transform, range(np.shape(preproc_data)[3])):
+            _qc_motion_state.update(affreg=affreg, transform=transform, params0=params0, static=S0s_raw[..., 0],
+                                    moving=bet_data, affine=bet_affine)
+            with process_pool(int(core_count*0.8), mp_context=multiprocessing.get_context("fork")) as executor:
+                for r in executor.map(_qc_motion_volume, range(np.shape(preproc_data)[3])):
                     motion_raw.append(r)
 
             print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
@@ -1310,12 +1310,11 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
                 "%d.%b %Y %H:%M:%S") + ": End of QC_REG motion_raw for patient %s \n" % p)
             f.close()
 
-            def motion_preproc_transform(i):
-                return affreg.optimize(np.copy(S0s_preproc[..., 0]), np.copy(preproc_data[..., i]), transform, params0,
-                                        preproc_affine, preproc_affine, ret_metric=True)[1]
-            with ProcessPoolExecutor(max_workers=int(core_count*0.8)) as executor:
-                for r in executor.map(motion_preproc_transform, range(np.shape(preproc_data)[3])):
+            _qc_motion_state.update(static=S0s_preproc[..., 0], moving=preproc_data, affine=preproc_affine)
+            with process_pool(int(core_count*0.8), mp_context=multiprocessing.get_context("fork")) as executor:
+                for r in executor.map(_qc_motion_volume, range(np.shape(preproc_data)[3])):
                     motion_proc.append(r)
+            _qc_motion_state.clear()
 
             print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                 "%d.%b %Y %H:%M:%S") + ": End of QC_REG motion_preproc for patient %s" % p)
@@ -1485,7 +1484,7 @@ def preproc_solo(folder_path, p, reslice=False, reslice_addSlice=False, denoisin
 
 
 def dti_solo(folder_path, p, maskType="brain_mask_dilated",
-             use_all_shells: bool = False, report=True):
+             use_all_shells: bool = False, report=True, fit_method="WLS", core_count=1):
     """
     Computes the DTI metrics for a single subject. The outputs are available in
     the directories <folder_path>/subjects/<subjects_ID>/dMRI/dti/.
@@ -1497,15 +1496,16 @@ def dti_solo(folder_path, p, maskType="brain_mask_dilated",
     :param use_all_shells: Boolean. DTI will use all shells available, not just
     shells <= 2000, this will cause a more defined white matter at the cost of
     an erronous estimation of the CSF. The default is False.
+    :param fit_method: Tensor fitting method, either "WLS" or "NLLS". default="WLS"
+    :param core_count: Number of threads used to fit the tensors. default=1
     """
+    core_count = cpu_allowance(core_count)
     log_prefix = "DTI SOLO"
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual DTI processing for patient %s \n" % p)
 
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, AsyncNiftiWriter
     from dipy.io.gradients import read_bvals_bvecs
-    from dipy.core.gradients import gradient_table
-    import dipy.reconst.dti as dti
 
     assert maskType in ["brain_mask_dilated","brain_mask", "wm_mask_MSMT", "wm_mask_AP", "wm_mask_FSL_T1",
                     "wm_mask_Freesurfer_T1"], "The mask parameter must be one of the following : brain_mask_dilated, brain_mask, wm_mask_MSMT, wm_mask_AP, wm_mask_FSL_T1, wm_mask_Freesurfer_T1"
@@ -1538,48 +1538,44 @@ def dti_solo(folder_path, p, maskType="brain_mask_dilated",
         data = data[..., indexes]
         print('Warning: removing shells above b=2000 for DTI. To disable this, '
               + 'activate the use_all_shells option.')
-    # create the model===================================
+    # fit the model on the masked voxels================
+    from elikopy.microstructure import fit_dti
     b0_threshold = np.min(bvals)+10
     b0_threshold = max(50, b0_threshold)
-    gtab = gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
-    tenmodel = dti.TensorModel(gtab)
-    tenfit = tenmodel.fit(data, mask=mask)
+    tenfit = fit_dti(data, bvals, bvecs, mask=mask, b0_threshold=b0_threshold, fit_method=fit_method,
+                     core_count=core_count)
+    # the outputs are written in the background while the quality control is computed
+    writer = AsyncNiftiWriter(max_workers=core_count)
     # FA ================================================
-    FA = dti.fractional_anisotropy(tenfit.evals)
-    FA[np.isnan(FA)] = 0
-    FA = np.clip(FA, 0, 1)
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_FA.nii.gz",
-               FA.astype(np.float32), affine)
+    FA = tenfit["FA"]
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_FA.nii.gz",
+                      FA, affine, mask=mask)
     # colored FA ========================================
-    RGB = dti.color_fa(FA, tenfit.evecs)
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_fargb.nii.gz",
-               np.array(255 * RGB, 'uint8'), affine)
+    RGB = tenfit["fargb"]
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_fargb.nii.gz",
+                      np.array(255 * RGB, 'uint8'), affine, mask=mask)
     # Mean diffusivity ==================================
-    MD = dti.mean_diffusivity(tenfit.evals)
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_MD.nii.gz",
-               MD.astype(np.float32), affine)
+    MD = tenfit["MD"]
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_MD.nii.gz",
+                      MD, affine, mask=mask)
     # Radial diffusivity ==================================
-    RD = dti.radial_diffusivity(tenfit.evals)
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_RD.nii.gz",
-               RD.astype(np.float32), affine)
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_RD.nii.gz",
+                      tenfit["RD"], affine, mask=mask)
     # Axial diffusivity ==================================
-    AD = dti.axial_diffusivity(tenfit.evals)
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_AD.nii.gz",
-               AD.astype(np.float32), affine)
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_AD.nii.gz",
+                      tenfit["AD"], affine, mask=mask)
     # eigen vectors =====================================
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_evecs.nii.gz",
-               tenfit.evecs.astype(np.float32), affine)
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_evecs.nii.gz",
+                      tenfit["evecs"], affine, mask=mask)
     # eigen values ======================================
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_evals.nii.gz",
-               tenfit.evals.astype(np.float32), affine)
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_evals.nii.gz",
+                      tenfit["evals"], affine, mask=mask)
     # diffusion tensor ====================================
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_dtensor.nii.gz",
-               tenfit.quadratic_form.astype(np.float32), affine)
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_dtensor.nii.gz",
+                      tenfit["dtensor"], affine, mask=mask)
     # Residual ============================================
-    reconstructed = tenfit.predict(gtab, S0=data[...,0])
-    residual = data - reconstructed
-    save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_residual.nii.gz",
-               residual.astype(np.float32), affine)
+    writer.save_nifti(folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/dti/' + patient_path + "_residual.nii.gz",
+                      tenfit["residual"], affine, mask=mask)
 
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Starting QC %s \n" % p)
@@ -1600,13 +1596,8 @@ def dti_solo(folder_path, p, maskType="brain_mask_dilated",
         qc_path = folder_path + '/subjects/' + patient_path + "/dMRI/microstructure/dti/quality_control"
         makedir(qc_path, folder_path + '/subjects/' + patient_path + "/dMRI/microstructure/dti/dti_logs.txt", log_prefix)
 
-        mse = np.mean(residual ** 2, axis=-1)
-        R2 = np.zeros_like(mse)
-        (itot, jtot, ktot) = np.shape(R2)
-        for i in range(itot):
-            for j in range(jtot):
-                for k in range(ktot):
-                    R2[i, j, k] = np.corrcoef(data[i, j, k, :], reconstructed[i, j, k, :])[0, 1] ** 2
+        mse = tenfit["MSE"]
+        R2 = tenfit["R2"]
 
         fig, axs = plt.subplots(2, 1, figsize=(2, 1))
         fig.suptitle('Elikopy : Quality control report - DTI', fontsize=50)
@@ -1714,6 +1705,8 @@ def dti_solo(folder_path, p, maskType="brain_mask_dilated",
         pdf.print_page(elem)
         pdf.output(qc_path + '/qc_report.pdf', 'F');
 
+        # the outputs must be written before the step is reported as completed
+        writer.flush()
         if not os.path.exists(folder_path + '/subjects/' + patient_path + '/quality_control.pdf'):
             shutil.copyfile(qc_path + '/qc_report.pdf', folder_path + '/subjects/' + patient_path + '/quality_control.pdf')
         else:
@@ -1735,8 +1728,10 @@ def dti_solo(folder_path, p, maskType="brain_mask_dilated",
                 "%d.%b %Y %H:%M:%S") + ": Successfully processed patient %s \n" % p)
             f.close()
 
+    writer.close()
+
 
-def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, debug=False):
+def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, debug=False, registration_preset="accurate"):
     """ Computes a white matter mask for a single subject based on the T1 structural image or on the anisotropic power map
     (obtained from the diffusion images) if the T1 image is not available. The outputs are available in the directories <folder_path>/subjects/<subjects_ID>/masks/.
     The T1 images can be gibbs ringing corrected.
@@ -1747,7 +1742,9 @@ def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, deb
     :param corr_gibbs: If true, Gibbs ringing correction is performed on the T1 image. default=True
     :param core_count: Number of allocated cpu cores. default=1
     :param debug: If true, additional intermediate output will be saved. default=False
+    :param registration_preset: Speed against accuracy trade-off of the T1 to diffusion registration, one of 'fast', 'balanced' or 'accurate'. default='accurate'
     """
+    core_count = cpu_allowance(core_count)
 
     assert maskType in ['wm_mask_FSL_T1', 'wm_mask_AP'], "maskType must be either 'wm_mask_FSL_T1' or 'wm_mask_AP'"
 
@@ -1755,15 +1752,14 @@ def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, deb
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual white mask processing for patient %s \n" % p)
 
-    from dipy.align.imaffine import (AffineMap, MutualInformationMetric, AffineRegistration)
+    from dipy.align.imaffine import AffineMap
     from dipy.align.transforms import (TranslationTransform3D, RigidTransform3D, AffineTransform3D)
-    from dipy.segment.tissue import TissueClassifierHMRF
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.registration import affine_registration, mapping_exists, load_mapping, save_mapping
+    from elikopy.segmentation import hmrf_segmentation
+    from elikopy.storage import load_nifti, save_nifti
     import subprocess
     from dipy.denoise.gibbs import gibbs_removal
-    from dipy.data import get_sphere
-    import dipy.reconst.shm as shm
-    import dipy.direction.peaks as dp
+    from elikopy.odf import anisotropic_power_map
     from dipy.io.gradients import read_bvals_bvecs
     from dipy.core.gradients import gradient_table
 
@@ -1831,40 +1827,44 @@ def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, deb
         moving_data, moving_affine = load_nifti(brain_extracted_T1_path)
         moving = moving_data
         moving_grid2world = moving_affine
-        # Read the static image ====================================
-        static_data, static_affine = load_nifti(
-            folder_path + "/subjects/" + patient_path + "/dMRI/preproc/" + patient_path + "_dmri_preproc.nii.gz")
-
-        static = np.squeeze(static_data)[..., 0]
-        static_grid2world = static_affine
-        # Reslice the moving image ====================================
-        identity = np.eye(4)
-        affine_map = AffineMap(identity, static.shape, static_grid2world, moving.shape, moving_grid2world)
-        # translation the moving image ====================================
-        nbins = 32
-        sampling_prop = None
-        metric = MutualInformationMetric(nbins, sampling_prop)
-        level_iters = [10000, 1000, 100]
-        sigmas = [3.0, 1.0, 0.0]
-        factors = [4, 2, 1]
-        affreg = AffineRegistration(metric=metric, level_iters=level_iters, sigmas=sigmas, factors=factors)
-        transform = TranslationTransform3D()
-        params0 = None
-        starting_affine = affine_map.affine
-        translation = affreg.optimize(static, moving, transform, params0, static_grid2world, moving_grid2world,
-                                      starting_affine=starting_affine)
-        # Rigid transform the moving image ====================================
-        transform = RigidTransform3D()
-        params0 = None
-        starting_affine = translation.affine
-        rigid = affreg.optimize(static, moving, transform, params0, static_grid2world, moving_grid2world,
-                                starting_affine=starting_affine)
-        # affine transform the moving image ====================================
-        transform = AffineTransform3D()
-        params0 = None
-        starting_affine = rigid.affine
-        affine = affreg.optimize(static, moving, transform, params0, static_grid2world, moving_grid2world,
-                                 starting_affine=starting_affine)
+        # The T1 to DWI transform is kept in the mapping store, where the registration to the common space reuses it.
+        # It is recomputed when the T1 or the preprocessed DWI changed since it was saved.
+        reg_path = folder_path + '/subjects/' + patient_path + '/reg/'
+        dwi_path = folder_path + "/subjects/" + patient_path + "/dMRI/preproc/" + patient_path + "_dmri_preproc.nii.gz"
+        if mapping_exists(reg_path + 'mapping_T1_to_DWI', sources=[brain_extracted_T1_path, dwi_path]):
+            affine = load_mapping(reg_path + 'mapping_T1_to_DWI')
+            static_grid2world = affine.domain_grid2world
+        else:
+            # Read the static image ====================================
+            static_data, static_affine = load_nifti(dwi_path)
+
+            static = np.squeeze(static_data)[..., 0]
+            static_grid2world = static_affine
+            # Reslice the moving image ====================================
+            identity = np.eye(4)
+            affine_map = AffineMap(identity, domain_grid_shape=static.shape, domain_grid2world=static_grid2world,
+                                   codomain_grid_shape=moving.shape, codomain_grid2world=moving_grid2world)
+            # translation the moving image ====================================
+            affreg = affine_registration(registration_preset)
+            transform = TranslationTransform3D()
+            params0 = None
+            starting_affine = affine_map.affine
+            translation = affreg.optimize(static, moving, transform, params0, static_grid2world, moving_grid2world,
+                                          starting_affine=starting_affine)
+            # Rigid transform the moving image ====================================
+            transform = RigidTransform3D()
+            params0 = None
+            starting_affine = translation.affine
+            rigid = affreg.optimize(static, moving, transform, params0, static_grid2world, moving_grid2world,
+                                    starting_affine=starting_affine)
+            # affine transform the moving image ====================================
+            transform = AffineTransform3D()
+            params0 = None
+            starting_affine = rigid.affine
+            affine = affreg.optimize(static, moving, transform, params0, static_grid2world, moving_grid2world,
+                                     starting_affine=starting_affine)
+            os.makedirs(reg_path, exist_ok=True)
+            save_mapping(affine, reg_path + 'mapping_T1_to_DWI', sources=[brain_extracted_T1_path, dwi_path])
 
         """"
         transformed = affine.transform(moving)
@@ -1883,8 +1883,7 @@ def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, deb
         anat = moving
         nclass = 3
         beta = 0.1
-        hmrf = TissueClassifierHMRF()
-        initial_segmentation, final_segmentation, PVE = hmrf.classify(anat, nclass, beta)
+        initial_segmentation, final_segmentation, PVE = hmrf_segmentation(anat, nclass, beta, core_count=core_count)
         # save the white matter mask ============================================
         white_mask = PVE[..., 2]
 
@@ -1942,22 +1941,11 @@ def white_mask_solo(folder_path, p, maskType, corr_gibbs=True, core_count=1, deb
         b0_threshold = np.min(bvals) + 10
         b0_threshold = max(50, b0_threshold)
         gtab = gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
-        sphere = get_sphere('symmetric724')
-        qball_model = shm.QballModel(gtab, 8)
-        if core_count > 1:
-            peaks = dp.peaks_from_model(model=qball_model, data=data, relative_peak_threshold=.5, min_separation_angle=25,
-                                    sphere=sphere, mask=mask, parallel=True, num_processes=core_count)
-        else:
-            peaks = dp.peaks_from_model(model=qball_model, data=data, relative_peak_threshold=.5,
-                                        min_separation_angle=25,
-                                        sphere=sphere, mask=mask, parallel=False)
-
-        ap = shm.anisotropic_power(peaks.shm_coeff)
+        ap = anisotropic_power_map(data, gtab, mask=mask, sh_order=8)
         save_nifti(folder_path + '/subjects/' + patient_path + "/masks/" + patient_path + '_ap.nii.gz', ap.astype(np.float32), affine)
         nclass = 3
         beta = 0.1
-        hmrf = TissueClassifierHMRF()
-        initial_segmentation, final_segmentation, PVE = hmrf.classify(ap, nclass, beta)
+        initial_segmentation, final_segmentation, PVE = hmrf_segmentation(ap, nclass, beta, core_count=core_count)
         white_mask = PVE[..., 2]
         white_mask[white_mask >= 0.01] = 1
         white_mask[white_mask < 0.01] = 0
@@ -2167,11 +2155,12 @@ def noddi_solo(folder_path, p, maskType="brain_mask_dilated", lambda_iso_diff=3.
     :param use_amico: If true, use the amico optimizer. default=FALSE
     :param core_count: Number of allocated cpu cores. default=1
     """
+    core_count = cpu_allowance(core_count)
     print("[NODDI SOLO] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual NODDI processing for patient %s \n" % p)
 
     import numpy as np
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, AsyncNiftiWriter
     from dipy.io.gradients import read_bvals_bvecs
 
     assert maskType in ["brain_mask_dilated", "brain_mask", "wm_mask_MSMT", "wm_mask_AP", "wm_mask_FSL_T1",
@@ -2250,16 +2239,18 @@ def noddi_solo(folder_path, p, maskType="brain_mask_dilated", lambda_iso_diff=3.
     mse = NODDI_fit.mean_squared_error(data)
     R2 = NODDI_fit.R2_coefficient_of_determination(data)
 
+    # the outputs are written in the background while the quality control is computed
+    writer = AsyncNiftiWriter(max_workers=core_count)
     # save the nifti
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_mu.nii.gz', mu.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_odi.nii.gz', odi.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_fiso.nii.gz', f_iso.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_fbundle.nii.gz', f_bundle.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_fintra.nii.gz', f_intra.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_icvf.nii.gz', f_icvf.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_fextra.nii.gz', f_extra.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_mse.nii.gz', mse.astype(np.float32), affine)
-    save_nifti(noddi_path + '/' + patient_path + '_noddi_R2.nii.gz', R2.astype(np.float32), affine)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_mu.nii.gz', mu.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_odi.nii.gz', odi.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_fiso.nii.gz', f_iso.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_fbundle.nii.gz', f_bundle.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_fintra.nii.gz', f_intra.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_icvf.nii.gz', f_icvf.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_fextra.nii.gz', f_extra.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_mse.nii.gz', mse.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(noddi_path + '/' + patient_path + '_noddi_R2.nii.gz', R2.astype(np.float32), affine, mask=mask)
 
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Starting quality control %s \n" % p)
@@ -2382,6 +2373,8 @@ def noddi_solo(folder_path, p, maskType="brain_mask_dilated", lambda_iso_diff=3.
     pdf.print_page(elem)
     pdf.output(qc_path + '/qc_report.pdf', 'F');
 
+    # the outputs must be written before the step is reported as completed
+    writer.flush()
     if not os.path.exists(folder_path + '/subjects/' + patient_path + '/quality_control.pdf'):
         shutil.copyfile(qc_path + '/qc_report.pdf', folder_path + '/subjects/' + patient_path + '/quality_control.pdf')
     else:
@@ -2403,6 +2396,8 @@ def noddi_solo(folder_path, p, maskType="brain_mask_dilated", lambda_iso_diff=3.
             "%d.%b %Y %H:%M:%S") + ": Successfully processed patient %s \n" % p)
         f.close()
 
+    writer.close()
+
 
 def noddi_amico_solo(folder_path, p, maskType="brain_mask_dilated"):
     """ Perform noddi amico on a single subject and store the data in the <folder_path>/subjects/<subjects_ID>/dMRI/microstructure/noddi_amico/.
@@ -2415,7 +2410,7 @@ def noddi_amico_solo(folder_path, p, maskType="brain_mask_dilated"):
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual NODDI AMICO processing for patient %s \n" % p)
 
     import numpy as np
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, save_nifti
     from dipy.io.gradients import read_bvals_bvecs
 
     log_prefix = "NODDI AMICO SOLO"
@@ -2430,27 +2425,31 @@ def noddi_amico_solo(folder_path, p, maskType="brain_mask_dilated"):
             log_prefix)
 
     mask_path = folder_path + '/subjects/' + patient_path + "/masks/" + patient_path + '_' + maskType + '.nii.gz'
-    if os.path.isfile(mask_path):
-        mask, _ = load_nifti(mask_path)
-    else:
-        mask, _ = load_nifti(
-            folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + "_brain_mask_dilated.nii.gz")
+    if not os.path.isfile(mask_path):
+        mask_path = folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + "_brain_mask_dilated.nii.gz"
 
     import amico
-    amico.core.setup()
-    ae = amico.Evaluation(study_path=folder_path + '/static_files/noddi_AMICO/',
-                          subject=folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/noddi_amico/',
-                          output_path=folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/noddi_amico/')
+    from elikopy.microstructure import AmicoKernelRegistry
 
     schemeFile = folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/noddi_amico/' + patient_path + "_NODDI_protocol.scheme"
     dwi_preproc = folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc"
+    bvals, bvecs = read_bvals_bvecs(dwi_preproc + ".bval", dwi_preproc + ".bvec")
+
+    # Kernels are generated once per acquisition protocol and shared by all the subjects of the study
+    kernel_registry = AmicoKernelRegistry(folder_path)
+
+    amico.core.setup()
+    ae = amico.Evaluation(study_path=kernel_registry.study_path(bvals, bvecs),
+                          subject=folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/noddi_amico/',
+                          output_path=folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/noddi_amico/')
 
     amico.util.fsl2scheme(dwi_preproc + ".bval", dwi_preproc + ".bvec", schemeFilename=schemeFile)
 
-    ae.load_data(dwi_filename=dwi_preproc + ".nii.gz", scheme_filename=schemeFile, mask_filename=wm_path, b0_thr=0)
+    ae.load_data(dwi_filename=dwi_preproc + ".nii.gz", scheme_filename=schemeFile, mask_filename=mask_path, b0_thr=0)
     ae.set_model("NODDI")
-    ae.generate_kernels()
-    ae.load_kernels()
+    f = open(folder_path + '/subjects/' + patient_path + "/dMRI/microstructure/noddi_amico/noddi_amico_logs.txt", "a+")
+    kernel_registry.load_kernels(ae, bvals, bvecs, log_file=f)
+    f.close()
     ae.fit()
     ae.save_results(path_suffix=patient_path)
 
@@ -2471,6 +2470,7 @@ def diamond_solo(folder_path, p, core_count=4, reportOnly=False, maskType="brain
     :param use_wm_mask: If true a white matter mask is used. The white_matter() function needs to already be applied. default=False
     :param customDiamond: If not empty, the string define custom value for --ntensors, -reg, --estimb0, --automose, --mosemodels, --fascicle, --waterfraction, --waterDiff, --omtm, --residuals, --fractions_sumto1, --verbose and --log
     """
+    core_count = cpu_allowance(core_count)
     log_prefix = "DIAMOND SOLO"
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual DIAMOND processing for patient %s \n" % p)
@@ -2519,8 +2519,7 @@ def diamond_solo(folder_path, p, core_count=4, reportOnly=False, maskType="brain
         f.close()
 
     if not reportOnly:
-        bashCommand = 'export OMP_NUM_THREADS=' + str(
-            core_count) + ' ; crlDCIEstimate --input "' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc.nii.gz' + '" --output "' + folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/diamond/' + patient_path + '_diamond.nii.gz' + '" --mask "' + mask + '" --proc ' + str(
+        bashCommand = thread_exports(core_count) + 'crlDCIEstimate --input "' + folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + '_dmri_preproc.nii.gz' + '" --output "' + folder_path + '/subjects/' + patient_path + '/dMRI/microstructure/diamond/' + patient_path + '_diamond.nii.gz' + '" --mask "' + mask + '" --proc ' + str(
             core_count)
         if customDiamond == "" or (customDiamond is None) or (isinstance(customDiamond, str) and len(customDiamond) < 3):
             bashCommand = bashCommand + ' --ntensors 2 --reg 1.0 --estimb0 1 --automose aicu --mosemodels --fascicle diamondcyl --waterfraction 1 --waterDiff 0.003 --omtm 1 --residuals --verbose 1 --log'
@@ -2555,7 +2554,7 @@ def diamond_solo(folder_path, p, core_count=4, reportOnly=False, maskType="brain
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    from dipy.io.image import load_nifti
+    from elikopy.storage import load_nifti
 
     mosemap, _ = load_nifti(folder_path + '/subjects/' + patient_path + "/dMRI/microstructure/diamond/" + patient_path + "_diamond_mosemap.nii.gz")
     fractions, _ = load_nifti(folder_path + '/subjects/' + patient_path + "/dMRI/microstructure/diamond/" + patient_path + "_diamond_fractions.nii.gz")
@@ -2716,6 +2715,7 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
     :param use_wm_mask: If true a white matter mask is used. The white_matter() function needs to already be applied. default=False
     :param output_filename: str. Specify output filename.
     """
+    core_count = cpu_allowance(core_count)
 
     log_prefix = "MF SOLO"
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
@@ -2749,7 +2749,7 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
 
     # imports
     import microstructure_fingerprinting as mf
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, get_data, AsyncNiftiWriter, compact_existing, image_exists, load_image
     from dipy.io import read_bvals_bvecs
 
     # load the data
@@ -2855,8 +2855,9 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
 
     f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Loading of MF dic\n")
-    # get the dictionary
-    mf_model = mf.MFModel(dictionary_path)
+    # get the dictionary, built once per study and shared read-only by the subjects
+    from elikopy.microstructure import MFDictionaryCache
+    mf_model = MFDictionaryCache(folder_path).get_model(dictionary_path, log_file=f)
 
     f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of fitting\n")
@@ -2896,9 +2897,14 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
         filename = '_mf'
 
     MF_fit.write_nifti(mf_path + '/' + patient_path + filename+'.nii.gz', affine=affine)
+    for out in sorted(os.listdir(mf_path)):
+        if out.startswith(patient_path + filename + '_') and out.endswith('.nii.gz'):
+            compact_existing(mf_path + '/' + out, mask)
 
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Saving of unravel pseudotensor dic\n", flush = True)
+    # the outputs are written in the background while the quality control is computed
+    writer = AsyncNiftiWriter(max_workers=core_count)
     # Export pseudo tensor
     frac = 0
     frac_list = []
@@ -2906,33 +2912,33 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
     fvf_list = []
     import nibabel as nib
     from elikopy.utils import peak_to_tensor
-    while os.path.exists(mf_path + '/' + patient_path + filename+'_peak_f'+str(frac)+'.nii.gz') and os.path.exists(mf_path + '/' + patient_path + filename+'_frac_f' + str(frac) + '.nii.gz'):
+    while image_exists(mf_path + '/' + patient_path + filename+'_peak_f'+str(frac)+'.nii.gz') and image_exists(mf_path + '/' + patient_path + filename+'_frac_f' + str(frac) + '.nii.gz'):
         peaks_path = mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '.nii.gz'
         frac_path = mf_path + '/' + patient_path + filename+'_frac_f' + str(frac) + '.nii.gz'
         fvf_path = mf_path + '/' + patient_path + filename+'_fvf_f' + str(frac) + '.nii.gz'
-        img_mf_peaks = nib.load(peaks_path)
-        img_mf_frac = nib.load(frac_path)
+        img_mf_peaks = load_image(peaks_path)
+        img_mf_frac = load_image(frac_path)
         hdr = img_mf_peaks.header
         pixdim = hdr['pixdim'][1:4]
-        t = peak_to_tensor(img_mf_peaks.get_fdata(),norm=None,pixdim=pixdim)
-        t_normed = peak_to_tensor(img_mf_peaks.get_fdata(), norm=img_mf_frac.get_fdata(),pixdim=pixdim)
+        t = peak_to_tensor(get_data(img_mf_peaks),norm=None,pixdim=pixdim)
+        t_normed = peak_to_tensor(get_data(img_mf_peaks), norm=get_data(img_mf_frac),pixdim=pixdim)
         hdr['dim'][0] = 5  # 4 scalar, 5 vector
         hdr['dim'][4] = 1  # 3
         hdr['dim'][5] = 6  # 1
         hdr['regular'] = b'r'
         hdr['intent_code'] = 1005
-        save_nifti(mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '_pseudoTensor.nii.gz', t, img_mf_peaks.affine, hdr)
-        save_nifti(mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '_pseudoTensor_normed.nii.gz', t_normed, img_mf_peaks.affine, hdr)
+        writer.save_nifti(mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '_pseudoTensor.nii.gz', t, img_mf_peaks.affine, hdr, mask=mask)
+        writer.save_nifti(mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '_pseudoTensor_normed.nii.gz', t_normed, img_mf_peaks.affine, hdr, mask=mask)
 
         import unravel.utils
-        RGB_peak = unravel.utils.peaks_to_RGB(img_mf_peaks.get_fdata(), order=color_order)
-        save_nifti(mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '_RGB.nii.gz', RGB_peak, img_mf_frac.affine)
-        peaks_list.append(img_mf_peaks.get_fdata())
-        frac_list.append(img_mf_frac.get_fdata())
+        RGB_peak = unravel.utils.peaks_to_RGB(get_data(img_mf_peaks), order=color_order)
+        writer.save_nifti(mf_path + '/' + patient_path + filename+'_peak_f' + str(frac) + '_RGB.nii.gz', RGB_peak, img_mf_frac.affine, mask=mask)
+        peaks_list.append(get_data(img_mf_peaks))
+        frac_list.append(get_data(img_mf_frac))
 
-        if os.path.exists(fvf_path):
-            img_mf_fvf = nib.load(fvf_path)
-            fvf_list.append(img_mf_fvf.get_fdata())
+        if image_exists(fvf_path):
+            img_mf_fvf = load_image(fvf_path)
+            fvf_list.append(get_data(img_mf_fvf))
 
         frac = frac + 1
     
@@ -2941,11 +2947,11 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
     fvf=np.stack(fvf_list,axis=-1)
     if len(frac_list) > 0 and len(peaks_list) > 0:
         RGB_peaks_frac = unravel.utils.peaks_to_RGB(peaks, frac, order=color_order)
-        save_nifti(mf_path + '/' + patient_path + filename+'_peak_tot_RGB_frac.nii.gz', RGB_peaks_frac, img_mf_frac.affine)
+        writer.save_nifti(mf_path + '/' + patient_path + filename+'_peak_tot_RGB_frac.nii.gz', RGB_peaks_frac, img_mf_frac.affine, mask=mask)
 
     if len(frac_list) > 0 and len(peaks_list) > 0 and len(fvf_list)>0:
         RGB_peaks_frac_fvf = unravel.utils.peaks_to_RGB(peaks, frac, fvf, order=color_order)
-        save_nifti(mf_path + '/' + patient_path + filename+'_peak_tot_RGB_frac_fvf.nii.gz', RGB_peaks_frac_fvf, img_mf_frac.affine)
+        writer.save_nifti(mf_path + '/' + patient_path + filename+'_peak_tot_RGB_frac_fvf.nii.gz', RGB_peaks_frac_fvf, img_mf_frac.affine, mask=mask)
 
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Starting quality control %s \n" % p, flush = True)
@@ -3071,6 +3077,8 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
         pdf.print_page(elem)
         pdf.output(qc_path + '/qc_report.pdf', 'F');
 
+        # the outputs must be written before the step is reported as completed
+        writer.flush()
         if not os.path.exists(folder_path + '/subjects/' + patient_path + '/quality_control.pdf'):
             shutil.copyfile(qc_path + '/qc_report.pdf',
                             folder_path + '/subjects/' + patient_path + '/quality_control.pdf')
@@ -3093,7 +3101,9 @@ def mf_solo(folder_path, p, dictionary_path, core_count=1, maskType="brain_mask_
                 "%d.%b %Y %H:%M:%S") + ": Successfully processed patient %s \n" % p)
             f.close()
 
-def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=None, core_count=1, maskType="brain_mask_dilated", report=True, CSD_FA_treshold=0.7, return_odf=False):
+    writer.close()
+
+def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=None, core_count=1, maskType="brain_mask_dilated", report=True, CSD_FA_treshold=0.7, return_odf=False, group_response=False):
     """Perform microstructure fingerprinting and store the data in the <folder_path>/subjects/<subjects_ID>/dMRI/microstructure/mf/.
 
     :param folder_path: the path to the root directory.
@@ -3102,7 +3112,9 @@ def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=
     :param CSD_bvalue: If the DIAMOND outputs are not available, the fascicles directions are estimated using a CSD with the images at the b-values specified in this argument. default=None
     :param core_count: Define the number of available core. default=1
     :param use_wm_mask: If true a white matter mask is used. The white_matter() function needs to already be applied. default=False
+    :param group_response: If true, the group response of the acquisition scheme stored in <folder_path>/responses/ is used instead of the subject response (see elikopy.odf.ResponseRegistry). default=False
     """
+    core_count = cpu_allowance(core_count)
     log_prefix = "ODF CSD SOLO"
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual ODF CSD for patient %s \n" % p, flush = True)
@@ -3120,19 +3132,13 @@ def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=
     makedir(odf_csd_path, folder_path + '/subjects/' + patient_path + "/dMRI/ODF/CSD/CSD_logs.txt", log_prefix)
 
     # imports
-    from dipy.io.image import load_nifti, save_nifti
-    from dipy.io import read_bvals_bvecs
-    from dipy.core.gradients import gradient_table
+    from elikopy.storage import load_nifti, save_nifti, get_data
     from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
-    from dipy.direction import peaks_from_model
     from dipy.data import default_sphere
+    from elikopy.odf import csd_peaks_parallel, load_csd_data, ResponseRegistry
 
     # load the data
-    data, affine = load_nifti(
-        folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.nii.gz")
-    bvals, bvecs = read_bvals_bvecs(
-        folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bval",
-        folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bvec")
+    data_CSD, gtab_CSD, affine = load_csd_data(folder_path, patient_path, CSD_bvalue=CSD_bvalue)
 
     mask_path = folder_path + '/subjects/' + patient_path + "/masks/" + patient_path + '_' + maskType + '.nii.gz'
     if os.path.isfile(mask_path):
@@ -3141,25 +3147,21 @@ def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=
         mask, _ = load_nifti(
             folder_path + '/subjects/' + patient_path + '/masks/' + patient_path + "_brain_mask_dilated.nii.gz")
 
-    b0_threshold = np.min(bvals) + 10
-    b0_threshold = max(50, b0_threshold)
-
-    if CSD_bvalue is not None:
-        print("Max CSD bvalue is", CSD_bvalue)
-        sel_b = np.logical_or(bvals == 0, np.logical_and((CSD_bvalue - 5) <= bvals, bvals <= (CSD_bvalue + 5)))
-        data_CSD = data[..., sel_b]
-        gtab_CSD = gradient_table(bvals[sel_b], bvecs[sel_b], b0_threshold=b0_threshold)
+    response_registry = ResponseRegistry(folder_path)
+    if group_response:
+        response = response_registry.get_group_csd_response(patient_path, CSD_bvalue=CSD_bvalue,
+                                                            fa_thr=CSD_FA_treshold)
     else:
-        data_CSD = data
-        gtab_CSD = gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
-
-    from dipy.reconst.csdeconv import auto_response_ssst
-    response, ratio = auto_response_ssst(gtab_CSD, data_CSD, roi_radii=10, fa_thr=CSD_FA_treshold)
+        response = response_registry.get_subject_csd_response(patient_path, gtab_CSD=gtab_CSD, data_CSD=data_CSD,
+                                                              CSD_bvalue=CSD_bvalue, fa_thr=CSD_FA_treshold)
+    f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+        "%d.%b %Y %H:%M:%S") + ": CSD response (group=" + str(group_response) + "): " + str(response) + "\n")
 
     csd_model = ConstrainedSphericalDeconvModel(gtab_CSD, response, sh_order=8)
-    csd_peaks = peaks_from_model(npeaks=num_peaks, model=csd_model, data=data_CSD, sphere=default_sphere,
-                                 relative_peak_threshold=peaks_threshold, min_separation_angle=25, parallel=False, mask=mask,
-                                 normalize_peaks=True,return_odf=return_odf,return_sh=True)
+    csd_peaks = csd_peaks_parallel(csd_model, data_CSD, default_sphere, mask=mask, npeaks=num_peaks,
+                                   relative_peak_threshold=peaks_threshold, min_separation_angle=25,
+                                   normalize_peaks=True, return_odf=return_odf, sh_order=8, core_count=core_count,
+                                   tmp_dir=odf_csd_path)
 
     save_nifti(odf_csd_path + '/' + patient_path + '_CSD_peaks.nii.gz', csd_peaks.peak_dirs, affine)
     save_nifti(odf_csd_path + '/' + patient_path + '_CSD_values.nii.gz', csd_peaks.peak_values, affine)
@@ -3201,10 +3203,10 @@ def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=
     hdr = img_mf_peaks.header
     pixdim = hdr['pixdim'][1:4]
 
-    t_p1 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 0, :], norm=None, pixdim=pixdim)
-    t_normed_p1 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 0, :], norm=img_mf_frac.get_fdata()[..., 0], pixdim=pixdim)
-    t_p2 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 1, :], norm=None, pixdim=pixdim)
-    t_normed_p2 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 1, :], norm=img_mf_frac.get_fdata()[..., 1], pixdim=pixdim)
+    t_p1 = peak_to_tensor(get_data(img_mf_peaks)[..., 0, :], norm=None, pixdim=pixdim)
+    t_normed_p1 = peak_to_tensor(get_data(img_mf_peaks)[..., 0, :], norm=get_data(img_mf_frac)[..., 0], pixdim=pixdim)
+    t_p2 = peak_to_tensor(get_data(img_mf_peaks)[..., 1, :], norm=None, pixdim=pixdim)
+    t_normed_p2 = peak_to_tensor(get_data(img_mf_peaks)[..., 1, :], norm=get_data(img_mf_frac)[..., 1], pixdim=pixdim)
 
     hdr['dim'][0] = 5  # 4 scalar, 5 vector
     hdr['dim'][4] = 1  # 3
@@ -3244,13 +3246,15 @@ def odf_csd_solo(folder_path, p, num_peaks=2, peaks_threshold = .25, CSD_bvalue=
     f.close()
 
 
-def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold = 0.25, report=True, maskType="brain_mask_dilated"):
+def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold = 0.25, report=True, maskType="brain_mask_dilated", group_response=False):
     """Perform MSMT CSD odf computation and store the data in the <folder_path>/subjects/<subjects_ID>/dMRI/ODF/MSMT-CSD/.
 
     :param folder_path: the path to the root directory.
     :param p: The name of the patient.
     :param core_count: Define the number of available core. default=1
+    :param group_response: If true, the group responses of the acquisition scheme stored in <folder_path>/responses/ are used instead of the subject responses (see elikopy.odf.ResponseRegistry). default=False
     """
+    core_count = cpu_allowance(core_count)
     log_prefix = "ODF MSMT-CSD SOLO"
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual ODF MSMT-CSD for patient %s \n" % p, flush = True)
@@ -3264,14 +3268,21 @@ def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold
     odf_msmtcsd_path = folder_path + '/subjects/' + patient_path + "/dMRI/ODF/MSMT-CSD"
     makedir(odf_msmtcsd_path, folder_path + '/subjects/' + patient_path + "/dMRI/ODF/MSMT-CSD/MSMT-CSD_logs.txt", log_prefix)
 
-    dwi2response_cmd = 'dwi2response dhollander -info ' + \
-                       '-nthreads ' + str(core_count) + '  -fslgrad ' + \
-                       folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bvec " + \
-                       folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bval " + \
-                       folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.nii.gz " + \
-                       odf_msmtcsd_path + '/' + patient_path + '_dhollander_WM_response.txt ' + \
-                       odf_msmtcsd_path + '/' + patient_path + '_dhollander_GM_response.txt ' + \
-                       odf_msmtcsd_path + '/' + patient_path + '_dhollander_CSF_response.txt -force ; '
+    from elikopy.odf import ResponseRegistry
+    response_registry = ResponseRegistry(folder_path)
+    if group_response:
+        wm_response, gm_response, csf_response = response_registry.get_group_msmt_response(patient_path)
+    else:
+        f.flush()
+        cached_responses = response_registry.get_subject_msmt_response(patient_path, core_count=core_count, log_file=f)
+        wm_response = odf_msmtcsd_path + '/' + patient_path + '_dhollander_WM_response.txt'
+        gm_response = odf_msmtcsd_path + '/' + patient_path + '_dhollander_GM_response.txt'
+        csf_response = odf_msmtcsd_path + '/' + patient_path + '_dhollander_CSF_response.txt'
+        for cached_response, response in zip(cached_responses, [wm_response, gm_response, csf_response]):
+            shutil.copyfile(cached_response, response)
+    f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+        "%d.%b %Y %H:%M:%S") + ": MSMT-CSD responses (group=" + str(group_response) + "): " + wm_response + " " + gm_response + " " + csf_response + "\n")
+    f.flush()
 
     dwi2fod_cmd = 'dwi2fod msmt_csd -info ' + \
                   '-nthreads ' + str(core_count) + ' -mask ' + \
@@ -3280,16 +3291,14 @@ def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold
                   '-fslgrad ' + \
                   folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bvec " + \
                   folder_path + '/subjects/' + patient_path + '/dMRI/preproc/' + patient_path + "_dmri_preproc.bval " + \
-                  odf_msmtcsd_path + '/' + patient_path + '_dhollander_WM_response.txt ' + \
+                  wm_response + ' ' + \
                   odf_msmtcsd_path + '/' + patient_path + '_MSMT-CSD_WM_ODF.nii.gz ' + \
-                  odf_msmtcsd_path + '/' + patient_path + '_dhollander_GM_response.txt ' + \
+                  gm_response + ' ' + \
                   odf_msmtcsd_path + '/' + patient_path + '_MSMT-CSD_GM.nii.gz ' + \
-                  odf_msmtcsd_path + '/' + patient_path + '_dhollander_CSF_response.txt ' + \
+                  csf_response + ' ' + \
                   odf_msmtcsd_path + '/' + patient_path + '_MSMT-CSD_CSF.nii.gz -force ; '
 
-    bashCommand = 'export OMP_NUM_THREADS=' + str(core_count) + ' ; ' + \
-                  dwi2response_cmd + \
-                  dwi2fod_cmd
+    bashCommand = thread_exports(core_count) + dwi2fod_cmd
 
 
     import subprocess
@@ -3310,7 +3319,7 @@ def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold
                      odf_msmtcsd_path + '/' + patient_path + '_MSMT-CSD_peaks.nii.gz ' + \
                      odf_msmtcsd_path + '/' + patient_path + "_MSMT-CSD_peaks_amp.nii.gz ; "
 
-    bashCommand = 'export OMP_NUM_THREADS=' + str(core_count) + ' ; ' + sh2peaks_cmd + peaks2amp_cmd
+    bashCommand = thread_exports(core_count) + sh2peaks_cmd + peaks2amp_cmd
 
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": mrtrix ODF MSMT-CSD postprocessing launched for patient %s \n" % p + " with bash command " + bashCommand)
@@ -3320,7 +3329,7 @@ def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold
 
     output, error = process.communicate()
 
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, save_nifti, get_data
 
     # Export pseudo tensor
     from elikopy.utils import peak_to_tensor
@@ -3335,11 +3344,11 @@ def odf_msmtcsd_solo(folder_path, p, core_count=1, num_peaks=2, peaks_threshold
     hdr = img_mf_peaks.header
     pixdim = hdr['pixdim'][1:4]
 
-    t_p1 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 0:3], norm=None, pixdim=pixdim)
-    t_normed_p1 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 0:3], norm=img_mf_frac.get_fdata()[..., 0],
+    t_p1 = peak_to_tensor(get_data(img_mf_peaks)[..., 0:3], norm=None, pixdim=pixdim)
+    t_normed_p1 = peak_to_tensor(get_data(img_mf_peaks)[..., 0:3], norm=get_data(img_mf_frac)[..., 0],
                                  pixdim=pixdim)
-    t_p2 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 3:6], norm=None, pixdim=pixdim)
-    t_normed_p2 = peak_to_tensor(img_mf_peaks.get_fdata()[..., 3:6], norm=img_mf_frac.get_fdata()[..., 1],
+    t_p2 = peak_to_tensor(get_data(img_mf_peaks)[..., 3:6], norm=None, pixdim=pixdim)
+    t_normed_p2 = peak_to_tensor(get_data(img_mf_peaks)[..., 3:6], norm=get_data(img_mf_frac)[..., 1],
                                  pixdim=pixdim)
 
     hdr['dim'][0] = 5  # 4 scalar, 5 vector
@@ -3394,11 +3403,12 @@ def ivim_solo(folder_path, p, core_count=1, G1Ball_2_lambda_iso=7e-9, G1Ball_1_l
     :param use_amico: If true, use the amico optimizer. default=FALSE
     :param core_count: Number of allocated cpu cores. default=1
     """
+    core_count = cpu_allowance(core_count)
     print("[IVIM SOLO] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual ivim processing for patient %s \n" % p)
 
     import numpy as np
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, AsyncNiftiWriter
     from dipy.io.gradients import read_bvals_bvecs
 
     patient_path = p
@@ -3464,12 +3474,14 @@ def ivim_solo(folder_path, p, core_count=1, G1Ball_2_lambda_iso=7e-9, G1Ball_1_l
     mse = ivim_fit_Dfixed.mean_squared_error(data)
     R2 = ivim_fit_Dfixed.R2_coefficient_of_determination(data)
 
+    # the outputs are written in the background while the quality control is computed
+    writer = AsyncNiftiWriter(max_workers=core_count)
     # save the nifti
-    save_nifti(ivim_path + '/' + patient_path + '_ivim_D_DiffBall.nii.gz', D_diffBall.astype(np.float32), affine)
-    save_nifti(ivim_path + '/' + patient_path + '_ivim_f_BloodBall.nii.gz', f_BloodBall.astype(np.float32), affine)
-    save_nifti(ivim_path + '/' + patient_path + '_ivim_f_DiffusionBall.nii.gz', f_DiffusionBall.astype(np.float32), affine)
-    save_nifti(ivim_path + '/' + patient_path + '_ivim_mse.nii.gz', mse.astype(np.float32), affine)
-    save_nifti(ivim_path + '/' + patient_path + '_ivim_R2.nii.gz', R2.astype(np.float32), affine)
+    writer.save_nifti(ivim_path + '/' + patient_path + '_ivim_D_DiffBall.nii.gz', D_diffBall.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(ivim_path + '/' + patient_path + '_ivim_f_BloodBall.nii.gz', f_BloodBall.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(ivim_path + '/' + patient_path + '_ivim_f_DiffusionBall.nii.gz', f_DiffusionBall.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(ivim_path + '/' + patient_path + '_ivim_mse.nii.gz', mse.astype(np.float32), affine, mask=mask)
+    writer.save_nifti(ivim_path + '/' + patient_path + '_ivim_R2.nii.gz', R2.astype(np.float32), affine, mask=mask)
 
     print("[" + log_prefix + "] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Starting quality control %s \n" % p)
@@ -3568,6 +3580,8 @@ def ivim_solo(folder_path, p, core_count=1, G1Ball_2_lambda_iso=7e-9, G1Ball_1_l
     pdf.print_page(elem)
     pdf.output(qc_path + '/qc_report.pdf', 'F');
 
+    # the outputs must be written before the step is reported as completed
+    writer.flush()
     if not os.path.exists(folder_path + '/subjects/' + patient_path + '/quality_control.pdf'):
         shutil.copyfile(qc_path + '/qc_report.pdf', folder_path + '/subjects/' + patient_path + '/quality_control.pdf')
     else:
@@ -3589,6 +3603,8 @@ def ivim_solo(folder_path, p, core_count=1, G1Ball_2_lambda_iso=7e-9, G1Ball_1_l
             "%d.%b %Y %H:%M:%S") + ": Successfully processed patient %s \n" % p)
         f.close()
 
+    writer.close()
+
 def tracking_solo(folder_path:str, p:str, streamline_number:int=100000,
                   max_angle:int=15, cutoff:float=0.1, msmtCSD:bool=True,
                   output_filename:str='tractogram',core_count:int=1,
@@ -3604,11 +3620,13 @@ def tracking_solo(folder_path:str, p:str, streamline_number:int=100000,
     :param output_filename: str. Specify output filename for tractogram.
     :param maskType: str. Specify a masking region of interest, streamlines exiting the mask will be truncated.
     """
+    core_count = cpu_allowance(core_count)
 
     assert maskType in ["brain_mask_dilated","brain_mask"], "The mask parameter must be one of the following : brain_mask_dilated, brain_mask"
 
     import nibabel as nib
     from elikopy.utils import dipy_fod_to_mrtrix
+    from elikopy.storage import get_data, save_nifti
     from dipy.io.streamline import load_tractogram, save_trk
 
     patient_path = p
@@ -3626,9 +3644,8 @@ def tracking_solo(folder_path:str, p:str, streamline_number:int=100000,
             odf_csd_solo(folder_path, p)
         if not os.path.isfile(folder_path + '/subjects/' + patient_path + "/dMRI/ODF/CSD/"+patient_path + "_CSD_SH_ODF_mrtrix.nii.gz"):
             img = nib.load(folder_path + '/subjects/' + patient_path + "/dMRI/ODF/CSD/"+patient_path + "_CSD_SH_ODF.nii.gz")
-            data = dipy_fod_to_mrtrix(img.get_fdata())
-            out = nib.Nifti1Image(data, img.affine, img.header)
-            out.to_filename(folder_path + '/subjects/' + patient_path + "/dMRI/ODF/CSD/"+patient_path + "_CSD_SH_ODF_mrtrix.nii.gz")
+            data = dipy_fod_to_mrtrix(get_data(img))
+            save_nifti(folder_path + '/subjects/' + patient_path + "/dMRI/ODF/CSD/"+patient_path + "_CSD_SH_ODF_mrtrix.nii.gz", data, img.affine, img.header)
         odf_file_path = folder_path + '/subjects/' + patient_path + "/dMRI/ODF/CSD/"+patient_path + "_CSD_SH_ODF_mrtrix.nii.gz"
         params['Local modeling']='CSD'
     tracking_path = folder_path + '/subjects/' + patient_path + "/dMRI/tractography/"
@@ -3678,6 +3695,7 @@ def sift_solo(folder_path: str, p: str, streamline_number: int = 100000,
     :param msmtCSD: boolean. If True then uses ODF from msmt-CSD, if False from CSD. default=True
     :param input_filename: str. Specify input filename for tractogram.
     """
+    core_count = cpu_allowance(core_count)
 
     from dipy.io.streamline import load_tractogram, save_trk
 
@@ -3726,11 +3744,12 @@ def verdict_solo(folder_path, p, core_count=1, small_delta=0.003, big_delta=0.03
     :param use_amico: If true, use the amico optimizer. default=FALSE
     :param core_count: Number of allocated cpu cores. default=1
     """
+    core_count = cpu_allowance(core_count)
     print("[verdict SOLO] " + datetime.datetime.now().strftime(
         "%d.%b %Y %H:%M:%S") + ": Beginning of individual verdict processing for patient %s \n" % p)
 
     import numpy as np
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, save_nifti
     from dipy.io.gradients import read_bvals_bvecs
 
     patient_path = p
@@ -0,0 +1,439 @@
+"""
+ Study-level caches shared by the microstructure models of the subjects.
+"""
+import os
+import pickle
+import datetime
+
+import numba
+import numpy as np
+
+from elikopy.resources import numba_threads
+from elikopy.utils import file_lock, get_acquisition_scheme_key
+
+
+class AmicoKernelRegistry:
+    r'''
+    Study-level registry of the AMICO kernels. Subjects are grouped by the shell structure of their acquisition (see
+    elikopy.utils.get_acquisition_scheme_key with directions=False) and the kernels of each protocol are generated only
+    once in <folder_path>/amico_kernels/<scheme_key>/kernels/<model>/. The generation is protected by a file lock,
+    several subjects (or Slurm jobs) can therefore use the registry concurrently. The generated kernels are resampled
+    by AMICO to the directions of each subject, which eddy rotates differently for every subject.
+    '''
+
+    def __init__(self, folder_path):
+        """ Creates the registry of the study.
+
+        :param folder_path: the path to the root directory.
+        """
+        self.folder_path = folder_path
+        self.registry_path = os.path.join(folder_path, "amico_kernels")
+
+    def study_path(self, bvals, bvecs):
+        """ Returns the AMICO study path of an acquisition scheme. The generated kernels are computed on the high
+        resolution scheme of AMICO, they only depend on the shells of the acquisition.
+
+        :param bvals: 1-D array of the b-values.
+        :param bvecs: 2-D array of the gradient directions.
+        """
+        return os.path.join(self.registry_path, get_acquisition_scheme_key(bvals, bvecs, directions=False))
+
+    def load_kernels(self, ae, bvals, bvecs, log_file=None):
+        """ Generates (once per protocol) and loads the kernels of the model of an AMICO evaluation. The data and the
+        model of ae must already be set, and ae must have been created with study_path=self.study_path(bvals, bvecs).
+
+        :param ae: The amico.Evaluation object.
+        :param bvals: 1-D array of the b-values of the subject.
+        :param bvecs: 2-D array of the gradient directions of the subject.
+        :param log_file: Opened file receiving the registry events. default=None
+        """
+        study_path = self.study_path(bvals, bvecs)
+        model_id = ae.model.id
+        generated_marker = os.path.join(study_path, "kernels", model_id, ".elikopy_generated")
+
+        if os.path.isfile(generated_marker):
+            self._log(log_file, "Reused the " + model_id + " kernels of " + study_path)
+        else:
+            with file_lock(os.path.join(study_path, ".lock")):
+                if not os.path.isfile(generated_marker):
+                    ae.generate_kernels(regenerate=True)
+                    os.makedirs(os.path.dirname(generated_marker), exist_ok=True)
+                    open(generated_marker, "w").close()
+                    self._log(log_file, "Generated the " + model_id + " kernels in " + study_path)
+
+        # The kernels are resampled to the directions of the subject
+        ae.load_kernels()
+
+    @staticmethod
+    def _log(log_file, message):
+        message = "[AMICO KERNELS] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": " + message
+        print(message)
+        if log_file is not None:
+            log_file.write(message + "\n")
+            log_file.flush()
+
+
+def check_amico_kernel_registry(seed=0, tmp_dir=None):
+    """
+    Checks the sharing of the AMICO kernels on a stand-in of amico.Evaluation recording its calls: three subjects of
+    the same protocol, whose directions were rotated differently by eddy and whose volumes are in different orders,
+    must share the study path and the kernels generated once, while each of them has the kernels resampled to its own
+    directions by ae.load_kernels. A subject of another protocol must get its own kernels.
+
+    :param seed: Seed of the directions, rotations and orders. default=0
+    :param tmp_dir: Directory of the temporary study. default=system temporary directory
+    :return: Dictionary with the number of generations and the list of the subjects whose kernels were loaded.
+    """
+    import shutil
+    import tempfile
+    from scipy.spatial.transform import Rotation
+
+    calls = {"generate": 0, "load": []}
+
+    class _Evaluation:
+        def __init__(self, name):
+            self.name = name
+            self.model = type("_Model", (), {"id": "NODDI"})()
+
+        def generate_kernels(self, regenerate=False):
+            calls["generate"] += 1
+
+        def load_kernels(self):
+            calls["load"].append(self.name)
+
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(60, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    bvals = np.concatenate([np.zeros(4), np.full(30, 1000.), np.full(30, 2000.)])
+    bvecs = np.concatenate([np.zeros((4, 3)), directions])
+    subjects = {}
+    for name in ("sub1", "sub2", "sub3"):
+        order = rng.permutation(len(bvals))
+        subjects[name] = (bvals[order], Rotation.from_rotvec(rng.normal(0, 0.03, 3)).apply(bvecs)[order])
+    subjects["other"] = (np.where(bvals == 2000, 3000., bvals), bvecs)
+
+    folder_path = tempfile.mkdtemp(prefix="elikopy_amico_check_", dir=tmp_dir)
+    try:
+        registry = AmicoKernelRegistry(folder_path)
+        study_paths = {name: registry.study_path(b, v) for name, (b, v) in subjects.items()}
+        for name, (b, v) in subjects.items():
+            registry.load_kernels(_Evaluation(name), b, v)
+    finally:
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+    assert study_paths["sub1"] == study_paths["sub2"] == study_paths["sub3"] != study_paths["other"], \
+        "the study paths do not follow the protocols"
+    assert calls["generate"] == 2, "the kernels must be generated once per protocol"
+    assert calls["load"] == list(subjects), "the kernels must be resampled for every subject"
+    return calls
+
+
+_resident_mf_models = {}
+
+
+class MFDictionaryCache:
+    r'''
+    Study-level cache of the Microstructure Fingerprinting dictionaries. The first time a dictionary is used, the
+    MFModel built from it is stored in <folder_path>/mf_dictionaries/<dictionary_key>/ as one .npy file per array
+    attribute (plus a small pickle of the other attributes). Subsequent subjects rebuild the model from these files
+    with memory-mapped arrays instead of re-reading and re-interpolating the MATLAB dictionary: the pages are shared by
+    all the processes fitting on the same node, and written pages are private to each process (copy-on-write). Within a
+    process, the model is kept resident and reused by every subject.
+    '''
+
+    def __init__(self, folder_path, min_mmap_size=1024):
+        """ Creates the cache of the study.
+
+        :param folder_path: the path to the root directory.
+        :param min_mmap_size: Arrays with fewer elements are pickled instead of memory-mapped. default=1024
+        """
+        self.folder_path = folder_path
+        self.cache_path = os.path.join(folder_path, "mf_dictionaries")
+        self.min_mmap_size = min_mmap_size
+
+    @staticmethod
+    def dictionary_key(dictionary_path):
+        """ Returns the key of a dictionary file, which changes whenever the file is modified.
+
+        :param dictionary_path: Path to the dictionary of fingerprints.
+        """
+        import hashlib
+
+        stat = os.stat(dictionary_path)
+        signature = os.path.abspath(dictionary_path) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+        return os.path.splitext(os.path.basename(dictionary_path))[0] + "_" + \
+            hashlib.sha1(signature.encode()).hexdigest()[:16]
+
+    def get_model(self, dictionary_path, log_file=None):
+        """ Returns the MFModel of a dictionary, building and storing it in the cache if needed.
+
+        :param dictionary_path: Path to the dictionary of fingerprints.
+        :param log_file: Opened file receiving the cache events. default=None
+        :return: A microstructure_fingerprinting.MFModel instance.
+        """
+        import microstructure_fingerprinting as mf
+
+        key = self.dictionary_key(dictionary_path)
+        if key in _resident_mf_models:
+            self._log(log_file, "Reused the resident MF dictionary " + key)
+            return _resident_mf_models[key]
+
+        model_path = os.path.join(self.cache_path, key)
+        state_path = os.path.join(model_path, "state.p")
+
+        if not os.path.isfile(state_path):
+            with file_lock(model_path + ".lock"):
+                if not os.path.isfile(state_path):
+                    model = mf.MFModel(dictionary_path)
+                    self._store(model, model_path)
+                    self._log(log_file, "Stored the MF dictionary " + dictionary_path + " in " + model_path)
+                    _resident_mf_models[key] = model
+                    return model
+
+        with open(state_path, "rb") as handle:
+            state, mmap_attributes = pickle.load(handle)
+        for name in mmap_attributes:
+            state[name] = np.load(os.path.join(model_path, name + ".npy"), mmap_mode='c')
+        model = mf.MFModel.__new__(mf.MFModel)
+        model.__dict__.update(state)
+        self._log(log_file, "Loaded the memory-mapped MF dictionary " + model_path)
+
+        _resident_mf_models[key] = model
+        return model
+
+    def _store(self, model, model_path):
+        os.makedirs(model_path, exist_ok=True)
+        state = {}
+        mmap_attributes = []
+        for name, value in vars(model).items():
+            if isinstance(value, np.ndarray) and value.dtype != object and value.size >= self.min_mmap_size:
+                tmp_path = os.path.join(model_path, name + ".tmp" + str(os.getpid()) + ".npy")
+                np.save(tmp_path, np.ascontiguousarray(value))
+                os.replace(tmp_path, os.path.join(model_path, name + ".npy"))
+                mmap_attributes.append(name)
+            else:
+                state[name] = value
+        tmp_path = os.path.join(model_path, "state.p.tmp" + str(os.getpid()))
+        with open(tmp_path, "wb") as handle:
+            pickle.dump((state, mmap_attributes), handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(model_path, "state.p"))
+
+    @staticmethod
+    def _log(log_file, message):
+        message = "[MF DICTIONARY] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": " + message
+        print(message)
+        if log_file is not None:
+            log_file.write(message + "\n")
+            log_file.flush()
+
+
+@numba.njit(cache=True)
+def _solve_weighted_ls(X, y, w):
+    """
+    Solves the weighted least-squares problem min ||w * (X beta - y)||^2 with a pseudo-inverse, as dipy does, so that
+    the singular systems of background voxels get the minimum norm solution. Returns NaN if the weights overflow.
+    """
+    Xw = X * w[:, np.newaxis]
+    yw = w * y
+    if not (np.all(np.isfinite(Xw)) and np.all(np.isfinite(yw))):
+        return np.full(X.shape[1], np.nan)
+    return np.linalg.pinv(Xw) @ yw
+
+
+@numba.njit(cache=True)
+def _nlls_refine(X, signal, beta, n_iter):
+    """
+    Refines the log-linear tensor parameters beta by minimising ||signal - exp(X beta)||^2 with Levenberg-Marquardt
+    iterations.
+    """
+    n_params = X.shape[1]
+    pred = np.exp(X @ beta)
+    cost = np.sum((signal - pred) ** 2)
+    lam = 1e-3
+    for it in range(n_iter):
+        J = X * pred[:, np.newaxis]
+        JtJ = J.T @ J
+        Jtr = J.T @ (signal - pred)
+        if not (np.all(np.isfinite(JtJ)) and np.all(np.isfinite(Jtr))):
+            break
+        for i in range(n_params):
+            JtJ[i, i] += lam * JtJ[i, i] + 1e-12
+        step = np.linalg.pinv(JtJ) @ Jtr
+        new_beta = beta + step
+        new_pred = np.exp(X @ new_beta)
+        new_cost = np.sum((signal - new_pred) ** 2)
+        if np.isfinite(new_cost) and new_cost < cost:
+            converged = (cost - new_cost) <= 1e-10 * cost
+            beta = new_beta
+            pred = new_pred
+            cost = new_cost
+            lam = lam / 10
+            if converged:
+                break
+        else:
+            lam = lam * 10
+            if lam > 1e10:
+                break
+    return beta
+
+
+@numba.njit(parallel=True, cache=True)
+def _dti_kernel(X, pinvX, data, S0, min_signal, min_diffusivity, nlls_iter, evals, evecs, tensor, residual, maps):
+    """
+    Fits the diffusion tensor on each voxel (row) of data and computes, in the same pass, the eigen decomposition, the
+    scalar maps (FA, MD, RD, AD, MSE, R2 in the columns of maps) and the residual of the prediction.
+    """
+    n_vox, n_vols = data.shape
+    for v in numba.prange(n_vox):
+        signal = np.maximum(data[v].astype(np.float64), min_signal)
+        log_s = np.log(signal)
+
+        # Weighted least-squares with the OLS prediction as weights
+        beta = pinvX @ log_s
+        w = np.exp(X @ beta)
+        beta = _solve_weighted_ls(X, log_s, w)
+        if nlls_iter > 0:
+            beta = _nlls_refine(X, signal, beta, nlls_iter)
+        if not np.all(np.isfinite(beta)):
+            evals[v] = np.nan
+            evecs[v] = np.nan
+            tensor[v] = np.nan
+            residual[v] = np.nan
+            maps[v] = np.nan
+            continue
+
+        D = np.empty((3, 3))
+        D[0, 0] = beta[0]
+        D[0, 1] = beta[1]
+        D[1, 0] = beta[1]
+        D[1, 1] = beta[2]
+        D[0, 2] = beta[3]
+        D[2, 0] = beta[3]
+        D[1, 2] = beta[4]
+        D[2, 1] = beta[4]
+        D[2, 2] = beta[5]
+        w_eig, v_eig = np.linalg.eigh(D)
+
+        # Sort in decreasing order and clip to the minimum diffusivity, as dipy does
+        for k in range(3):
+            evals[v, k] = max(w_eig[2 - k], min_diffusivity)
+            for r in range(3):
+                evecs[v, r, k] = v_eig[r, 2 - k]
+
+        Dc = np.zeros((3, 3))
+        for k in range(3):
+            for r in range(3):
+                for c in range(3):
+                    Dc[r, c] += evals[v, k] * evecs[v, r, k] * evecs[v, c, k]
+        tensor[v, 0] = Dc[0, 0]
+        tensor[v, 1] = Dc[0, 1]
+        tensor[v, 2] = Dc[1, 1]
+        tensor[v, 3] = Dc[0, 2]
+        tensor[v, 4] = Dc[1, 2]
+        tensor[v, 5] = Dc[2, 2]
+
+        # Residual of the prediction from the clipped tensor
+        sse = 0.
+        sum_d = 0.
+        sum_p = 0.
+        sum_dd = 0.
+        sum_pp = 0.
+        sum_dp = 0.
+        for g in range(n_vols):
+            lin = 0.
+            for i in range(6):
+                lin += X[g, i] * tensor[v, i]
+            pred = S0[v] * np.exp(lin)
+            d = np.float64(data[v, g])
+            residual[v, g] = d - pred
+            sse += (d - pred) ** 2
+            sum_d += d
+            sum_p += pred
+            sum_dd += d * d
+            sum_pp += pred * pred
+            sum_dp += d * pred
+
+        ev1 = evals[v, 0]
+        ev2 = evals[v, 1]
+        ev3 = evals[v, 2]
+        norm = ev1 * ev1 + ev2 * ev2 + ev3 * ev3
+        if norm > 0:
+            maps[v, 0] = min(max(np.sqrt(0.5 * ((ev1 - ev2) ** 2 + (ev2 - ev3) ** 2 + (ev3 - ev1) ** 2) / norm), 0.), 1.)
+        maps[v, 1] = (ev1 + ev2 + ev3) / 3
+        maps[v, 2] = (ev2 + ev3) / 2
+        maps[v, 3] = ev1
+        maps[v, 4] = sse / n_vols
+        cov = sum_dp - sum_d * sum_p / n_vols
+        var = (sum_dd - sum_d * sum_d / n_vols) * (sum_pp - sum_p * sum_p / n_vols)
+        if var > 0:
+            maps[v, 5] = cov * cov / var
+
+
+def fit_dti(data, bvals, bvecs, mask=None, b0_threshold=50, fit_method="WLS", nlls_iter=20, core_count=1,
+            min_signal=1e-4):
+    """
+    Fits the diffusion tensor on the masked voxels only, with multi-threaded numba kernels. The eigen decomposition,
+    scalar maps and residuals are computed in the same pass. The WLS fit reproduces dipy's TensorModel (OLS estimates
+    used as weights, eigenvalues clipped to 1e-6 / max(b)), the NLLS fit refines the WLS estimates with
+    Levenberg-Marquardt iterations on the signal. Voxels whose fit is not finite are set to NaN.
+
+    :param data: 4-D array. Diffusion data of shape (x,y,z,n).
+    :param bvals: 1-D array of the b-values.
+    :param bvecs: 2-D array of shape (n,3) of the gradient directions.
+    :param mask: 3-D array, optional. Voxels to fit, other voxels are set to zero. The default is None (all voxels).
+    :param b0_threshold: b-values below this threshold are considered as b0. default=50
+    :param fit_method: Either "WLS" or "NLLS". default="WLS"
+    :param nlls_iter: Maximum number of Levenberg-Marquardt iterations of the NLLS fit. default=20
+    :param core_count: Number of threads used by the kernels. default=1
+    :param min_signal: Signal values are clipped to this minimum before taking the log. default=1e-4
+    :return: Dictionary of float32 volumes: FA, MD, RD, AD, evals (x,y,z,3), evecs (x,y,z,3,3), dtensor (x,y,z,3,3),
+        residual (x,y,z,n), MSE, R2 and fargb (x,y,z,3).
+    """
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.dti import design_matrix
+
+    assert fit_method in ["WLS", "NLLS"], "fit_method must be either WLS or NLLS"
+
+    shape = data.shape[:-1]
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+    else:
+        mask = mask.astype(bool)
+
+    gtab = gradient_table(bvals, bvecs=bvecs, b0_threshold=b0_threshold)
+    X = np.ascontiguousarray(design_matrix(gtab), dtype=np.float64)
+    pinvX = np.ascontiguousarray(np.linalg.pinv(X))
+    min_diffusivity = 1e-6 / -X.min()
+
+    voxels = np.ascontiguousarray(data[mask])
+    S0 = voxels[:, 0].astype(np.float64)
+    n_vox = voxels.shape[0]
+
+    evals = np.zeros((n_vox, 3))
+    evecs = np.zeros((n_vox, 3, 3))
+    tensor = np.zeros((n_vox, 6))
+    residual = np.zeros((n_vox, voxels.shape[1]), dtype=np.float32)
+    maps = np.zeros((n_vox, 6))
+
+    previous_threads = numba.get_num_threads()
+    numba.set_num_threads(numba_threads(core_count))
+    try:
+        _dti_kernel(X, pinvX, voxels, S0, min_signal, min_diffusivity, nlls_iter if fit_method == "NLLS" else 0,
+                    evals, evecs, tensor, residual, maps)
+    finally:
+        numba.set_num_threads(previous_threads)
+
+    def to_volume(values):
+        volume = np.zeros(shape + values.shape[1:], dtype=np.float32)
+        volume[mask] = values
+        return volume
+
+    quadratic_form = tensor[:, [0, 1, 3, 1, 2, 4, 3, 4, 5]].reshape((n_vox, 3, 3))
+    FA = to_volume(maps[:, 0])
+    fit = {"FA": FA, "MD": to_volume(maps[:, 1]), "RD": to_volume(maps[:, 2]), "AD": to_volume(maps[:, 3]),
+           "MSE": to_volume(maps[:, 4]), "R2": to_volume(maps[:, 5]), "evals": to_volume(evals),
+           "evecs": to_volume(evecs), "dtensor": to_volume(quadratic_form), "residual": to_volume(residual)}
+    fit["fargb"] = np.abs(fit["evecs"][..., 0]) * FA[..., np.newaxis]
+
+    return fit
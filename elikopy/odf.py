@@ -0,0 +1,569 @@
+"""
+ Orientation distribution function (ODF) estimation helpers.
+"""
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+
+from elikopy.resources import cpu_allowance, thread_exports
+
+
+_csd_worker_state = {}
+
+
+def _init_csd_worker(model, sphere, invB, peaks_kwargs, voxels_path, outputs_paths):
+    """
+    Initializer of the CSD worker processes. The model and the paths of the shared memory-mapped arrays are only
+    transferred once per worker instead of once per chunk.
+    """
+    _csd_worker_state["model"] = model
+    _csd_worker_state["sphere"] = sphere
+    _csd_worker_state["invB"] = invB
+    _csd_worker_state["peaks_kwargs"] = peaks_kwargs
+    _csd_worker_state["voxels"] = np.load(voxels_path, mmap_mode='r')
+    _csd_worker_state["outputs"] = {name: np.load(path, mmap_mode='r+') for name, path in outputs_paths.items()}
+
+
+def _fit_csd_chunk(start, stop):
+    """
+    Fits the CSD model on the masked voxels [start:stop[ and writes the SH coefficients, ODF and peaks of the chunk
+    directly in the shared output arrays.
+
+    :return: The maximum peak (or ODF) value of the chunk, used to normalise the QA over the whole volume.
+    """
+    from dipy.direction.peaks import peak_directions
+    from dipy.reconst.odf import gfa
+
+    model = _csd_worker_state["model"]
+    sphere = _csd_worker_state["sphere"]
+    invB = _csd_worker_state["invB"]
+    kwargs = _csd_worker_state["peaks_kwargs"]
+    outputs = _csd_worker_state["outputs"]
+    npeaks = kwargs["npeaks"]
+
+    chunk = np.asarray(_csd_worker_state["voxels"][start:stop])
+    odfs = np.asarray(model.fit(chunk).odf(sphere)).reshape((stop - start, len(sphere.vertices)))
+
+    n_vox = stop - start
+    gfa_chunk = np.zeros(n_vox)
+    qa_chunk = np.zeros((n_vox, npeaks))
+    peak_dirs = np.zeros((n_vox, npeaks, 3))
+    peak_values = np.zeros((n_vox, npeaks))
+    peak_indices = np.full((n_vox, npeaks), -1, dtype=np.int32)
+
+    chunk_max = -np.inf
+    for i in range(n_vox):
+        odf = odfs[i]
+        gfa_chunk[i] = gfa(odf)
+        if gfa_chunk[i] < kwargs["gfa_thr"]:
+            chunk_max = max(chunk_max, odf.max())
+            continue
+
+        direction, pk, ind = peak_directions(odf, sphere,
+                                             relative_peak_threshold=kwargs["relative_peak_threshold"],
+                                             min_separation_angle=kwargs["min_separation_angle"])
+        if pk.shape[0] != 0:
+            chunk_max = max(chunk_max, pk[0])
+            n = min(npeaks, pk.shape[0])
+            qa_chunk[i, :n] = pk[:n] - odf.min()
+            peak_dirs[i, :n] = direction[:n]
+            peak_indices[i, :n] = ind[:n]
+            peak_values[i, :n] = pk[:n]
+            if kwargs["normalize_peaks"]:
+                peak_values[i, :n] = peak_values[i, :n] / pk[0] if pk[0] != 0 else 0
+                peak_dirs[i] *= peak_values[i][:, None]
+
+    outputs["shm_coeff"][start:stop] = np.dot(odfs, invB)
+    outputs["gfa"][start:stop] = gfa_chunk
+    outputs["qa"][start:stop] = qa_chunk
+    outputs["peak_dirs"][start:stop] = peak_dirs
+    outputs["peak_values"][start:stop] = peak_values
+    outputs["peak_indices"][start:stop] = peak_indices
+    if "odf" in outputs:
+        outputs["odf"][start:stop] = odfs
+    for out in outputs.values():
+        out.flush()
+
+    return chunk_max
+
+
+def csd_peaks_parallel(model, data, sphere, mask=None, npeaks=5, relative_peak_threshold=.5,
+                       min_separation_angle=25, normalize_peaks=False, gfa_thr=0, return_odf=False, sh_order=8,
+                       core_count=1, chunk_size=2000, tmp_dir=None):
+    """
+    Chunked and parallel equivalent of dipy's peaks_from_model for CSD-like models. The masked voxels are written once
+    to a memory-mapped array shared read-only by core_count worker processes. Each worker fits its chunks and writes the
+    SH coefficients, peaks (and optionally ODF) incrementally in memory-mapped output arrays, so that only the masked
+    voxels are ever held in memory by the workers.
+
+    :param model: The reconstruction model (e.g. ConstrainedSphericalDeconvModel).
+    :param data: 4-D array. Diffusion data of shape (x,y,z,n).
+    :param sphere: Sphere on which the ODF are evaluated.
+    :param mask: 3-D array, optional. Voxels to fit. The default is None (all voxels).
+    :param npeaks: Maximum number of peaks found per voxel. default=5
+    :param relative_peak_threshold: Only return peaks greater than relative_peak_threshold * max_peak. default=0.5
+    :param min_separation_angle: Minimum angle (in degrees) between two peaks. default=25
+    :param normalize_peaks: If true, all peak values are calculated relative to max(odf). default=False
+    :param gfa_thr: Voxels with gfa less than gfa_thr are skipped. default=0
+    :param return_odf: If true, the odf sampled on the sphere is returned. default=False
+    :param sh_order: Order of the spherical harmonics of the returned ODF coefficients. default=8
+    :param core_count: Number of worker processes. default=1
+    :param chunk_size: Number of voxels processed per task. default=2000
+    :param tmp_dir: Directory where the shared memory-mapped arrays are stored. default=system temporary directory
+    :return: A dipy PeaksAndMetrics object, as returned by peaks_from_model.
+    """
+    from dipy.direction.peaks import PeaksAndMetrics
+    from dipy.reconst.shm import sh_to_sf_matrix
+
+    shape = data.shape[:-1]
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+    else:
+        mask = mask.astype(bool)
+        if mask.shape != shape:
+            raise ValueError("Mask is not the same shape as data.")
+
+    B, invB = sh_to_sf_matrix(sphere, sh_order=sh_order, basis_type=None, return_inv=True, legacy=True)
+    n_coeffs = B.shape[0]
+    n_vox = int(np.count_nonzero(mask))
+
+    peaks_kwargs = {"npeaks": npeaks, "relative_peak_threshold": relative_peak_threshold,
+                    "min_separation_angle": min_separation_angle, "normalize_peaks": normalize_peaks,
+                    "gfa_thr": gfa_thr}
+
+    outputs_specs = {"shm_coeff": ((n_vox, n_coeffs), np.float64),
+                     "gfa": ((n_vox,), np.float64),
+                     "qa": ((n_vox, npeaks), np.float64),
+                     "peak_dirs": ((n_vox, npeaks, 3), np.float64),
+                     "peak_values": ((n_vox, npeaks), np.float64),
+                     "peak_indices": ((n_vox, npeaks), np.int32)}
+    if return_odf:
+        outputs_specs["odf"] = ((n_vox, len(sphere.vertices)), np.float64)
+
+    work_dir = tempfile.mkdtemp(prefix="elikopy_csd_", dir=tmp_dir)
+    try:
+        voxels_path = os.path.join(work_dir, "voxels.npy")
+        voxels = np.lib.format.open_memmap(voxels_path, mode='w+', dtype=data.dtype, shape=(n_vox, data.shape[-1]))
+        voxels[:] = data[mask]
+        voxels.flush()
+        del voxels
+
+        outputs_paths = {}
+        for name, (out_shape, out_dtype) in outputs_specs.items():
+            outputs_paths[name] = os.path.join(work_dir, name + ".npy")
+            out = np.lib.format.open_memmap(outputs_paths[name], mode='w+', dtype=out_dtype, shape=out_shape)
+            if name == "peak_indices":
+                out[:] = -1
+            out.flush()
+            del out
+
+        chunk_size = max(1, int(chunk_size))
+        chunks = [(start, min(start + chunk_size, n_vox)) for start in range(0, n_vox, chunk_size)]
+        initargs = (model, sphere, invB, peaks_kwargs, voxels_path, outputs_paths)
+
+        if core_count > 1 and len(chunks) > 1:
+            from elikopy.resources import process_pool
+            with process_pool(min(core_count, len(chunks)), initializer=_init_csd_worker,
+                              initargs=initargs) as executor:
+                chunks_max = list(executor.map(_fit_csd_chunk, *zip(*chunks)))
+        else:
+            _init_csd_worker(*initargs)
+            try:
+                chunks_max = [_fit_csd_chunk(start, stop) for start, stop in chunks]
+            finally:
+                _csd_worker_state.clear()
+
+        global_max = max(chunks_max) if len(chunks_max) > 0 else -np.inf
+
+        volumes = {}
+        for name, (out_shape, out_dtype) in outputs_specs.items():
+            values = np.load(outputs_paths[name], mmap_mode='r')
+            volume = np.full(shape + out_shape[1:], -1 if name == "peak_indices" else 0, dtype=out_dtype)
+            volume[mask] = values
+            volumes[name] = volume
+            del values
+        volumes["qa"] /= global_max
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    pam = PeaksAndMetrics()
+    pam.sphere = sphere
+    pam.peak_dirs = volumes["peak_dirs"]
+    pam.peak_values = volumes["peak_values"]
+    pam.peak_indices = volumes["peak_indices"]
+    pam.gfa = volumes["gfa"]
+    pam.qa = volumes["qa"]
+    pam.shm_coeff = volumes["shm_coeff"]
+    pam.B = B
+    pam.odf = volumes["odf"] if return_odf else None
+
+    return pam
+
+
+def anisotropic_power_map(data, gtab, mask=None, sh_order=8, smooth=0.006, min_signal=1e-5, norm_factor=1e-5,
+                          chunk_size=100000):
+    """
+    Computes the anisotropic power map of dipy's shm.anisotropic_power directly from the diffusion data. The SH
+    coefficients of the Q-ball model are fitted with a single matrix product per chunk of masked voxels and reduced to
+    the anisotropic power right away, instead of going through peaks_from_model which also searches the peaks of every
+    voxel on the sphere.
+
+    :param data: 4-D array. Diffusion data of shape (x,y,z,n).
+    :param gtab: GradientTable of the data.
+    :param mask: 3-D array, optional. Voxels to fit, the other voxels are set to 0. The default is None (all voxels).
+    :param sh_order: Maximal order of the spherical harmonics. default=8
+    :param smooth: Laplace-Beltrami regularisation of the Q-ball fit. default=0.006
+    :param min_signal: Signal values below min_signal are clipped before normalisation by the mean b0. default=1e-5
+    :param norm_factor: Normalisation factor of the log of the anisotropic power. default=1e-5
+    :param chunk_size: Number of voxels processed at once. default=100000
+    :return: 3-D float32 array. Anisotropic power map, as shm.anisotropic_power(peaks.shm_coeff).
+    """
+    from dipy.reconst.shm import QballModel, anisotropic_power
+
+    shape = data.shape[:-1]
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+    else:
+        mask = mask.astype(bool)
+        if mask.shape != shape:
+            raise ValueError("Mask is not the same shape as data.")
+
+    model = QballModel(gtab, sh_order, smooth=smooth, min_signal=min_signal)
+    voxels = np.flatnonzero(mask)
+    flat_data = data.reshape((-1, data.shape[-1]))
+
+    ap = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    for start in range(0, voxels.size, chunk_size):
+        idx = voxels[start:start + chunk_size]
+        coef = model.fit(flat_data[idx]).shm_coeff
+        ap[idx] = anisotropic_power(coef, norm_factor=norm_factor)
+    return ap.reshape(shape)
+
+
+def load_csd_data(folder_path, p, CSD_bvalue=None):
+    """
+    Loads the preprocessed diffusion data of a subject and selects the volumes used by the single-shell CSD.
+
+    :param folder_path: the path to the root directory.
+    :param p: The name of the patient.
+    :param CSD_bvalue: If not None, only the b0 and the volumes at this b-value (+/- 5) are kept. default=None
+    :return: data_CSD, gtab_CSD, affine
+    """
+    from elikopy.storage import load_nifti
+    from dipy.io import read_bvals_bvecs
+    from dipy.core.gradients import gradient_table
+
+    preproc_prefix = folder_path + '/subjects/' + p + '/dMRI/preproc/' + p + "_dmri_preproc"
+    data, affine = load_nifti(preproc_prefix + ".nii.gz")
+    bvals, bvecs = read_bvals_bvecs(preproc_prefix + ".bval", preproc_prefix + ".bvec")
+
+    b0_threshold = np.min(bvals) + 10
+    b0_threshold = max(50, b0_threshold)
+
+    if CSD_bvalue is not None:
+        print("Max CSD bvalue is", CSD_bvalue)
+        sel_b = np.logical_or(bvals == 0, np.logical_and((CSD_bvalue - 5) <= bvals, bvals <= (CSD_bvalue + 5)))
+        data_CSD = data[..., sel_b]
+        gtab_CSD = gradient_table(bvals[sel_b], bvecs[sel_b], b0_threshold=b0_threshold)
+    else:
+        data_CSD = data
+        gtab_CSD = gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
+
+    return data_CSD, gtab_CSD, affine
+
+
+def _file_signature(path):
+    """
+    Returns a small signature (size and modification time) of a file, used to invalidate cached results.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _atomic_write_json(path, content):
+    """
+    Writes a json file through a temporary file renamed at the end, so that concurrent readers never see a partially
+    written file.
+    """
+    tmp_path = path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _atomic_copy(src, dst):
+    """
+    Copies a file through a temporary file renamed at the end.
+    """
+    tmp_path = dst + ".tmp" + str(os.getpid())
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class ResponseRegistry:
+    r'''
+    Study-level registry of the response functions used by the CSD and MSMT-CSD ODF steps. Responses are stored in
+    <folder_path>/responses/<scheme_key>/ where scheme_key is the canonical hash of the shell structure of the subjects
+    (see elikopy.utils.get_acquisition_scheme_key). The registry caches the per-subject responses, so that re-running
+    an ODF step with different parameters does not recompute them, and computes group-averaged responses shared by all
+    the subjects of a given acquisition scheme.
+    '''
+
+    def __init__(self, folder_path):
+        """ Creates the registry of the study.
+
+        :param folder_path: the path to the root directory.
+        """
+        self.folder_path = folder_path
+        self.registry_path = os.path.join(folder_path, "responses")
+
+    def scheme_key(self, p):
+        """ Returns the acquisition scheme key of the preprocessed data of a subject. The key only depends on the shells
+        of the acquisition: the directions of the preprocessed data are rotated by eddy for the motion of each subject,
+        keying on them would split the subjects of a protocol into many small groups.
+
+        :param p: The name of the patient.
+        """
+        from dipy.io import read_bvals_bvecs
+        from elikopy.utils import get_acquisition_scheme_key
+
+        preproc_prefix = self.folder_path + '/subjects/' + p + '/dMRI/preproc/' + p + "_dmri_preproc"
+        bvals, bvecs = read_bvals_bvecs(preproc_prefix + ".bval", preproc_prefix + ".bvec")
+
+        return get_acquisition_scheme_key(bvals, bvecs, directions=False)
+
+    def _scheme_path(self, scheme_key):
+        scheme_path = os.path.join(self.registry_path, scheme_key)
+        os.makedirs(os.path.join(scheme_path, "subjects"), exist_ok=True)
+        return scheme_path
+
+    def _preproc_path(self, p):
+        return self.folder_path + '/subjects/' + p + '/dMRI/preproc/' + p + "_dmri_preproc.nii.gz"
+
+    @staticmethod
+    def _csd_tag(CSD_bvalue, fa_thr, roi_radii):
+        return "CSD_b" + str(CSD_bvalue) + "_fa" + str(fa_thr) + "_r" + str(roi_radii)
+
+    # ------------------------------------------------------------------ CSD
+
+    def get_subject_csd_response(self, p, gtab_CSD=None, data_CSD=None, CSD_bvalue=None, fa_thr=0.7, roi_radii=10,
+                                 recompute=False):
+        """ Returns the single-shell CSD response of a subject, estimated with auto_response_ssst. The response is
+        cached in the registry and only recomputed if the preprocessed data changed.
+
+        :param p: The name of the patient.
+        :param gtab_CSD: Gradient table of data_CSD. If None, the data is loaded with load_csd_data. default=None
+        :param data_CSD: 4-D array of the data used for the CSD. default=None
+        :param CSD_bvalue: b-value used to select the CSD volumes. default=None
+        :param fa_thr: FA threshold used to select the single fiber voxels. default=0.7
+        :param roi_radii: Radii of the cuboid ROI used to estimate the response. default=10
+        :param recompute: If True, ignore the cached response. default=False
+        :return: response, a tuple (evals, S0) as returned by auto_response_ssst.
+        """
+        from dipy.reconst.csdeconv import auto_response_ssst
+
+        scheme_path = self._scheme_path(self.scheme_key(p))
+        cache_path = os.path.join(scheme_path, "subjects", p + "_" + self._csd_tag(CSD_bvalue, fa_thr, roi_radii) + ".json")
+        signature = _file_signature(self._preproc_path(p))
+
+        if not recompute and os.path.isfile(cache_path):
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            if cached.get("signature") == signature:
+                return np.array(cached["evals"]), cached["S0"]
+
+        if data_CSD is None or gtab_CSD is None:
+            data_CSD, gtab_CSD, _ = load_csd_data(self.folder_path, p, CSD_bvalue=CSD_bvalue)
+
+        response, ratio = auto_response_ssst(gtab_CSD, data_CSD, roi_radii=roi_radii, fa_thr=fa_thr)
+        evals, S0 = response
+
+        _atomic_write_json(cache_path, {"evals": [float(e) for e in evals], "S0": float(S0), "ratio": float(ratio),
+                                        "signature": signature})
+
+        return np.array(evals), float(S0)
+
+    def compute_group_csd_response(self, patient_list, CSD_bvalue=None, fa_thr=0.7, roi_radii=10):
+        """ Computes (or reuses) the response of every subject and stores, for each acquisition scheme, the average
+        response of its subjects.
+
+        :param patient_list: List of the subjects to include in the group response.
+        :param CSD_bvalue: b-value used to select the CSD volumes. default=None
+        :param fa_thr: FA threshold used to select the single fiber voxels. default=0.7
+        :param roi_radii: Radii of the cuboid ROI used to estimate the response. default=10
+        :return: Dictionary mapping each scheme key to its group response (evals, S0).
+        """
+        responses = {}
+        for p in patient_list:
+            key = self.scheme_key(p)
+            responses.setdefault(key, {})[p] = self.get_subject_csd_response(p, CSD_bvalue=CSD_bvalue, fa_thr=fa_thr,
+                                                                            roi_radii=roi_radii)
+
+        group_responses = {}
+        for key, subjects_responses in responses.items():
+            evals = np.mean([r[0] for r in subjects_responses.values()], axis=0)
+            S0 = float(np.mean([r[1] for r in subjects_responses.values()]))
+            group_path = os.path.join(self._scheme_path(key),
+                                      "group_" + self._csd_tag(CSD_bvalue, fa_thr, roi_radii) + ".json")
+            _atomic_write_json(group_path, {"evals": [float(e) for e in evals], "S0": S0,
+                                            "subjects": sorted(subjects_responses.keys())})
+            group_responses[key] = (evals, S0)
+
+        return group_responses
+
+    def get_group_csd_response(self, p, CSD_bvalue=None, fa_thr=0.7, roi_radii=10):
+        """ Returns the group CSD response of the acquisition scheme of a subject. The group response must have been
+        computed beforehand with compute_group_csd_response.
+
+        :param p: The name of the patient.
+        :return: response, a tuple (evals, S0).
+        """
+        group_path = os.path.join(self._scheme_path(self.scheme_key(p)),
+                                  "group_" + self._csd_tag(CSD_bvalue, fa_thr, roi_radii) + ".json")
+        if not os.path.isfile(group_path):
+            raise FileNotFoundError("No group CSD response available for the acquisition scheme of " + p +
+                                    ", compute it first with compute_group_csd_response")
+        with open(group_path, "r") as f:
+            group = json.load(f)
+
+        return np.array(group["evals"]), group["S0"]
+
+    # ------------------------------------------------------------- MSMT-CSD
+
+    def get_subject_msmt_response(self, p, core_count=1, log_file=None, recompute=False):
+        """ Returns the paths of the WM, GM and CSF dhollander responses of a subject. The responses are estimated
+        with dwi2response and cached in the registry.
+
+        :param p: The name of the patient.
+        :param core_count: Number of threads given to dwi2response. default=1
+        :param log_file: Opened file receiving the output of dwi2response. default=None
+        :param recompute: If True, ignore the cached response. default=False
+        :return: List of the paths of the WM, GM and CSF response files.
+        """
+        scheme_path = self._scheme_path(self.scheme_key(p))
+        prefix = os.path.join(scheme_path, "subjects", p + "_dhollander_")
+        paths = [prefix + tissue + "_response.txt" for tissue in ("WM", "GM", "CSF")]
+        signature_path = prefix + "signature.json"
+        signature = _file_signature(self._preproc_path(p))
+
+        if not recompute and all(os.path.isfile(path) for path in paths) and os.path.isfile(signature_path):
+            with open(signature_path, "r") as f:
+                if json.load(f).get("signature") == signature:
+                    return paths
+
+        preproc_prefix = self.folder_path + '/subjects/' + p + '/dMRI/preproc/' + p + "_dmri_preproc"
+        tmp_paths = [path + ".tmp" + str(os.getpid()) + ".txt" for path in paths]
+        threads = cpu_allowance(core_count)
+        bashCommand = thread_exports(threads) + \
+                      'dwi2response dhollander -info -nthreads ' + str(threads) + ' -fslgrad ' + \
+                      preproc_prefix + ".bvec " + preproc_prefix + ".bval " + preproc_prefix + ".nii.gz " + \
+                      " ".join(tmp_paths) + " -force ; "
+
+        process = subprocess.Popen(bashCommand, universal_newlines=True, shell=True, stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        process.communicate()
+        if process.returncode != 0 or not all(os.path.isfile(path) for path in tmp_paths):
+            raise RuntimeError("dwi2response failed for patient " + p)
+
+        for tmp_path, path in zip(tmp_paths, paths):
+            os.replace(tmp_path, path)
+        _atomic_write_json(signature_path, {"signature": signature})
+
+        return paths
+
+    def compute_group_msmt_response(self, patient_list, core_count=1, log_file=None):
+        """ Computes (or reuses) the dhollander responses of every subject and stores, for each acquisition scheme,
+        the group responses obtained with the MRtrix responsemean command.
+
+        :param patient_list: List of the subjects to include in the group response.
+        :param core_count: Number of threads given to dwi2response. default=1
+        :param log_file: Opened file receiving the output of the MRtrix commands. default=None
+        :return: Dictionary mapping each scheme key to the paths of its WM, GM and CSF group responses.
+        """
+        responses = {}
+        for p in patient_list:
+            responses.setdefault(self.scheme_key(p), []).append(
+                self.get_subject_msmt_response(p, core_count=core_count, log_file=log_file))
+
+        group_responses = {}
+        for key, subjects_paths in responses.items():
+            scheme_path = self._scheme_path(key)
+            group_paths = []
+            for i, tissue in enumerate(("WM", "GM", "CSF")):
+                group_path = os.path.join(scheme_path, "group_dhollander_" + tissue + "_response.txt")
+                tmp_path = group_path + ".tmp" + str(os.getpid()) + ".txt"
+                bashCommand = "responsemean " + " ".join(paths[i] for paths in subjects_paths) + " " + \
+                              tmp_path + " -force"
+                process = subprocess.Popen(bashCommand, universal_newlines=True, shell=True, stdout=log_file,
+                                           stderr=subprocess.STDOUT)
+                process.communicate()
+                if process.returncode != 0 or not os.path.isfile(tmp_path):
+                    raise RuntimeError("responsemean failed for the acquisition scheme " + key)
+                os.replace(tmp_path, group_path)
+                group_paths.append(group_path)
+            group_responses[key] = group_paths
+
+        return group_responses
+
+    def get_group_msmt_response(self, p):
+        """ Returns the paths of the WM, GM and CSF group responses of the acquisition scheme of a subject. The group
+        responses must have been computed beforehand with compute_group_msmt_response.
+
+        :param p: The name of the patient.
+        :return: List of the paths of the WM, GM and CSF group response files.
+        """
+        scheme_path = self._scheme_path(self.scheme_key(p))
+        paths = [os.path.join(scheme_path, "group_dhollander_" + tissue + "_response.txt")
+                 for tissue in ("WM", "GM", "CSF")]
+        if not all(os.path.isfile(path) for path in paths):
+            raise FileNotFoundError("No group MSMT-CSD response available for the acquisition scheme of " + p +
+                                    ", compute it first with compute_group_msmt_response")
+
+        return paths
+
+
+def check_response_scheme_key(seed=0, tmp_dir=None):
+    """
+    Checks that the response registry shares the responses between the subjects of a protocol: two subjects scanned
+    with the same b0/b1000/b2000 protocol, whose preprocessed directions were rotated differently by eddy (small
+    rotations of a few degrees), must obtain the same scheme key, while a subject with another protocol must not.
+
+    :param seed: Seed of the directions and of the rotations. default=0
+    :param tmp_dir: Directory of the temporary study. default=system temporary directory
+    :return: Dictionary of the scheme keys of the three subjects.
+    """
+    from scipy.spatial.transform import Rotation
+    from elikopy.utils import get_acquisition_scheme_key
+
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(60, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    bvals = np.concatenate([np.zeros(4), np.full(30, 1000.), np.full(30, 2000.)])
+    bvecs = np.concatenate([np.zeros((4, 3)), directions])
+    schemes = {"same_protocol_1": (bvals, Rotation.from_rotvec(rng.normal(0, 0.03, 3)).apply(bvecs)),
+               "same_protocol_2": (bvals + rng.normal(0, 5, len(bvals)) * (bvals > 0),
+                                   Rotation.from_rotvec(rng.normal(0, 0.03, 3)).apply(bvecs)),
+               "other_protocol": (np.where(bvals == 2000, 3000., bvals), bvecs)}
+
+    folder_path = tempfile.mkdtemp(prefix="elikopy_response_check_", dir=tmp_dir)
+    try:
+        for p, (b, v) in schemes.items():
+            preproc_path = folder_path + '/subjects/' + p + '/dMRI/preproc/'
+            os.makedirs(preproc_path)
+            np.savetxt(preproc_path + p + "_dmri_preproc.bval", b[np.newaxis], fmt="%.1f")
+            np.savetxt(preproc_path + p + "_dmri_preproc.bvec", v.T, fmt="%.6f")
+        registry = ResponseRegistry(folder_path)
+        keys = {p: registry.scheme_key(p) for p in schemes}
+    finally:
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+    rotated_keys = [get_acquisition_scheme_key(*schemes[p], ordered=False)
+                    for p in ("same_protocol_1", "same_protocol_2")]
+    assert rotated_keys[0] != rotated_keys[1], "the rotations must change the directions"
+    assert keys["same_protocol_1"] == keys["same_protocol_2"], "subjects of the same protocol have different keys"
+    assert keys["same_protocol_1"] != keys["other_protocol"], "subjects of different protocols share a key"
+    return keys
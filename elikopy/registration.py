@@ -5,7 +5,7 @@ import numpy as np
 import nibabel as nib
 from dipy.viz import regtools
 from dipy.segment.mask import applymask
-from dipy.io.image import load_nifti
+from elikopy.storage import load_nifti, save_nifti, get_data, upcast, load_image
 from dipy.align.imaffine import (transform_centers_of_mass,
                                  AffineMap,
                                  MutualInformationMetric,
@@ -21,8 +21,398 @@ import pickle
 from elikopy.utils import get_patient_ref
 
 
+MAPPING_STORE_VERSION = 1
+
+
+def _matrix(value):
+    return None if value is None else np.asarray(value, dtype=np.float64).tolist()
+
+
+def _shape(value):
+    return None if value is None else [int(v) for v in value]
+
+
+def _source_stamps(files):
+    return [[os.path.abspath(f), os.path.getmtime(f), os.path.getsize(f)] for f in files]
+
+
+def save_mapping(mapping, path, sources=None):
+    '''
+    Saves an AffineMap or a DiffeomorphicMap in the mapping store: a directory <path>.map holding mapping.json (format
+    version, kind, shapes and grid-to-world matrices of the domain, codomain and displacement grids, prealign) and, for
+    diffeomorphic maps, the forward and backward displacement fields as float32 .npy files. The directory is written
+    next to its final location and renamed, so that an interrupted write never leaves a partial mapping.
+
+    :param mapping: AffineMap or DiffeomorphicMap.
+    :param path: Path of the mapping without extension (e.g. reg/mapping_DWI_B0_to_T1).
+    :param sources: Images the mapping was computed from. Their path, modification time and size are recorded, so that
+        mapping_exists(path, sources) detects a mapping computed from older versions of these images. default=None
+    '''
+    import json
+    import shutil
+
+    info = {"version": MAPPING_STORE_VERSION,
+            "domain_shape": _shape(mapping.domain_shape), "domain_grid2world": _matrix(mapping.domain_grid2world),
+            "codomain_shape": _shape(mapping.codomain_shape),
+            "codomain_grid2world": _matrix(mapping.codomain_grid2world)}
+    if sources is not None:
+        info["sources"] = _source_stamps(sources)
+    store_path = path + ".map"
+    tmp_path = store_path + ".tmp" + str(os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    if isinstance(mapping, AffineMap):
+        info.update({"kind": "affine", "affine": _matrix(mapping.affine)})
+    else:
+        info.update({"kind": "diffeomorphic", "dim": int(mapping.dim), "disp_shape": _shape(mapping.disp_shape),
+                     "disp_grid2world": _matrix(mapping.disp_grid2world), "prealign": _matrix(mapping.prealign),
+                     "is_inverse": bool(mapping.is_inverse), "dtype": "float32"})
+        np.save(os.path.join(tmp_path, "forward.npy"), np.asarray(mapping.forward, dtype=np.float32))
+        np.save(os.path.join(tmp_path, "backward.npy"), np.asarray(mapping.backward, dtype=np.float32))
+    with open(os.path.join(tmp_path, "mapping.json"), "w") as f:
+        json.dump(info, f)
+    # the previous store is moved aside rather than removed, so that a crash between the two renames leaves a complete
+    # mapping (restored by _recover_store)
+    _recover_store(store_path)
+    old_path = store_path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.isdir(store_path):
+        os.rename(store_path, old_path)
+    os.rename(tmp_path, store_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def _recover_store(store_path):
+    '''
+    Restores the previous version of a mapping store when save_mapping was interrupted after moving it aside.
+    '''
+    if not os.path.isdir(store_path) and os.path.isfile(os.path.join(store_path + ".old", "mapping.json")):
+        os.rename(store_path + ".old", store_path)
+
+
+def mapping_exists(path, sources=None):
+    '''
+    Whether a mapping was saved at path, in the mapping store or as a legacy pickle (<path>.p).
+
+    :param sources: If given, the mapping must also have been saved from these images (see save_mapping), none of which
+        was modified since. default=None
+    '''
+    _recover_store(path + ".map")
+    if sources is not None:
+        recorded = mapping_sources(path)
+        return recorded is not None and recorded == _source_stamps(sources)
+    return os.path.isfile(os.path.join(path + ".map", "mapping.json")) or os.path.isfile(path + ".p")
+
+
+def mapping_sources(path):
+    '''
+    Returns the source images recorded by save_mapping ([path, modification time, size] of each image), or None if the
+    mapping is not in the store or was saved without its sources.
+    '''
+    import json
+
+    _recover_store(path + ".map")
+    try:
+        with open(os.path.join(path + ".map", "mapping.json")) as f:
+            return json.load(f).get("sources")
+    except FileNotFoundError:
+        return None
+
+
+def mapping_is_current(path):
+    '''
+    Whether the mapping was saved with its sources and none of them changed since.
+    '''
+    recorded = mapping_sources(path)
+    if recorded is None:
+        return False
+    try:
+        return recorded == _source_stamps([source[0] for source in recorded])
+    except OSError:
+        return False
+
+
+def load_mapping(path, mmap=True):
+    '''
+    Loads a mapping saved by save_mapping. The displacement fields are memory-mapped unless mmap is False (copy-on-write,
+    as the warping functions of dipy require writable buffers).
+    A legacy pickle <path>.p is loaded instead if the mapping is not in the store, and converted to the store.
+
+    :param path: Path of the mapping without extension.
+    :param mmap: Memory-map the displacement fields. default=True
+    :return: AffineMap or DiffeomorphicMap.
+    '''
+    import json
+    from dipy.align.imwarp import DiffeomorphicMap
+
+    store_path = path + ".map"
+    _recover_store(store_path)
+    if not os.path.isfile(os.path.join(store_path, "mapping.json")):
+        with open(path + ".p", 'rb') as handle:
+            mapping = pickle.load(handle)
+        save_mapping(mapping, path)
+        return mapping
+
+    with open(os.path.join(store_path, "mapping.json")) as f:
+        info = json.load(f)
+    assert info["version"] <= MAPPING_STORE_VERSION, "Mapping " + store_path + " was saved by a newer version"
+
+    def matrix(name):
+        return None if info[name] is None else np.array(info[name])
+
+    if info["kind"] == "affine":
+        return AffineMap(matrix("affine"), domain_grid_shape=info["domain_shape"],
+                         domain_grid2world=matrix("domain_grid2world"), codomain_grid_shape=info["codomain_shape"],
+                         codomain_grid2world=matrix("codomain_grid2world"))
+    mapping = DiffeomorphicMap(info["dim"], info["disp_shape"], disp_grid2world=matrix("disp_grid2world"),
+                               domain_shape=info["domain_shape"], domain_grid2world=matrix("domain_grid2world"),
+                               codomain_shape=info["codomain_shape"],
+                               codomain_grid2world=matrix("codomain_grid2world"), prealign=matrix("prealign"))
+    mmap_mode = 'c' if mmap else None
+    mapping.forward = np.load(os.path.join(store_path, "forward.npy"), mmap_mode=mmap_mode)
+    mapping.backward = np.load(os.path.join(store_path, "backward.npy"), mmap_mode=mmap_mode)
+    mapping.is_inverse = info["is_inverse"]
+    return mapping
+
+
+class RegistrationTemplate:
+    '''
+    Static side of the registrations to a common template (e.g. the MNI T1 or FA). The template volume, its center of
+    mass and the normalised scale spaces of the affine and diffeomorphic optimisations are computed once and shared by
+    every getTransform call using this template in the process, instead of being rebuilt for each optimisation stage of
+    each subject.
+
+    :param static_volume_file: Path to the template volume.
+    '''
+
+    def __init__(self, static_volume_file):
+        static, static_affine = load_nifti(static_volume_file)
+        self.static = upcast(static)
+        self.grid2world = static_affine
+        self._center_of_mass = None
+        self._scale_spaces = {}
+
+    @property
+    def center_of_mass(self):
+        '''World coordinates of the center of mass of the template.'''
+        if self._center_of_mass is None:
+            from scipy import ndimage
+            center = np.array(ndimage.center_of_mass(np.array(self.static)) + (1,))
+            self._center_of_mass = self.grid2world.dot(center)[:3]
+        return self._center_of_mass
+
+    def matches(self, static, static_grid2world):
+        return static.shape == self.static.shape and np.array_equal(static_grid2world, self.grid2world)
+
+    def scale_space(self, key, build):
+        '''
+        Returns the scale space identified by key, calling build(static) to create it on first use.
+        '''
+        if key not in self._scale_spaces:
+            self._scale_spaces[key] = build(self.static)
+        return self._scale_spaces[key]
+
+
+_registration_templates = {}
+
+
+def get_registration_template(static_volume_file):
+    '''
+    Returns the RegistrationTemplate of a template volume, reusing the one already built in this process as long as the
+    file has not been modified. Only the two most recently used templates are kept in memory.
+
+    :param static_volume_file: Path to the template volume.
+    '''
+    path = os.path.abspath(static_volume_file)
+    key = (path, os.path.getmtime(path))
+    template = _registration_templates.pop(key, None)
+    if template is None:
+        template = RegistrationTemplate(path)
+    _registration_templates[key] = template
+    while len(_registration_templates) > 2:
+        del _registration_templates[next(iter(_registration_templates))]
+    return template
+
+
+def _normalise(image):
+    return (image.astype(np.float64) - np.min(image)) / (np.max(image) - np.min(image))
+
+
+def _private_hook_supported(cls, parameters, attributes=()):
+    '''
+    Whether the private _init_optimizer hook of a dipy registration class has the signature (and the class the
+    attributes) that the template registrations below were written against. Other dipy versions fall back to the plain
+    dipy classes.
+    '''
+    import inspect
+
+    hook = getattr(cls, "_init_optimizer", None)
+    if hook is None:
+        return False
+    try:
+        names = tuple(inspect.signature(hook).parameters)
+    except (TypeError, ValueError):
+        return False
+    return names == parameters and all(hasattr(cls, name) for name in attributes)
+
+
+class _TemplateAffineRegistration(AffineRegistration):
+    '''
+    AffineRegistration taking the scale space of the static image from a RegistrationTemplate, and keeping the scale
+    space of the moving image between the successive optimisations (translation, rigid, affine) of the same subject.
+    Falls back to AffineRegistration when masks are given or the static image is not the template.
+    '''
+
+    def __init__(self, template, **kwargs):
+        super().__init__(**kwargs)
+        self.template = template
+        self._moving = None
+
+    def _init_optimizer(self, static, moving, transform, params0, static_grid2world, moving_grid2world,
+                        starting_affine, static_mask, moving_mask):
+        if (static_mask is not None or moving_mask is not None or not self.use_isotropic
+                or not isinstance(starting_affine, np.ndarray) or not self.template.matches(static, static_grid2world)):
+            return super()._init_optimizer(static, moving, transform, params0, static_grid2world, moving_grid2world,
+                                           starting_affine, static_mask, moving_mask)
+        from dipy.align.imwarp import get_direction_and_spacings
+        from dipy.align.scalespace import IsotropicScaleSpace
+
+        self.dim = len(static.shape)
+        self.transform = transform
+        self.nparams = transform.get_number_of_parameters()
+        self.static_mask, self.moving_mask = None, None
+        self.params0 = self.transform.get_identity_parameters() if params0 is None else params0
+        self.starting_affine = starting_affine
+
+        def build(image, grid2world):
+            spacing = get_direction_and_spacings(grid2world, self.dim)[1]
+            return IsotropicScaleSpace(_normalise(image), self.factors, self.sigmas, image_grid2world=grid2world,
+                                       input_spacing=spacing, mask0=False)
+
+        key = ("affine", tuple(self.factors), tuple(self.sigmas))
+        self.static_ss = self.template.scale_space(key, lambda image: build(image, static_grid2world))
+        if self._moving is None or self._moving[0] is not moving or self._moving[1] != key:
+            self._moving = (moving, key, build(moving, moving_grid2world))
+        self.moving_ss = self._moving[2]
+
+
+class _TemplateDiffeomorphicRegistration(SymmetricDiffeomorphicRegistration):
+    '''
+    SymmetricDiffeomorphicRegistration taking the scale space of the static image from a RegistrationTemplate.
+    '''
+
+    def __init__(self, template, metric, level_iters=None, **kwargs):
+        super().__init__(metric, level_iters, **kwargs)
+        self.template = template
+
+    def _init_optimizer(self, static, moving, static_grid2world, moving_grid2world, prealign):
+        if not self.template.matches(static, static_grid2world):
+            return super()._init_optimizer(static, moving, static_grid2world, moving_grid2world, prealign)
+        from dipy.align.imwarp import get_direction_and_spacings, DiffeomorphicMap, floating
+        from dipy.align.scalespace import ScaleSpace
+
+        self._connect_functions()
+        static_direction, static_spacing = get_direction_and_spacings(static_grid2world, self.dim)
+        moving_direction, moving_spacing = get_direction_and_spacings(moving_grid2world, self.dim)
+        self.static_direction = np.eye(self.dim + 1)
+        self.moving_direction = np.eye(self.dim + 1)
+        self.static_direction[:self.dim, :self.dim] = static_direction
+        self.moving_direction[:self.dim, :self.dim] = moving_direction
+
+        self.moving_ss = ScaleSpace(moving, self.levels, image_grid2world=moving_grid2world,
+                                    input_spacing=moving_spacing, sigma_factor=self.ss_sigma_factor, mask0=self.mask0)
+        key = ("diffeomorphic", self.levels, self.ss_sigma_factor, self.mask0)
+        self.static_ss = self.template.scale_space(
+            key, lambda image: ScaleSpace(image.astype(floating), self.levels, image_grid2world=static_grid2world,
+                                          input_spacing=static_spacing, sigma_factor=self.ss_sigma_factor,
+                                          mask0=self.mask0))
+
+        disp_shape = self.static_ss.get_domain_shape(self.levels - 1)
+        disp_grid2world = self.static_ss.get_affine(self.levels - 1)
+        self.static_to_ref = DiffeomorphicMap(dim=self.dim, disp_shape=disp_shape, disp_grid2world=disp_grid2world,
+                                              domain_shape=static.shape, domain_grid2world=static_grid2world,
+                                              codomain_shape=static.shape, codomain_grid2world=static_grid2world,
+                                              prealign=None)
+        self.static_to_ref.allocate()
+        prealign_inv = None if prealign is None else np.linalg.inv(prealign)
+        self.moving_to_ref = DiffeomorphicMap(dim=self.dim, disp_shape=disp_shape, disp_grid2world=disp_grid2world,
+                                              domain_shape=moving.shape, domain_grid2world=moving_grid2world,
+                                              codomain_shape=static.shape, codomain_grid2world=static_grid2world,
+                                              prealign=prealign_inv)
+        self.moving_to_ref.allocate()
+
+
+# Settings of the registration presets used by getTransform and white_mask_solo:
+#
+# - sampling_proportion: proportion of the static voxels sampled by the mutual information metric (None for all voxels).
+# - level_iters, sigmas, factors: pyramid depth and, from the coarsest to the finest level, the maximum number of
+#   iterations, the smoothing and the downsampling factor of the translation, rigid and affine optimisations.
+# - options: convergence tolerances of the L-BFGS-B optimiser at each level.
+# - syn_level_iters: iteration budget of the SyN registration at each level (coarsest first).
+# - syn_opt_tol, syn_energy_window: SyN stops a level when the slope of the energy over the last syn_energy_window
+#   iterations falls below syn_opt_tol.
+#
+# "accurate" reproduces the historical settings of getTransform.
+REGISTRATION_PRESETS = {
+    "fast": {"sampling_proportion": 0.25, "level_iters": [1000, 100], "sigmas": [3.0, 1.0], "factors": [4, 2],
+             "options": {"gtol": 1e-3, "ftol": 1e-6}, "syn_level_iters": [10, 5], "syn_opt_tol": 1e-4,
+             "syn_energy_window": 4},
+    "balanced": {"sampling_proportion": 0.5, "level_iters": [2000, 250, 50], "sigmas": [3.0, 1.0, 0.0],
+                 "factors": [4, 2, 1], "options": {"gtol": 1e-4, "ftol": 1e-8}, "syn_level_iters": [10, 10, 5],
+                 "syn_opt_tol": 1e-5, "syn_energy_window": 4},
+    "accurate": {"sampling_proportion": None, "level_iters": [10000, 1000, 100], "sigmas": [3.0, 1.0, 0.0],
+                 "factors": [4, 2, 1], "options": {"gtol": 1e-4}, "syn_level_iters": [10, 10, 5],
+                 "syn_opt_tol": 1e-5, "syn_energy_window": 12},
+}
+
+
+def _registration_preset(preset):
+    assert preset in REGISTRATION_PRESETS, "The registration preset must be one of the following : " + \
+                                           ", ".join(REGISTRATION_PRESETS)
+    return REGISTRATION_PRESETS[preset]
+
+
+def affine_registration(preset="accurate", template=None):
+    '''
+    Returns the mutual information AffineRegistration configured by a registration preset.
+
+    :param preset: Name of a preset of REGISTRATION_PRESETS. default='accurate'
+    :param template: RegistrationTemplate of the static image, if the registration is done to a cached template.
+    '''
+    settings = _registration_preset(preset)
+    metric = MutualInformationMetric(32, settings["sampling_proportion"])
+    kwargs = {"metric": metric, "level_iters": list(settings["level_iters"]), "sigmas": list(settings["sigmas"]),
+              "factors": list(settings["factors"]), "options": dict(settings["options"])}
+    if template is not None and _private_hook_supported(
+            AffineRegistration, ("self", "static", "moving", "transform", "params0", "static_grid2world",
+                                 "moving_grid2world", "starting_affine", "static_mask", "moving_mask")):
+        return _TemplateAffineRegistration(template, **kwargs)
+    return AffineRegistration(**kwargs)
+
+
+def diffeomorphic_registration(preset="accurate", template=None):
+    '''
+    Returns the cross-correlation SymmetricDiffeomorphicRegistration configured by a registration preset.
+
+    :param preset: Name of a preset of REGISTRATION_PRESETS. default='accurate'
+    :param template: RegistrationTemplate of the static image, if the registration is done to a cached template.
+    '''
+    settings = _registration_preset(preset)
+    metric = CCMetric(3)
+    level_iters = list(settings["syn_level_iters"])
+    if template is not None and _private_hook_supported(
+            SymmetricDiffeomorphicRegistration,
+            ("self", "static", "moving", "static_grid2world", "moving_grid2world", "prealign"), ("_connect_functions",)):
+        sdr = _TemplateDiffeomorphicRegistration(template, metric, level_iters, opt_tol=settings["syn_opt_tol"])
+    else:
+        sdr = SymmetricDiffeomorphicRegistration(metric, level_iters, opt_tol=settings["syn_opt_tol"])
+    sdr.energy_window = settings["syn_energy_window"]
+    return sdr
+
+
 def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAffine=False,
-                 diffeomorph=True, sanity_check=False, DWI=False, affine_map=None):
+                 diffeomorph=True, sanity_check=False, DWI=False, affine_map=None, cache_static=False,
+                 preset="accurate"):
     '''
 
 
@@ -32,6 +422,14 @@ def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAff
     moving_volume : 3D array of moving volume
     diffeomorph : if False then registration is only affine
     sanity_check : if True then prints figures
+    cache_static : if True then the static volume is a common template whose
+                   pyramids are computed once and reused by the following
+                   registrations to the same template (see RegistrationTemplate)
+    preset : speed against accuracy trade-off of the registration, one of
+             'fast', 'balanced' or 'accurate' (see REGISTRATION_PRESETS)
+    affine_map : affine matrix returned as is if onlyAffine, otherwise used
+                 to initialise the affine stage instead of the translation and
+                 rigid stages
 
     Returns
     -------
@@ -39,7 +437,13 @@ def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAff
 
     '''
 
-    static, static_affine = load_nifti(static_volume_file)
+    if cache_static:
+        template = get_registration_template(static_volume_file)
+        static, static_affine = template.static, template.grid2world
+    else:
+        template = None
+        static, static_affine = load_nifti(static_volume_file)
+        static = upcast(static)
     static_grid2world = static_affine
 
     moving, moving_affine = load_nifti(moving_volume_file)
@@ -47,6 +451,7 @@ def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAff
 
     if DWI:
         moving = np.squeeze(moving)[..., 0]
+    moving = upcast(moving)
 
     if mask_file is not None:
         mask, mask_affine = load_nifti(mask_file)
@@ -54,13 +459,15 @@ def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAff
 
     # Affine registration -----------------------------------------------------
 
+    initial_affine = affine_map
+
     if sanity_check or onlyAffine:
 
         if affine_map is None:
             affine_map = np.eye(4)
         affine_map = AffineMap(affine_map,
-                               static.shape, static_grid2world,
-                               moving.shape, moving_grid2world)
+                               domain_grid_shape=static.shape, domain_grid2world=static_grid2world,
+                               codomain_grid_shape=moving.shape, codomain_grid2world=moving_grid2world)
         
         if sanity_check:
         
@@ -76,47 +483,47 @@ def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAff
         if onlyAffine:
             return affine_map
 
-    c_of_mass = transform_centers_of_mass(static, static_grid2world,
-                                          moving, moving_grid2world)
-
-    nbins = 32
-    sampling_prop = None
-    metric = MutualInformationMetric(nbins, sampling_prop)
+    affreg = affine_registration(preset, template)
+    params0 = None
 
-    # !!!
-    level_iters = [10000, 1000, 100]
-    # level_iters = [100, 10, 1]
-    sigmas = [3.0, 1.0, 0.0]
-    factors = [4, 2, 1]
-    affreg = AffineRegistration(metric=metric,
-                                level_iters=level_iters,
-                                sigmas=sigmas,
-                                factors=factors)
+    if initial_affine is not None:
+        # A close initial affine (e.g. from an earlier registration of the same images) skips the translation and
+        # rigid stages
+        affine = affreg.optimize(static, moving, AffineTransform3D(), params0,
+                                 static_grid2world, moving_grid2world,
+                                 starting_affine=np.asarray(initial_affine, dtype=np.float64))
+    else:
+        if template is not None:
+            from scipy import ndimage
+            c_moving = moving_grid2world.dot(ndimage.center_of_mass(np.array(moving)) + (1,))[:3]
+            translation = np.eye(4)
+            translation[:3, 3] = c_moving - template.center_of_mass
+            c_of_mass = AffineMap(translation, domain_grid_shape=static.shape, domain_grid2world=static_grid2world,
+                                  codomain_grid_shape=moving.shape, codomain_grid2world=moving_grid2world)
+        else:
+            c_of_mass = transform_centers_of_mass(static, static_grid2world,
+                                                  moving, moving_grid2world)
 
-    transform = TranslationTransform3D()
-    params0 = None
-    translation = affreg.optimize(static, moving, transform, params0,
-                                  static_grid2world, moving_grid2world,
-                                  starting_affine=c_of_mass.affine)
+        transform = TranslationTransform3D()
+        translation = affreg.optimize(static, moving, transform, params0,
+                                      static_grid2world, moving_grid2world,
+                                      starting_affine=c_of_mass.affine)
 
-    transform = RigidTransform3D()
-    rigid = affreg.optimize(static, moving, transform, params0,
-                            static_grid2world, moving_grid2world,
-                            starting_affine=translation.affine)
+        transform = RigidTransform3D()
+        rigid = affreg.optimize(static, moving, transform, params0,
+                                static_grid2world, moving_grid2world,
+                                starting_affine=translation.affine)
 
-    transform = AffineTransform3D()
-    affine = affreg.optimize(static, moving, transform, params0,
-                             static_grid2world, moving_grid2world,
-                             starting_affine=rigid.affine)
+        transform = AffineTransform3D()
+        affine = affreg.optimize(static, moving, transform, params0,
+                                 static_grid2world, moving_grid2world,
+                                 starting_affine=rigid.affine)
 
     # Diffeomorphic registration --------------------------
 
     if diffeomorph:
 
-        metric = CCMetric(3)
-
-        level_iters = [10, 10, 5]
-        sdr = SymmetricDiffeomorphicRegistration(metric, level_iters)
+        sdr = diffeomorphic_registration(preset, template)
 
         mapping = sdr.optimize(static, moving, static_affine, moving_affine,
                                affine.affine)
@@ -139,6 +546,220 @@ def getTransform(static_volume_file, moving_volume_file, mask_file=None, onlyAff
     return mapping
 
 
+def benchmark_registration_presets(presets=("fast", "balanced", "accurate"), n_phantoms=2, shape=(64, 64, 64),
+                                   voxel_size=2.0, diffeomorph=True, seed=0, output_dir=None):
+    '''
+    Registers synthetic phantoms warped by a known affine and smooth non-linear deformation with each registration
+    preset, and reports the computation time against the registration error. The error is the distance, in mm, between
+    the point of the static phantom and the point recovered by composing the estimated mapping with the true
+    deformation, averaged (mean) and at the 95th percentile over the voxels of the phantom.
+
+    :param presets: Names of the presets to compare. default=('fast', 'balanced', 'accurate')
+    :param n_phantoms: Number of warped phantoms registered with each preset. default=2
+    :param shape: Shape of the phantoms. default=(64, 64, 64)
+    :param voxel_size: Isotropic voxel size of the phantoms in mm. default=2.0
+    :param diffeomorph: If True, the SyN registration is performed after the affine registration. default=True
+    :param seed: Seed of the random deformations. default=0
+    :param output_dir: Directory where the phantoms are written. default=a temporary directory
+    :return: List of dictionaries with the preset, phantom, seconds, mean_error and p95_error of each registration.
+    '''
+    import time
+    import tempfile
+    from scipy import ndimage
+
+    rng = np.random.default_rng(seed)
+    grid2world = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    grid2world[:3, 3] = -voxel_size * (np.array(shape) - 1) / 2
+    voxels = np.indices(shape).reshape(3, -1).astype(np.float64)
+    world = grid2world[:3, :3].dot(voxels) + grid2world[:3, 3:]
+
+    # Phantom: nested ellipsoids of different intensities and a few inner blobs, smoothed
+    radius = np.array(shape) * voxel_size / 2
+    static = np.zeros(world.shape[1])
+    for scale, intensity in ((0.85, 0.4), (0.6, 0.8), (0.3, 0.5)):
+        inside = np.sum((world / (scale * radius[:, None] * np.array([[1.0], [0.8], [0.9]]))) ** 2, axis=0) < 1
+        static[inside] = intensity
+    for _ in range(6):
+        center = rng.uniform(-0.4, 0.4, 3) * radius
+        static += 0.3 * np.exp(-np.sum((world - center[:, None]) ** 2, axis=0) / (2 * (0.08 * radius.min()) ** 2))
+    static = ndimage.gaussian_filter(static.reshape(shape), 1.0)
+    phantom_mask = ndimage.binary_erosion(static > 0.2, iterations=3).ravel()
+
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix="elikopy_registration_benchmark_")
+    static_file = os.path.join(output_dir, "static.nii.gz")
+    save_nifti(static_file, static.astype(np.float32), grid2world)
+
+    results = []
+    for phantom in range(n_phantoms):
+        # True deformation, from the moving world space to the static world space
+        angles = np.deg2rad(rng.uniform(-8, 8, 3))
+        rotation = np.eye(3)
+        for axis, angle in enumerate(angles):
+            c, s = np.cos(angle), np.sin(angle)
+            r = np.eye(3)
+            i, j = [k for k in range(3) if k != axis]
+            r[i, i], r[i, j], r[j, i], r[j, j] = c, -s, s, c
+            rotation = rotation.dot(r)
+        linear = rotation.dot(np.diag(rng.uniform(0.93, 1.07, 3)))
+        translation = rng.uniform(-4, 4, 3)
+        displacement = np.stack([ndimage.gaussian_filter(rng.normal(size=shape), 6) for _ in range(3)])
+        displacement *= 3.0 / np.abs(displacement).max()
+        true_points = linear.dot(world) + translation[:, None] + displacement.reshape(3, -1)
+
+        static_inv = np.linalg.inv(grid2world)
+        moving = ndimage.map_coordinates(static, static_inv[:3, :3].dot(true_points) + static_inv[:3, 3:], order=1)
+        moving_file = os.path.join(output_dir, "moving_" + str(phantom) + ".nii.gz")
+        save_nifti(moving_file, moving.reshape(shape).astype(np.float32), grid2world)
+
+        for preset in presets:
+            start = time.time()
+            mapping = getTransform(static_file, moving_file, onlyAffine=False, diffeomorph=diffeomorph,
+                                   sanity_check=False, preset=preset)
+            seconds = time.time() - start
+            recovered = np.stack([mapping.transform(true_points[k].reshape(shape)).ravel() for k in range(3)])
+            error = np.linalg.norm(recovered - world, axis=0)[phantom_mask]
+            results.append({"preset": preset, "phantom": phantom, "seconds": seconds,
+                            "mean_error": float(np.mean(error)), "p95_error": float(np.percentile(error, 95))})
+            print("[Registration benchmark] " + preset + " phantom " + str(phantom) + ": %.1f s, mean error %.2f mm, "
+                  "95th percentile %.2f mm" % (seconds, results[-1]["mean_error"], results[-1]["p95_error"]))
+
+    for preset in presets:
+        rows = [r for r in results if r["preset"] == preset]
+        print("[Registration benchmark] " + preset + ": %.1f s, mean error %.2f mm (average over %d phantoms)" % (
+            np.mean([r["seconds"] for r in rows]), np.mean([r["mean_error"] for r in rows]), len(rows)))
+    return results
+
+
+class ComposedTransform:
+    '''
+    Chain of affine (AffineMap) and diffeomorphic (DiffeomorphicMap) mappings composed into a single field of sampling
+    coordinates, so that an image is resampled once instead of once per mapping. transform(image) is equivalent to
+    m_n.transform(...m_2.transform(m_1.transform(image))), or to the chain of transform_inverse if inverse is True,
+    without the blur and the cropping of the intermediate grids.
+
+    The voxel coordinates in the input image of every voxel of the output grid are computed on first use and kept, so
+    that all the maps sharing the chain are warped with a single interpolation each.
+    '''
+
+    def __init__(self, mappings, inverse=False):
+        self.mappings = [m for m in mappings if m is not None]
+        self.inverse = inverse
+        self._coordinates = None
+        assert len(self.mappings) > 0, "At least one mapping is required"
+
+    def _steps(self):
+        '''
+        Returns, for each mapping in the order of application, its kind and the sampling and image grids of the
+        underlying dipy resampling.
+        '''
+        steps = []
+        for m in self.mappings:
+            if isinstance(m, AffineMap):
+                if self.inverse:
+                    steps.append(("affine", m.affine_inv, m.codomain_shape, m.codomain_grid2world, m.domain_grid2world))
+                else:
+                    steps.append(("affine", m.affine, m.domain_shape, m.domain_grid2world, m.codomain_grid2world))
+            else:
+                if self.inverse != bool(m.is_inverse):
+                    steps.append(("backward", m, m.codomain_shape, m.codomain_grid2world, m.domain_grid2world))
+                else:
+                    steps.append(("forward", m, m.domain_shape, m.domain_grid2world, m.codomain_grid2world))
+        return steps
+
+    @property
+    def out_shape(self):
+        return tuple(int(v) for v in self._steps()[-1][2])
+
+    @property
+    def out_grid2world(self):
+        grid2world = self._steps()[-1][3]
+        return np.eye(4) if grid2world is None else np.asarray(grid2world)
+
+    @staticmethod
+    def _pull_back(step, points):
+        '''
+        Maps world points (n, 3) of the sampling grid of a step to the world points where its input image is sampled.
+        '''
+        from scipy import ndimage
+
+        kind, m = step[0], step[1]
+        if kind == "affine":
+            return points if m is None else points @ m[:3, :3].T + m[:3, 3]
+
+        def displacement(field, world):
+            grid = world @ m.disp_world2grid[:3, :3].T + m.disp_world2grid[:3, 3]
+            return np.stack([ndimage.map_coordinates(field[..., c], grid.T, order=1, mode='grid-constant', cval=0)
+                             for c in range(3)], axis=1)
+
+        if kind == "forward":
+            prealign = np.eye(4) if m.prealign is None else m.prealign
+            points = points @ prealign[:3, :3].T + prealign[:3, 3]
+            return points + displacement(np.asarray(m.forward), points)
+        prealign_inv = np.eye(4) if m.prealign_inv is None else m.prealign_inv
+        points = points + displacement(np.asarray(m.backward), points)
+        return points @ prealign_inv[:3, :3].T + prealign_inv[:3, 3]
+
+    @property
+    def coordinates(self):
+        '''
+        Voxel coordinates (3, x, y, z) in the input image of the voxels of the output grid, computed by slabs of the
+        first axis to bound the memory of the intermediate points.
+        '''
+        if self._coordinates is None:
+            steps = self._steps()
+            image_grid2world = steps[0][4]
+            image_world2grid = np.linalg.inv(np.eye(4) if image_grid2world is None else image_grid2world)
+            shape = self.out_shape
+            grid2world = self.out_grid2world
+            coordinates = np.empty((3,) + shape, dtype=np.float32)
+            j, k = np.meshgrid(np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
+            for i in range(shape[0]):
+                voxels = np.stack([np.full(j.size, i), j.ravel(), k.ravel()], axis=1).astype(np.float64)
+                points = voxels @ grid2world[:3, :3].T + grid2world[:3, 3]
+                for step in reversed(steps):
+                    points = self._pull_back(step, points)
+                voxels = points @ image_world2grid[:3, :3].T + image_world2grid[:3, 3]
+                coordinates[:, i] = voxels.T.reshape((3,) + shape[1:])
+            self._coordinates = coordinates
+        return self._coordinates
+
+    def transform(self, image, interpolation='linear'):
+        '''
+        Resamples a 3-D image of the input space of the chain on the output grid (zero outside the image).
+        '''
+        from scipy import ndimage
+
+        image = np.asarray(image)
+        if image.ndim != 3:
+            raise ValueError("Undefined transform for dim: " + str(image.ndim))
+        order = 1 if interpolation == 'linear' else 0
+        return ndimage.map_coordinates(image.astype(np.float32, copy=False), self.coordinates, order=order,
+                                       mode='grid-constant', cval=0, output=np.float32)
+
+
+# composed transforms of the last chains used in this process
+_composed_transforms = []
+_COMPOSED_CACHE_SIZE = 2
+
+
+def get_composed_transform(mappings, inverse=False):
+    '''
+    Returns the ComposedTransform of a chain of mappings, reusing the one computed for the same mapping objects.
+    '''
+    mappings = [m for m in mappings if m is not None]
+    for composed in _composed_transforms:
+        if composed.inverse == inverse and len(composed.mappings) == len(mappings) and \
+                all(a is b for a, b in zip(composed.mappings, mappings)):
+            _composed_transforms.remove(composed)
+            _composed_transforms.insert(0, composed)
+            return composed
+    composed = ComposedTransform(mappings, inverse=inverse)
+    _composed_transforms.insert(0, composed)
+    del _composed_transforms[_COMPOSED_CACHE_SIZE:]
+    return composed
+
+
 def applyTransform(file_path, mapping, mapping_2=None, mapping_3=None, mask_file=None, static_file='', output_path='', binary=False,
                    inverse=False, mask_static=None, static_fa_file=''):
     '''
@@ -166,30 +787,16 @@ def applyTransform(file_path, mapping, mapping_2=None, mapping_3=None, mask_file
 
     '''
     print("Applying transform to", file_path)
-    moving = nib.load(file_path)
-    moving_data = moving.get_fdata()
+    moving = load_image(file_path)
+    moving_data = get_data(moving)
     print("Moving data shape:", moving_data.shape)
 
     if mask_file is not None:
         mask, mask_affine = load_nifti(mask_file)
         moving_data = applymask(moving_data, mask)
 
-    if inverse:
-        transformed = mapping.transform_inverse(moving_data)
-    else:
-        transformed = mapping.transform(moving_data)
-
-    if mapping_2 is not None:
-        if inverse:
-            transformed = mapping_2.transform_inverse(transformed)
-        else:
-            transformed = mapping_2.transform(transformed)
-
-    if mapping_3 is not None:
-        if inverse:
-            transformed = mapping_3.transform_inverse(transformed)
-        else:
-            transformed = mapping_3.transform(transformed)
+    # the chain of mappings is composed once and each map is resampled a single time
+    transformed = get_composed_transform([mapping, mapping_2, mapping_3], inverse=inverse).transform(moving_data)
 
     if binary:
         transformed[transformed > .5] = 1
@@ -204,8 +811,7 @@ def applyTransform(file_path, mapping, mapping_2=None, mapping_3=None, mask_file
             mask_static_data, mask_static_affine = load_nifti(mask_static)
             transformed = applymask(transformed, mask_static_data)
 
-        out = nib.Nifti1Image(transformed, static.affine, header=static_fa.header)
-        out.to_filename(output_path)
+        save_nifti(output_path, transformed, static.affine, static_fa.header)
 
     else:
         return transformed
@@ -231,6 +837,11 @@ def applyTransformToAllMapsInFolder(input_folder, output_folder, mapping, mappin
     '''
 
     for filename in os.listdir(input_folder):
+        if filename.endswith(".cvox") and os.path.isdir(input_folder + filename):
+            # compact output (see storage.CompactVolume), registered as the dense image it stands for
+            filename = filename[:-len(".cvox")] + ".nii.gz"
+            if os.path.exists(input_folder + filename):
+                continue
 
         curr_filename = filename
         valid = True
@@ -247,16 +858,15 @@ def applyTransformToAllMapsInFolder(input_folder, output_folder, mapping, mappin
                 applyTransform(input_folder + filename, mapping, mapping_2=mapping_2, mapping_3=mapping_3, static_file=static_file,
                                output_path=output_folder + filename, mask_file=mask_file, binary=False, inverse=inverse,
                                mask_static=mask_static, static_fa_file=static_fa_file)
-            except TypeError:
+            except (TypeError, nib.filebasedimages.ImageFileError):
                 continue
 
 
 
 def regToT1fromB0FSL(reg_path, T1_subject, DWI_B0_subject, mask_file, metrics_dic, folderpath, p, mapping_T1_to_T1MNI, T1_MNI,
                   mask_static, FA_MNI, longitudinal_transform=None):
-    if os.path.exists(reg_path + 'mapping_DWI_B0FSL_to_T1.p'):
-        with open(reg_path + 'mapping_DWI_B0FSL_to_T1.p', 'rb') as handle:
-            mapping_DWI_to_T1 = pickle.load(handle)
+    if mapping_exists(reg_path + 'mapping_DWI_B0FSL_to_T1'):
+        mapping_DWI_to_T1 = load_mapping(reg_path + 'mapping_DWI_B0FSL_to_T1')
     else:
         if not (os.path.exists(reg_path)):
             try:
@@ -277,8 +887,7 @@ def regToT1fromB0FSL(reg_path, T1_subject, DWI_B0_subject, mask_file, metrics_di
 
         affine_map_fslb0 = np.loadtxt(f"{b0fsl_reg_path}/{p}_B0toT1_ANTS.mat")
         mapping_DWI_to_T1 = getTransform(T1_subject, DWI_B0_subject, mask_file=mask_file, onlyAffine=True, diffeomorph=False, sanity_check=False, DWI=False, affine_map=affine_map_fslb0)
-        with open(reg_path + 'mapping_DWI_B0FSL_to_T1.p', 'wb') as handle:
-            pickle.dump(mapping_DWI_to_T1, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        save_mapping(mapping_DWI_to_T1, reg_path + 'mapping_DWI_B0FSL_to_T1')
 
     if not (os.path.exists(folderpath + "/subjects/" + p + "/masks/reg/")):
         try:
@@ -329,20 +938,20 @@ def regToT1fromB0FSL(reg_path, T1_subject, DWI_B0_subject, mask_file, metrics_di
 
 
 def regToT1fromB0(reg_path, T1_subject, DWI_subject, mask_file, metrics_dic, folderpath, p, mapping_T1_to_T1MNI, T1_MNI,
-                  mask_static, FA_MNI, longitudinal_transform=None):
-    if os.path.exists(reg_path + 'mapping_DWI_B0_to_T1.p'):
-        with open(reg_path + 'mapping_DWI_B0_to_T1.p', 'rb') as handle:
-            mapping_DWI_to_T1 = pickle.load(handle)
+                  mask_static, FA_MNI, longitudinal_transform=None, initial_affine=None,
+                  reuse_initial_affine=False):
+    if mapping_exists(reg_path + 'mapping_DWI_B0_to_T1'):
+        mapping_DWI_to_T1 = load_mapping(reg_path + 'mapping_DWI_B0_to_T1')
     else:
         if not (os.path.exists(reg_path)):
             try:
                 os.makedirs(reg_path)
             except OSError:
                 print("Creation of the directory %s failed" % reg_path)
-        mapping_DWI_to_T1 = getTransform(T1_subject, DWI_subject, mask_file=mask_file, onlyAffine=False,
-                                         diffeomorph=False, sanity_check=False, DWI=True)
-        with open(reg_path + 'mapping_DWI_B0_to_T1.p', 'wb') as handle:
-            pickle.dump(mapping_DWI_to_T1, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        mapping_DWI_to_T1 = getTransform(T1_subject, DWI_subject, mask_file=mask_file,
+                                         onlyAffine=reuse_initial_affine and initial_affine is not None,
+                                         diffeomorph=False, sanity_check=False, DWI=True, affine_map=initial_affine)
+        save_mapping(mapping_DWI_to_T1, reg_path + 'mapping_DWI_B0_to_T1')
 
     if not (os.path.exists(folderpath + "/subjects/" + p + "/masks/reg/")):
         try:
@@ -391,20 +1000,20 @@ def regToT1fromB0(reg_path, T1_subject, DWI_subject, mask_file, metrics_dic, fol
 
 
 def regToT1fromWMFOD(reg_path, T1_subject, WM_FOD_subject, mask_file, metrics_dic, folderpath, p, mapping_T1_to_T1MNI,
-                     T1_MNI, mask_static, FA_MNI, longitudinal_transform=None):
-    if os.path.exists(reg_path + 'mapping_DWI_WMFOD_to_T1.p'):
-        with open(reg_path + 'mapping_DWI_WMFOD_to_T1.p', 'rb') as handle:
-            mapping_DWI_to_T1 = pickle.load(handle)
+                     T1_MNI, mask_static, FA_MNI, longitudinal_transform=None, initial_affine=None,
+                     reuse_initial_affine=False):
+    if mapping_exists(reg_path + 'mapping_DWI_WMFOD_to_T1'):
+        mapping_DWI_to_T1 = load_mapping(reg_path + 'mapping_DWI_WMFOD_to_T1')
     else:
         if not (os.path.exists(reg_path)):
             try:
                 os.makedirs(reg_path)
             except OSError:
                 print("Creation of the directory %s failed" % reg_path)
-        mapping_DWI_to_T1 = getTransform(T1_subject, WM_FOD_subject, mask_file=mask_file, onlyAffine=False,
-                                         diffeomorph=False, sanity_check=False, DWI=True)
-        with open(reg_path + 'mapping_DWI_WMFOD_to_T1.p', 'wb') as handle:
-            pickle.dump(mapping_DWI_to_T1, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        mapping_DWI_to_T1 = getTransform(T1_subject, WM_FOD_subject, mask_file=mask_file,
+                                         onlyAffine=reuse_initial_affine and initial_affine is not None,
+                                         diffeomorph=False, sanity_check=False, DWI=True, affine_map=initial_affine)
+        save_mapping(mapping_DWI_to_T1, reg_path + 'mapping_DWI_WMFOD_to_T1')
 
     if not (os.path.exists(folderpath + "/subjects/" + p + "/masks/reg/")):
         try:
@@ -454,20 +1063,20 @@ def regToT1fromWMFOD(reg_path, T1_subject, WM_FOD_subject, mask_file, metrics_di
 
 
 def regToT1fromAP(reg_path, T1_subject, AP_subject, mask_file, metrics_dic, folderpath, p, mapping_T1_to_T1MNI, T1_MNI,
-                  mask_static, FA_MNI, longitudinal_transform=None):
-    if os.path.exists(reg_path + 'mapping_DWI_AP_to_T1.p'):
-        with open(reg_path + 'mapping_DWI_AP_to_T1.p', 'rb') as handle:
-            mapping_DWI_to_T1 = pickle.load(handle)
+                  mask_static, FA_MNI, longitudinal_transform=None, initial_affine=None,
+                  reuse_initial_affine=False):
+    if mapping_exists(reg_path + 'mapping_DWI_AP_to_T1'):
+        mapping_DWI_to_T1 = load_mapping(reg_path + 'mapping_DWI_AP_to_T1')
     else:
         if not (os.path.exists(reg_path)):
             try:
                 os.makedirs(reg_path)
             except OSError:
                 print("Creation of the directory %s failed" % reg_path)
-        mapping_DWI_to_T1 = getTransform(T1_subject, AP_subject, mask_file=mask_file, onlyAffine=False,
-                                         diffeomorph=False, sanity_check=False, DWI=False)
-        with open(reg_path + 'mapping_DWI_AP_to_T1.p', 'wb') as handle:
-            pickle.dump(mapping_DWI_to_T1, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        mapping_DWI_to_T1 = getTransform(T1_subject, AP_subject, mask_file=mask_file,
+                                         onlyAffine=reuse_initial_affine and initial_affine is not None,
+                                         diffeomorph=False, sanity_check=False, DWI=False, affine_map=initial_affine)
+        save_mapping(mapping_DWI_to_T1, reg_path + 'mapping_DWI_AP_to_T1')
 
     if not (os.path.exists(folderpath + "/subjects/" + p + "/masks/reg/")):
         try:
@@ -517,7 +1126,27 @@ def regToT1fromAP(reg_path, T1_subject, AP_subject, mask_file, metrics_dic, fold
                                             mask_static=mask_static, static_fa_file=FA_MNI)
 
 
-def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="brain_mask", T1_filepath=None, T1wCommonSpace_filepath="${FSLDIR}/data/standard/MNI152_T1_1mm_brain.nii.gz", T1wCommonSpaceMask_filepath="${FSLDIR}/data/standard/MNI152_T1_1mm_brain_mask.nii.gz", metrics_dic={'_FA': 'dti', 'RD': 'dti', 'AD': 'dti', 'MD': 'dti'}, longitudinal=False):
+def whitemask_initial_affine(reg_path):
+    '''
+    Returns the affine matrix of the DWI to T1 registration (from the T1 world space to the DWI world space) given by
+    the T1 to DWI transform saved by white_mask_solo in reg/mapping_T1_to_DWI, or None if white_mask_solo has not been
+    run with a T1 image or if the T1 or the preprocessed DWI changed since.
+
+    :param reg_path: Path to the reg folder of the subject.
+    '''
+    if not mapping_exists(reg_path + 'mapping_T1_to_DWI') or not mapping_is_current(reg_path + 'mapping_T1_to_DWI'):
+        return None
+    return np.linalg.inv(load_mapping(reg_path + 'mapping_T1_to_DWI').affine)
+
+
+def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="brain_mask", T1_filepath=None, T1wCommonSpace_filepath="${FSLDIR}/data/standard/MNI152_T1_1mm_brain.nii.gz", T1wCommonSpaceMask_filepath="${FSLDIR}/data/standard/MNI152_T1_1mm_brain_mask.nii.gz", metrics_dic={'_FA': 'dti', 'RD': 'dti', 'AD': 'dti', 'MD': 'dti'}, longitudinal=False, whitemask_transform="init"):
+    '''
+    Registers the diffusion metrics of a subject to the T1 common space, through the T1 of the subject.
+
+    whitemask_transform sets how the T1 to DWI transform computed by white_mask_solo is used by the DWI to T1
+    registration when DWI_type is 'B0', 'WMFOD' or 'AP': 'init' to initialise the affine registration, 'reuse' to use
+    it as the DWI to T1 mapping without registering again, None to ignore it.
+    '''
     preproc_folder = folder_path + '/subjects/' + p + '/dMRI/preproc/'
     T1_CommonSpace = os.path.expandvars(T1wCommonSpace_filepath)
     FA_MNI = os.path.expandvars('${FSLDIR}/data/standard/FSL_HCP1065_FA_1mm.nii.gz')
@@ -526,6 +1155,7 @@ def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="b
                     "wm_mask_Freesurfer_T1", None], "The mask parameter must be one of the following : brain_mask_dilated, brain_mask, wm_mask_MSMT, wm_mask_AP, wm_mask_FSL_T1, wm_mask_Freesurfer_T1, None"
 
     assert DWI_type in ["AP", "WMFOD", "B0", "B0FSL"], "The DWI_type parameter must be one of the following : AP, WMFOD, B0, B0FSL"
+    assert whitemask_transform in ["init", "reuse", None], "The whitemask_transform parameter must be one of the following : init, reuse, None"
 
     mask_path = ""
     if maskType is not None and os.path.isfile(folder_path + '/subjects/' + p + "/masks/" + p + '_' + maskType + '.nii.gz'):
@@ -560,9 +1190,8 @@ def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="b
     print("Start of getTransform for T1 to T1_MNI")
     mask_file = None
 
-    if os.path.exists(reg_path + 'mapping_T1w_to_T1wCommonSpace.p'):
-        with open(reg_path + 'mapping_T1w_to_T1wCommonSpace.p', 'rb') as handle:
-            mapping_T1w_to_T1wCommonSpace = pickle.load(handle)
+    if mapping_exists(reg_path + 'mapping_T1w_to_T1wCommonSpace'):
+        mapping_T1w_to_T1wCommonSpace = load_mapping(reg_path + 'mapping_T1w_to_T1wCommonSpace')
     else:
         if not (os.path.exists(reg_path)):
             try:
@@ -570,9 +1199,8 @@ def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="b
             except OSError:
                 print("Creation of the directory %s failed" % reg_path)
         mapping_T1w_to_T1wCommonSpace = getTransform(T1_CommonSpace, T1_subject, mask_file=mask_file, onlyAffine=False, diffeomorph=True,
-                                           sanity_check=False, DWI=False)
-        with open(reg_path + 'mapping_T1w_to_T1wCommonSpace.p', 'wb') as handle:
-            pickle.dump(mapping_T1w_to_T1wCommonSpace, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                                           sanity_check=False, DWI=False, cache_static=True)
+        save_mapping(mapping_T1w_to_T1wCommonSpace, reg_path + 'mapping_T1w_to_T1wCommonSpace')
 
     applyTransform(T1_subject, mapping_T1w_to_T1wCommonSpace, mapping_2=None, mask_file=None, static_file=T1_CommonSpace,
                    output_path=folder_path + '/subjects/' + p + '/T1/' + p + '_T1_MNI_FS.nii.gz', binary=False,
@@ -584,9 +1212,8 @@ def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="b
         p_ref = get_patient_ref(root=folder_path, patient=p, suffix_length=longitudinal)
         T1_ref_subject = folder_path + '/subjects/' + p_ref + '/T1/' + p_ref + "_T1_brain.nii.gz"
 
-        if os.path.exists(reg_path + 'mapping_T1w_to_T1wRef.p'):
-            with open(reg_path + 'mapping_T1w_to_T1wRef.p', 'rb') as handle:
-                mapping_T1w_to_T1wRef = pickle.load(handle)
+        if mapping_exists(reg_path + 'mapping_T1w_to_T1wRef'):
+            mapping_T1w_to_T1wRef = load_mapping(reg_path + 'mapping_T1w_to_T1wRef')
         else:
             if not (os.path.exists(reg_path)):
                 try:
@@ -602,19 +1229,17 @@ def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="b
                 mapping_T1w_to_T1wRef = getTransform(T1_ref_subject, T1_subject, mask_file=mask_file,
                                                              onlyAffine=False, diffeomorph=False,
                                                              sanity_check=False, DWI=False)
-            with open(reg_path + 'mapping_T1w_to_T1wRef.p', 'wb') as handle:
-                pickle.dump(mapping_T1w_to_T1wRef, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            save_mapping(mapping_T1w_to_T1wRef, reg_path + 'mapping_T1w_to_T1wRef')
 
         applyTransform(T1_subject, mapping_T1w_to_T1wRef, mapping_2=None, mask_file=None,
                        static_file=T1_ref_subject,
                        output_path=folder_path + '/subjects/' + p + '/T1/' + p + '_space-T1Ref_type-brain_T1.nii.gz', binary=False,
                        inverse=False, static_fa_file=T1_ref_subject)
 
-        reg_T1RefToCommonSpace_precomputed = folder_path + '/subjects/' + p_ref + '/reg/' + 'mapping_T1w_to_T1wCommonSpace.p'
-        if not os.path.exists(reg_T1RefToCommonSpace_precomputed):
-            raise ValueError("No mapping_T1w_to_T1wCommonSpace.p file found in the reg folder of the reference subject")
-        with open(reg_T1RefToCommonSpace_precomputed, 'rb') as handle:
-            mapping_T1w_to_T1wCommonSpace = pickle.load(handle)
+        reg_T1RefToCommonSpace_precomputed = folder_path + '/subjects/' + p_ref + '/reg/' + 'mapping_T1w_to_T1wCommonSpace'
+        if not mapping_exists(reg_T1RefToCommonSpace_precomputed):
+            raise ValueError("No mapping_T1w_to_T1wCommonSpace mapping found in the reg folder of the reference subject")
+        mapping_T1w_to_T1wCommonSpace = load_mapping(reg_T1RefToCommonSpace_precomputed)
     else:
         mapping_T1w_to_T1wRef = None
 
@@ -626,12 +1251,19 @@ def regallDWIToT1wToT1wCommonSpace(folder_path, p, DWI_type="B0FSL", maskType="b
     else:
         mask_static = None
 
+    # white_mask_solo registers the T1 of the subject, not a T1 given in T1_filepath
+    if whitemask_transform is not None and T1_filepath is None:
+        initial_affine = whitemask_initial_affine(reg_path)
+    else:
+        initial_affine = None
+    reuse_initial_affine = whitemask_transform == "reuse"
+
     if DWI_type == "B0":
-        regToT1fromB0(reg_path, T1_subject, DWI_subject, mask_path, metrics_dic, folder_path, p, mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI, longitudinal_transform=mapping_T1w_to_T1wRef)
+        regToT1fromB0(reg_path, T1_subject, DWI_subject, mask_path, metrics_dic, folder_path, p, mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI, longitudinal_transform=mapping_T1w_to_T1wRef, initial_affine=initial_affine, reuse_initial_affine=reuse_initial_affine)
     elif DWI_type == "WMFOD":
-        regToT1fromWMFOD(reg_path, T1_subject, WM_FOD_subject, mask_path, metrics_dic, folder_path, p, mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI, longitudinal_transform=mapping_T1w_to_T1wRef)
+        regToT1fromWMFOD(reg_path, T1_subject, WM_FOD_subject, mask_path, metrics_dic, folder_path, p, mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI, longitudinal_transform=mapping_T1w_to_T1wRef, initial_affine=initial_affine, reuse_initial_affine=reuse_initial_affine)
     elif DWI_type == "AP":
-        regToT1fromAP(reg_path, T1_subject, AP_subject, mask_path, metrics_dic, folder_path, p, mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI, longitudinal_transform=mapping_T1w_to_T1wRef)
+        regToT1fromAP(reg_path, T1_subject, AP_subject, mask_path, metrics_dic, folder_path, p, mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI, longitudinal_transform=mapping_T1w_to_T1wRef, initial_affine=initial_affine, reuse_initial_affine=reuse_initial_affine)
     elif DWI_type == "B0FSL":
         regToT1fromB0FSL(reg_path, T1_subject, DWI_B0_subject, mask_path, metrics_dic, folder_path, p,
                       mapping_T1w_to_T1wCommonSpace, T1_CommonSpace, mask_static, FA_MNI,
@@ -649,9 +1281,15 @@ def regallFAToMNI(folderpath, p, metrics_dic={'_FA': 'dti', 'RD': 'dti', 'AD': '
     static_volume_file = FA_MNI
     moving_volume_file = folderpath + '/subjects/' + p + '/dMRI/microstructure/dti/' + p + '_FA.nii.gz'
     mask_file = folderpath + '/subjects/' + p + '/masks/' + p + '_brain_mask.nii.gz'
-    print("Start of getTransform")
-    mapping = getTransform(static_volume_file, moving_volume_file, mask_file=mask_file, onlyAffine=False,
-                           diffeomorph=False, sanity_check=True)
+    reg_path = folderpath + '/subjects/' + p + '/reg/'
+    if mapping_exists(reg_path + 'mapping_FA_to_MNI'):
+        mapping = load_mapping(reg_path + 'mapping_FA_to_MNI')
+    else:
+        print("Start of getTransform")
+        mapping = getTransform(static_volume_file, moving_volume_file, mask_file=mask_file, onlyAffine=False,
+                               diffeomorph=False, sanity_check=True, cache_static=True)
+        os.makedirs(reg_path, exist_ok=True)
+        save_mapping(mapping, reg_path + 'mapping_FA_to_MNI')
 
     for key, value in metrics_dic.items():
 
@@ -665,7 +1303,100 @@ def regallFAToMNI(folderpath, p, metrics_dic={'_FA': 'dti', 'RD': 'dti', 'AD': '
                 print("Creation of the directory %s failed" % output_folder)
 
         print("Start of applyTransformToAllMapsInFolder for metrics ", value, ":", key)
-        applyTransformToAllMapsInFolder(input_folder, output_folder, mapping, static_volume_file, mask_file=mask_file,
-                                        keywordList=[p, key], inverse=False)
+        applyTransformToAllMapsInFolder(input_folder, output_folder, mapping, static_file=static_volume_file,
+                                        mask_file=mask_file, keywordList=[p, key], inverse=False,
+                                        static_fa_file=static_volume_file)
+
 
+REGISTRATION_FUNCTIONS = ("regallDWIToT1wToT1wCommonSpace", "regallFAToMNI")
+
+
+def _registration_waves(folder_path, patient_list, kwargs):
+    longitudinal = kwargs.get("longitudinal", False)
+    if longitudinal is False or longitudinal is None or longitudinal <= 0:
+        return [list(patient_list)]
+    # The longitudinal registration of a subject reuses the common space mapping of its reference subject
+    references = [p for p in patient_list if get_patient_ref(root=folder_path, patient=p,
+                                                                suffix_length=longitudinal) == p]
+    return [references, [p for p in patient_list if p not in references]]
+
+
+def _init_registration_worker(max_memory):
+    if max_memory is not None:
+        import resource
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        limit = int(max_memory) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+
+
+def _register_subject(function_name, folder_path, p, kwargs):
+    try:
+        globals()[function_name](folder_path, p, **kwargs)
+    except MemoryError:
+        return p, "OUT_OF_MEMORY"
+    except Exception as e:
+        return p, "FAILED (" + repr(e) + ")"
+    return p, "COMPLETED"
+
+
+def regall_subjects(folder_path, patient_list, function_name="regallDWIToT1wToT1wCommonSpace", core_count=1,
+                    max_memory=None, **kwargs):
+    '''
+    Registers the subjects of a study with one of the per-subject registration functions (regallDWIToT1wToT1wCommonSpace
+    or regallFAToMNI), spreading the subjects over core_count worker processes. Each worker keeps its template
+    pyramids between subjects (see RegistrationTemplate). The mappings are written atomically in the mapping store and
+    reused when present, so that an interrupted run resumes where it stopped when called again. With longitudinal
+    registration, the reference subjects are registered first.
+
+    :param folder_path: the path to the root directory.
+    :param patient_list: List of the subjects to register.
+    :param function_name: Name of the registration function. default='regallDWIToT1wToT1wCommonSpace'
+    :param core_count: Number of worker processes. default=1
+    :param max_memory: Maximum address space of each worker process in MB. A subject exceeding it is reported as
+        OUT_OF_MEMORY and the other subjects are still processed. default=None
+    :param kwargs: Additional arguments of the registration function.
+    :return: Dictionary giving the state (COMPLETED, OUT_OF_MEMORY or FAILED) of each subject.
+    '''
+    import datetime
+    from elikopy.resources import process_pool
+
+    assert function_name in REGISTRATION_FUNCTIONS, "The registration function must be one of the following : " + \
+                                                    ", ".join(REGISTRATION_FUNCTIONS)
+    log_prefix = "Registration"
+    states = {}
+    for wave in _registration_waves(folder_path, patient_list, kwargs):
+        if core_count > 1 or max_memory is not None:
+            with process_pool(max(1, min(core_count, len(wave))), initializer=_init_registration_worker,
+                              initargs=(max_memory,)) as executor:
+                futures = [executor.submit(_register_subject, function_name, folder_path, p, kwargs) for p in wave]
+                results = []
+                for p, future in zip(wave, futures):
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        # e.g. a worker killed by the system, which breaks the pool
+                        results.append((p, "FAILED (" + repr(e) + ")"))
+        else:
+            results = [_register_subject(function_name, folder_path, p, kwargs) for p in wave]
+        with open(folder_path + "/logs.txt", "a+") as f:
+            for p, state in results:
+                states[p] = state
+                f.write("[" + log_prefix + "] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": " +
+                        function_name + " of patient " + p + " " + state + "\n")
+    return states
+
+
+def regall_array_task(task_file):
+    '''
+    Registers the subject of the current Slurm array task (SLURM_ARRAY_TASK_ID) described in a task file written by
+    Elikopy.register_study. Raises an error if the registration fails so that the array task is reported as failed.
+
+    :param task_file: Path to the json task file holding the folder path, the function name, its arguments and the
+        list of subjects.
+    '''
+    import json
 
+    with open(task_file, "r") as f:
+        task = json.load(f)
+    p = task["patient_list"][int(os.environ["SLURM_ARRAY_TASK_ID"])]
+    globals()[task["function_name"]](task["folder_path"], p, **task["kwargs"])
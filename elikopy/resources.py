@@ -0,0 +1,191 @@
+"""
+ CPU budget shared by the processing steps of the package.
+"""
+import os
+import sys
+import time
+
+
+CPU_BUDGET_ENV = "ELIKOPY_CPU_BUDGET"
+
+# Environment variables read by the threaded libraries and external tools: OpenMP (FSL, dipy, ANTs), the BLAS
+# libraries, ITK (ANTs), MRtrix and FSL.
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "MRTRIX_NTHREADS", "FSLPARALLEL")
+
+
+def available_cpus():
+    """
+    Number of cores the current process may run on (its CPU affinity, which follows the Slurm allocation).
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_cpu_budget():
+    """
+    Returns the number of cores of the current process. Set with set_cpu_budget (or the ELIKOPY_CPU_BUDGET environment
+    variable); by default, the cores available to the process. The workers of process_pool receive their share of the
+    budget of their parent, so that nested pools never use more than the cores of the first level.
+    """
+    budget = os.environ.get(CPU_BUDGET_ENV)
+    if budget:
+        return max(1, int(budget))
+    return available_cpus()
+
+
+def set_cpu_budget(cpus=None):
+    """
+    Sets the number of cores shared by all the processing steps of the current process and of its child processes.
+
+    :param cpus: Number of cores. default=None (the cores available to the process)
+    """
+    if cpus is None:
+        os.environ.pop(CPU_BUDGET_ENV, None)
+    else:
+        assert int(cpus) >= 1, "cpus must be a positive integer"
+        os.environ[CPU_BUDGET_ENV] = str(int(cpus))
+
+
+def cpu_allowance(core_count=None):
+    """
+    Number of threads granted to a step asking for core_count threads: core_count capped by the CPU budget.
+
+    :param core_count: Requested number of threads. default=None (the whole budget)
+    """
+    budget = get_cpu_budget()
+    if core_count is None:
+        return budget
+    return max(1, min(int(core_count), budget))
+
+
+def thread_env(threads):
+    """
+    Environment variables limiting a child process (FSL, MRtrix, ANTs, python) to threads threads.
+    """
+    threads = str(max(1, int(threads)))
+    env = {name: threads for name in THREAD_ENV_VARS}
+    env[CPU_BUDGET_ENV] = threads
+    return env
+
+
+def thread_exports(threads):
+    """
+    Shell prefix exporting the thread environment of thread_env, for the commands run through a shell (e.g. the
+    commands wrapped by slurm).
+    """
+    return "".join("export " + name + "=" + value + " ; " for name, value in thread_env(threads).items())
+
+
+def set_process_threads(threads):
+    """
+    Limits the current process to threads threads: the CPU budget and thread environment variables (inherited by the
+    child processes), torch intra-op threads, and the BLAS/OpenMP pools already loaded when threadpoolctl is
+    installed. The numba kernels of the package read the CPU budget when they are called.
+    """
+    threads = max(1, int(threads))
+    os.environ.update(thread_env(threads))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+def numba_threads(core_count):
+    """
+    Number of numba threads used by a kernel asked to run on core_count threads.
+    """
+    import numba
+
+    return max(1, min(cpu_allowance(core_count), numba.config.NUMBA_NUM_THREADS))
+
+
+def _init_budget_worker(threads, initializer, initargs):
+    set_process_threads(threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def process_pool(max_workers, initializer=None, initargs=(), mp_context=None):
+    """
+    ProcessPoolExecutor sharing the CPU budget of the current process: the number of workers is capped by the budget
+    and each worker is limited to budget // workers threads (see set_process_threads) before initializer runs.
+
+    :param max_workers: Requested number of worker processes.
+    :param initializer: Initializer of the workers. default=None
+    :param initargs: Arguments of the initializer. default=()
+    :param mp_context: Multiprocessing context. default=None
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    budget = get_cpu_budget()
+    workers = max(1, min(int(max_workers), budget))
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_budget_worker,
+                               initargs=(max(1, budget // workers), initializer, initargs))
+
+
+def _benchmark_kernel(size, repeats):
+    """
+    Multi-threaded numba workload of the benchmark, run with the numba threads granted by the CPU budget.
+    """
+    import numba
+    import numpy as np
+    from elikopy.segmentation import hmrf_segmentation
+
+    rng = np.random.default_rng(0)
+    image = rng.normal(np.repeat(np.arange(3.0), size * size * size // 3 + 1)[:size ** 3], 0.5).reshape((size,) * 3)
+    start = time.time()
+    for _ in range(repeats):
+        hmrf_segmentation(image, 2, 0.1, max_iter=5, tolerance=0, core_count=numba.config.NUMBA_NUM_THREADS)
+    return time.time() - start
+
+
+def _init_unmanaged_worker():
+    # Without the budget, each worker uses as many threads as the machine has cores
+    os.environ.pop(CPU_BUDGET_ENV, None)
+
+
+def benchmark_cpu_budget(n_tasks=None, workers=None, size=64, repeats=2):
+    """
+    Benchmarks the CPU budget: n_tasks multi-threaded tasks (a few iterations of hmrf_segmentation, whose numba
+    kernels run on all the cores when no budget is set) are spread over a pool of workers, first without limiting the
+    threads of the workers (workers x cores threads, oversubscribing the machine), then with process_pool. The
+    results are printed and returned.
+
+    :param n_tasks: Number of tasks. default=2 * workers
+    :param workers: Number of worker processes, e.g. the number of subjects processed concurrently. default=cores
+    :param size: Size of the cubic image of each task. default=64
+    :param repeats: Number of segmentations per task. default=2
+    :return: List of dicts with the mode, the number of threads per worker, the wall time and the mean task time.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import numba
+
+    budget = get_cpu_budget()
+    workers = budget if workers is None else max(1, int(workers))
+    n_tasks = 2 * workers if n_tasks is None else int(n_tasks)
+
+    results = []
+    pools = (("unmanaged", numba.config.NUMBA_NUM_THREADS,
+              lambda: ProcessPoolExecutor(max_workers=workers, initializer=_init_unmanaged_worker)),
+             ("budget", max(1, budget // min(workers, budget)), lambda: process_pool(workers)))
+    for mode, threads, make_pool in pools:
+        with make_pool() as executor:
+            # Starts the workers and compiles the kernels, so that the compilation is not measured
+            list(executor.map(_benchmark_kernel, [8] * workers, [1] * workers))
+            start = time.time()
+            task_times = list(executor.map(_benchmark_kernel, [size] * n_tasks, [repeats] * n_tasks))
+            wall_time = time.time() - start
+        results.append({"mode": mode, "threads_per_worker": threads, "seconds": wall_time,
+                        "mean_task_seconds": sum(task_times) / len(task_times)})
+
+    print("CPU budget: " + str(budget) + " cores, " + str(workers) + " workers, " + str(n_tasks) + " tasks")
+    for result in results:
+        print("{mode:>10} {threads_per_worker:>4} threads/worker {seconds:8.2f} s (mean task {mean_task_seconds:.2f} s)"
+              .format(**result))
+    return results
@@ -0,0 +1,276 @@
+import numpy as np
+import numba
+
+from elikopy.resources import numba_threads
+
+
+@numba.njit(cache=True)
+def _neighbour_agreement(seg, i, j, k, n_classes, agreement):
+    """
+    Writes in agreement[l] the number of 6-neighbours of voxel (i,j,k) labelled l minus the number of neighbours with
+    another label, which is the Ising interaction term of dipy's IteratedConditionalModes.
+    """
+    nx, ny, nz = seg.shape
+    for l in range(n_classes):
+        agreement[l] = 0.
+    n_neighbours = 0
+    for d in range(6):
+        a, b, c = i, j, k
+        if d == 0:
+            a = i - 1
+        elif d == 1:
+            a = i + 1
+        elif d == 2:
+            b = j - 1
+        elif d == 3:
+            b = j + 1
+        elif d == 4:
+            c = k - 1
+        else:
+            c = k + 1
+        if a < 0 or a >= nx or b < 0 or b >= ny or c < 0 or c >= nz:
+            continue
+        n_neighbours += 1
+        agreement[seg[a, b, c]] += 2.
+    for l in range(n_classes):
+        agreement[l] -= n_neighbours
+
+
+@numba.njit(parallel=True, cache=True)
+def _em_kernel(image, seg, beta, mu, sigmasq, pve, stats):
+    """
+    E-step of the HMRF-EM: posterior probability pve of each class given the neighbourhood prior of seg and the
+    Gaussian likelihood of (mu, sigmasq). stats[i] receives the sums over slab i of the weights, of the weighted
+    intensities and of the weighted squared deviations to mu used by the M-step.
+    """
+    nx, ny, nz = image.shape
+    n_classes = mu.shape[0]
+    for i in numba.prange(nx):
+        agreement = np.empty(n_classes)
+        posterior = np.empty(n_classes)
+        for l in range(n_classes):
+            for s in range(3):
+                stats[i, l, s] = 0.
+        for j in range(ny):
+            for k in range(nz):
+                y = image[i, j, k]
+                _neighbour_agreement(seg, np.int64(i), j, k, n_classes, agreement)
+                prior_sum = 0.
+                for l in range(n_classes):
+                    agreement[l] = np.exp(beta * agreement[l])
+                    prior_sum += agreement[l]
+                total = 0.
+                for l in range(n_classes):
+                    posterior[l] = np.exp(-(y - mu[l]) ** 2 / (2 * sigmasq[l])) / np.sqrt(2 * np.pi * sigmasq[l]) * \
+                                   agreement[l] / prior_sum
+                    total += posterior[l]
+                for l in range(n_classes):
+                    if total > 0:
+                        p = posterior[l] / total
+                    else:
+                        p = agreement[l] / prior_sum
+                    pve[i, j, k, l] = p
+                    stats[i, l, 0] += p
+                    stats[i, l, 1] += p * y
+                    stats[i, l, 2] += p * (y - mu[l]) ** 2
+
+
+@numba.njit(parallel=True, cache=True)
+def _icm_kernel(image, seg, beta, mu, sigmasq, new_seg, energy, changes):
+    """
+    One synchronous Iterated Conditional Modes sweep: each voxel takes the label minimising its negative
+    log-likelihood minus beta times the neighbour agreement of seg. energy[i] and changes[i] receive the sum of the
+    minimal energies and the number of relabelled voxels of slab i.
+    """
+    nx, ny, nz = image.shape
+    n_classes = mu.shape[0]
+    for i in numba.prange(nx):
+        agreement = np.empty(n_classes)
+        energy[i] = 0.
+        changes[i] = 0
+        for j in range(ny):
+            for k in range(nz):
+                y = image[i, j, k]
+                _neighbour_agreement(seg, np.int64(i), j, k, n_classes, agreement)
+                best = 0
+                best_energy = np.inf
+                for l in range(n_classes):
+                    e = (y - mu[l]) ** 2 / (2 * sigmasq[l]) + 0.5 * np.log(2 * np.pi * sigmasq[l]) - \
+                        beta * agreement[l]
+                    if e < best_energy:
+                        best_energy = e
+                        best = l
+                new_seg[i, j, k] = best
+                if best_energy > -np.inf:
+                    energy[i] += best_energy
+                if best != seg[i, j, k]:
+                    changes[i] += 1
+
+
+def _lloyd_1d(centers, counts, mu, n_iter):
+    """
+    Lloyd iterations on a histogram from the means mu. A cluster left empty is moved to the non-empty bin farthest
+    from the current means. Returns the means and the within-cluster sum of squares.
+    """
+    for _ in range(n_iter):
+        labels = np.argmin(np.abs(centers[:, None] - mu[None, :]), axis=1)
+        new_mu = mu.copy()
+        for l in range(len(mu)):
+            weight = counts[labels == l].sum()
+            if weight > 0:
+                new_mu[l] = np.sum(counts[labels == l] * centers[labels == l]) / weight
+            else:
+                distance = np.where(counts > 0, np.min(np.abs(centers[:, None] - new_mu[None, :]), axis=1), -1)
+                new_mu[l] = centers[np.argmax(distance)]
+        if np.allclose(new_mu, mu):
+            break
+        mu = new_mu
+    labels = np.argmin(np.abs(centers[:, None] - mu[None, :]), axis=1)
+    return mu, np.sum(counts * (centers - mu[labels]) ** 2)
+
+
+def _kmeans_1d(values, n_classes, tissue=None, n_iter=50):
+    """
+    k-means of the intensities, computed on their histogram. The first cluster (background) starts at the minimum
+    intensity and the others are seeded from the tissue intensities only, so that a large background does not pull
+    several seeds to zero: once evenly spaced over the 1-99 percentile range and once at the quantiles. The seeding
+    with the lowest within-cluster sum of squares is kept. Returns the sorted cluster means and variances.
+
+    :param tissue: Boolean array selecting the tissue voxels of values. default=None (the non-zero values)
+    """
+    counts, edges = np.histogram(values, bins=1024)
+    centers = (edges[:-1] + edges[1:]) / 2
+    tissue_values = values[values != 0] if tissue is None else values[tissue]
+    if tissue_values.size == 0:
+        tissue_values = values
+    low, high = np.percentile(tissue_values, [1, 99])
+    steps = (np.arange(n_classes - 1) + 0.5) / (n_classes - 1)
+    best = None
+    for seeds in (low + steps * (high - low), np.quantile(tissue_values, steps)):
+        mu, inertia = _lloyd_1d(centers, counts, np.concatenate([[values.min()], seeds]), n_iter)
+        if best is None or inertia < best[1]:
+            best = (mu, inertia)
+    mu = np.sort(best[0])
+    labels = np.argmin(np.abs(centers[:, None] - mu[None, :]), axis=1)
+    sigmasq = np.ones(n_classes)
+    for l in range(n_classes):
+        weight = counts[labels == l].sum()
+        if weight > 1:
+            sigmasq[l] = max(np.sum(counts[labels == l] * (centers[labels == l] - mu[l]) ** 2) / weight, 1e-8)
+    return mu, sigmasq
+
+
+def _crop_box(mask, margin=1):
+    indices = np.nonzero(mask)
+    if len(indices[0]) == 0:
+        return tuple(slice(0, s) for s in mask.shape)
+    return tuple(slice(max(int(idx.min()) - margin, 0), min(int(idx.max()) + margin + 1, s))
+                 for idx, s in zip(indices, mask.shape))
+
+
+def hmrf_segmentation(image, nclasses, beta, mask=None, tolerance=1e-05, max_iter=100, min_change_rate=None,
+                      init="uniform", core_count=1, seed=0):
+    """
+    Tissue segmentation with the Hidden Markov Random Field model of dipy's TissueClassifierHMRF (Gaussian classes
+    and Ising prior on the 6-neighbourhood, parameters estimated by EM and labels updated by synchronous ICM), computed
+    with multi-threaded numba kernels on the bounding box of the mask only. The voxels outside the bounding box are
+    background. With the default arguments, the segmentation follows TissueClassifierHMRF.classify step by step; the
+    labels match dipy's while the PVE of boundary voxels varies with the random noise put on the zero voxels, as much
+    as between two runs of dipy.
+
+    :param image: 3-D array. Structural image (e.g. brain extracted T1).
+    :param nclasses: Number of tissue classes, without the background.
+    :param beta: Smoothing parameter of the Ising prior.
+    :param mask: 3-D array, optional. Region of interest; the default is the non-zero voxels of the image.
+    :param tolerance: The iterations stop when the total energy varied by less than tolerance times its range over the
+        last five iterations (dipy's criterion, disabled with 0). default=1e-05
+    :param max_iter: Maximum number of iterations. default=100
+    :param min_change_rate: If set, the iterations also stop when the proportion of voxels whose label changes during
+        an iteration falls below this value. default=None
+    :param init: Either 'uniform' (evenly spaced class means, as dipy) or 'kmeans' (k-means of the intensities).
+        default='uniform'
+    :param core_count: Number of threads used by the kernels. default=1
+    :param seed: Seed of the small noise added to the zero voxels (as dipy does, to avoid degenerate classes).
+        default=0
+    :return: initial_segmentation, final_segmentation (int16, 0 for the background) and PVE (float32, probability of
+        each tissue class, without the background).
+    """
+    assert init in ["uniform", "kmeans"], "init must be either 'uniform' or 'kmeans'"
+
+    n_classes = nclasses + 1  # One extra class for the background
+    image = np.asarray(image, dtype=np.float64)
+    if image.max() > 1:
+        image = np.interp(image, [0, image.max()], [0.0, 1.0])
+    box = _crop_box(image != 0 if mask is None else mask)
+    data = np.ascontiguousarray(image[box])
+
+    if init == "kmeans":
+        tissue = None if mask is None else (np.asarray(mask)[box] > 0) & (data != 0)
+        mu, sigmasq = _kmeans_1d(data.ravel(), n_classes, None if tissue is None else tissue.ravel())
+    else:
+        mu = data.min() + np.arange(n_classes) * (data.max() - data.min()) / n_classes
+        sigmasq = np.ones(n_classes)
+    seg_init = np.argmin((data[..., None] - mu) ** 2 / (2 * sigmasq) + 0.5 * np.log(2 * np.pi * sigmasq),
+                         axis=-1).astype(np.int16)
+
+    rng = np.random.default_rng(seed)
+    zeros = data == 0
+    noise = 0.001 + rng.normal(0, 1e-4, int(zeros.sum()))
+    if init == "kmeans":
+        # the k-means background holds only zero voxels: its statistics are taken on the noisy zeros seen by the EM,
+        # otherwise its variance vanishes and the background is absorbed by the first tissue class
+        data[zeros] = noise
+    for l in range(n_classes):
+        values = data[seg_init == l]
+        if values.size > 0:
+            mu[l], sigmasq[l] = values.mean(), values.var()
+    sigmasq = np.maximum(sigmasq, 1e-12)
+    data[zeros] = noise
+
+    n_slabs = data.shape[0]
+    pve = np.zeros(data.shape + (n_classes,))
+    stats = np.zeros((n_slabs, n_classes, 3))
+    energy = np.zeros(n_slabs)
+    changes = np.zeros(n_slabs, dtype=np.int64)
+    seg = seg_init.copy()
+    new_seg = np.empty_like(seg)
+    energy_sum = [1e-05]
+
+    previous_threads = numba.get_num_threads()
+    numba.set_num_threads(numba_threads(core_count))
+    try:
+        for i in range(max_iter):
+            _em_kernel(data, seg, beta, mu, sigmasq, pve, stats)
+            # Slab sums are reduced in a fixed order, so that the result does not depend on core_count
+            total = stats.sum(axis=0)
+            # a class whose posterior vanished everywhere keeps its parameters instead of becoming NaN
+            empty = total[:, 0] <= 0
+            weight = np.where(empty, 1., total[:, 0])
+            mu_upd = np.where(empty, mu, total[:, 1] / weight)
+            sigmasq_upd = np.where(empty, sigmasq, np.maximum(total[:, 2] / weight, 1e-12))
+            order = np.argsort(mu_upd)
+            mu_upd, sigmasq_upd = mu_upd[order], sigmasq_upd[order]
+
+            _icm_kernel(data, seg, beta, mu_upd, sigmasq_upd, new_seg, energy, changes)
+            energy_sum.append(energy.sum())
+
+            seg, new_seg = new_seg, seg
+            mu, sigmasq = mu_upd, sigmasq_upd
+
+            if tolerance > 0 and i > 5:
+                e_sum = np.asarray(energy_sum)
+                e_end = e_sum[-5:]
+                if np.abs(np.amax(e_end) - np.amin(e_end)) < tolerance * (np.amax(e_sum) - np.amin(e_sum)):
+                    break
+            if min_change_rate is not None and changes.sum() < min_change_rate * seg.size:
+                break
+    finally:
+        numba.set_num_threads(previous_threads)
+
+    initial_segmentation = np.zeros(image.shape, dtype=np.int16)
+    initial_segmentation[box] = seg_init
+    final_segmentation = np.zeros(image.shape, dtype=np.int16)
+    final_segmentation[box] = seg
+    PVE = np.zeros(image.shape + (nclasses,), dtype=np.float32)
+    PVE[box] = pve[..., 1:]
+    return initial_segmentation, final_segmentation, PVE
@@ -0,0 +1,910 @@
+"""
+ Group statistics helpers: out-of-core group stacks, permutation inference on the general linear model (GLM) and
+ tract-based spatial statistics (TBSS) skeleton projection.
+"""
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+
+_glm_worker_state = {}
+
+
+class GroupStack:
+    """
+    Out-of-core 4-D group stack: one float32 volume per subject in a raw memory-mapped file, the subjects along the
+    slowest axis. New subjects are appended at the end of the file without rewriting the others, and the volumes of
+    subjects whose source file changed are overwritten in place. The directory of the stack holds data.raw and
+    stack.json (shape, affine, subjects with the source file and modification time of each volume).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "stack.json")) as f:
+            info = json.load(f)
+        self.shape = tuple(info["shape"])
+        self.affine = np.array(info["affine"])
+        self.subjects = info["subjects"]
+        self.sources = info["sources"]
+
+    @classmethod
+    def create(cls, path, shape, affine):
+        """
+        Creates an empty stack, or opens the existing one if it has the same shape and affine.
+        """
+        if os.path.isfile(os.path.join(path, "stack.json")):
+            stack = cls(path)
+            if stack.shape == tuple(shape[:3]) and np.allclose(stack.affine, affine):
+                return stack
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        open(os.path.join(path, "data.raw"), "wb").close()
+        info = {"shape": [int(v) for v in shape[:3]], "affine": np.asarray(affine).tolist(), "subjects": [],
+                "sources": []}
+        _write_json(os.path.join(path, "stack.json"), info)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def data(self, mode='r'):
+        """
+        Memory-mapped array (n_subjects, x, y, z) of the stack.
+        """
+        if len(self) == 0:
+            return np.zeros((0,) + self.shape, dtype=np.float32)
+        return np.memmap(os.path.join(self.path, "data.raw"), dtype=np.float32, mode=mode,
+                         shape=(len(self),) + self.shape)
+
+    def rows(self, subjects=None):
+        return list(range(len(self))) if subjects is None else [self.subjects.index(s) for s in subjects]
+
+    def _save_info(self):
+        _write_json(os.path.join(self.path, "stack.json"),
+                    {"shape": list(self.shape), "affine": self.affine.tolist(), "subjects": self.subjects,
+                     "sources": self.sources})
+
+    def _allocate(self, subjects, sources):
+        """
+        Returns the rows of the subjects whose source is new or modified, appending the new subjects to the file.
+        """
+        rows = []
+        for subject, source in zip(subjects, sources):
+            if subject in self.subjects:
+                row = self.subjects.index(subject)
+                if self.sources[row] != source:
+                    self.sources[row] = source
+                    rows.append(row)
+            else:
+                self.subjects.append(subject)
+                self.sources.append(source)
+                rows.append(len(self.subjects) - 1)
+        with open(os.path.join(self.path, "data.raw"), "r+b") as f:
+            f.truncate(len(self) * int(np.prod(self.shape)) * 4)
+        return rows
+
+    def add(self, subjects, files, core_count=1):
+        """
+        Loads the volumes of the subjects concurrently into the stack. Subjects whose file has not changed since it was
+        stacked are skipped.
+
+        :param subjects: List of subject names.
+        :param files: List of 3-D NIfTI files, one per subject. Files stored in the compact format are copied from their
+            voxel table without building the dense volume.
+        :param core_count: Number of concurrent loads. default=1
+        :return: Number of volumes written.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from elikopy.storage import load_voxels, image_mtime
+
+        sources = [[os.path.abspath(f), image_mtime(f)] for f in files]
+        rows = self._allocate(subjects, sources)
+        if len(rows) == 0:
+            return 0
+        data = self.data('r+')
+
+        def load(row):
+            table, mask = load_voxels(self.sources[row][0], dtype="float32")
+            assert mask.shape == self.shape and table.shape[1] == 1, "Shape mismatch for " + self.sources[row][0]
+            volume = data[row].reshape(-1)
+            if table.shape[0] == volume.size:
+                volume[:] = table[:, 0]
+            else:
+                volume[:] = 0
+                volume[np.flatnonzero(mask)] = table[:, 0]
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, core_count)) as executor:
+                list(executor.map(load, rows))
+            data.flush()
+        except BaseException:
+            # the volumes that may not have been written are reloaded next time
+            for row in rows:
+                self.sources[row] = None
+            raise
+        finally:
+            self._save_info()
+        return len(rows)
+
+    def smooth(self, path, sigma=1.0, core_count=1, chunk_size=8):
+        """
+        Smooths every volume with a separable 3-D Gaussian kernel into another stack (as mrfilter smooth). Only the
+        volumes that are new or changed since the last call are smoothed. Chunks of chunk_size volumes are processed in
+        parallel across core_count processes sharing the memory-mapped stacks.
+
+        :param path: Directory of the smoothed stack.
+        :param sigma: Standard deviation of the kernel in voxels. default=1
+        :param core_count: Number of worker processes. default=1
+        :param chunk_size: Number of volumes per task. default=8
+        :return: The smoothed GroupStack.
+        """
+        out = GroupStack.create(path, self.shape, self.affine)
+        if out.sources and out.sources[0] is not None and out.sources[0][-1] != sigma:
+            shutil.rmtree(path)
+            out = GroupStack.create(path, self.shape, self.affine)
+        sources = [None if source is None else source + [sigma] for source in self.sources]
+        out_rows = out._allocate(self.subjects, sources)
+        out._save_info()
+        pairs = [(self.subjects.index(out.subjects[row]), row) for row in out_rows]
+        chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+        initargs = (self.path, len(self), out.path, len(out), self.shape, sigma)
+        try:
+            if core_count > 1 and len(chunks) > 1:
+                from elikopy.resources import process_pool
+                with process_pool(min(core_count, len(chunks)), initializer=_init_smooth_worker,
+                                  initargs=initargs) as executor:
+                    list(executor.map(_smooth_chunk, chunks))
+            else:
+                _init_smooth_worker(*initargs)
+                try:
+                    for chunk in chunks:
+                        _smooth_chunk(chunk)
+                finally:
+                    _smooth_worker_state.clear()
+        except BaseException:
+            for _, row in pairs:
+                out.sources[row] = None
+            out._save_info()
+            raise
+        return out
+
+    def mean(self, subjects=None):
+        total = np.zeros(self.shape, dtype=np.float64)
+        data = self.data()
+        rows = self.rows(subjects)
+        for row in rows:
+            total += data[row]
+        return total / max(1, len(rows))
+
+    def to_nifti(self, fname, subjects=None, mask=None, hdr=None):
+        """
+        Writes the volumes of the subjects (default: all, in the order of the stack) as a 4-D NIfTI file, streaming one
+        volume at a time.
+        """
+        from elikopy.storage import save_nifti_volumes
+
+        data = self.data()
+        rows = self.rows(subjects)
+        volumes = (data[row] if mask is None else data[row] * mask for row in rows)
+        save_nifti_volumes(fname, volumes, len(rows), self.affine, hdr)
+
+
+_smooth_worker_state = {}
+
+
+def _write_json(path, info):
+    with open(path + ".tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(path + ".tmp", path)
+
+
+def _init_smooth_worker(in_path, in_len, out_path, out_len, shape, sigma):
+    _smooth_worker_state["in"] = np.memmap(os.path.join(in_path, "data.raw"), dtype=np.float32, mode='r',
+                                           shape=(in_len,) + tuple(shape))
+    _smooth_worker_state["out"] = np.memmap(os.path.join(out_path, "data.raw"), dtype=np.float32, mode='r+',
+                                            shape=(out_len,) + tuple(shape))
+    _smooth_worker_state["sigma"] = sigma
+
+
+def _smooth_chunk(pairs):
+    from scipy import ndimage
+
+    state = _smooth_worker_state
+    for in_row, out_row in pairs:
+        state["out"][out_row] = ndimage.gaussian_filter(np.asarray(state["in"][in_row]), state["sigma"])
+    state["out"].flush()
+
+
+def read_vest(path):
+    """
+    Reads a matrix in the FSL VEST format (design.mat, design.con, ...).
+
+    :param path: Path to the VEST file.
+    :return: 2-D array of the /Matrix section.
+    """
+    rows = []
+    in_matrix = False
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("/Matrix"):
+                in_matrix = True
+            elif in_matrix and len(line) > 0 and not line.startswith("/"):
+                rows.append([float(v) for v in line.split()])
+    return np.atleast_2d(np.array(rows, dtype=np.float64))
+
+
+def glm_tstat(Y, X, C):
+    """
+    Ordinary least squares fit of the GLM Y = X b + e and t statistics of the contrasts.
+
+    :param Y: 2-D array (n_subjects, n_voxels) of the data.
+    :param X: 2-D array (n_subjects, n_regressors) of the design matrix.
+    :param C: 2-D array (n_contrasts, n_regressors) of the contrasts.
+    :return: 2-D array (n_contrasts, n_voxels) of t statistics.
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    XtX_inv = np.linalg.pinv(X.T @ X)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    return _tstat(X.T @ Y, np.einsum('ij,ij->j', Y, Y), XtX_inv, np.asarray(C, dtype=np.float64), dof)
+
+
+def _tstat(XtY, YtY, XtX_inv, C, dof):
+    """
+    t statistics of the contrasts from the sufficient statistics X'Y (..., n_regressors, n_voxels) and Y'Y (n_voxels).
+    X'X is invariant under the permutations and sign flips of the rows of X, so that a batch of permuted designs only
+    changes X'Y.
+    """
+    beta = XtX_inv @ XtY
+    rss = YtY - np.einsum('...rv,...rv->...v', beta, XtY)
+    sigma2 = np.maximum(rss, 0) / dof
+    var_c = np.einsum('cr,rs,cs->c', C, XtX_inv, C)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (C @ beta) / np.sqrt(sigma2[..., None, :] * var_c[:, None])
+    return np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def tfce(stat, H=2.0, E=0.5, connectivity=26, n_steps=100, dh=None):
+    """
+    Threshold-free cluster enhancement (Smith and Nichols, 2009) of the positive part of a statistic volume.
+
+    :param stat: 3-D array of the statistic.
+    :param H: Height exponent. default=2
+    :param E: Extent exponent. default=0.5 (use E=1 on a skeleton, as randomise --T2)
+    :param connectivity: 6, 18 or 26 neighbourhood. default=26
+    :param n_steps: Number of thresholds when dh is not given. default=100
+    :param dh: Step between two thresholds. default=max(stat)/n_steps
+    :return: 3-D array of the TFCE scores.
+    """
+    from scipy import ndimage
+
+    structure = ndimage.generate_binary_structure(3, {6: 1, 18: 2, 26: 3}[connectivity])
+    out = np.zeros(stat.shape, dtype=np.float64)
+    positive = stat > 0
+    if not positive.any():
+        return out
+
+    # work on the bounding box of the supra-threshold voxels
+    box = ndimage.find_objects(positive.astype(np.int8))[0]
+    sub = stat[box]
+    sub_out = out[box]
+    max_stat = float(sub.max())
+    dh = max_stat / n_steps if dh is None else dh
+    for h in np.arange(dh, max_stat + dh, dh):
+        labels, n_labels = ndimage.label(sub >= h, structure=structure)
+        if n_labels == 0:
+            break
+        extent = np.bincount(labels.ravel())
+        extent[0] = 0
+        sub_out += (extent.astype(np.float64) ** E)[labels] * (h ** H) * dh
+    return out
+
+
+def _init_glm_worker(Y_path, X, C, dof, mask_indices, shape, observed_t, observed_tfce, tfce_kwargs):
+    """
+    Initializer of the permutation workers. The data matrix is shared through a memory-mapped .npy file.
+    """
+    Y = np.load(Y_path, mmap_mode='r')
+    _glm_worker_state["Y"] = Y
+    _glm_worker_state["YtY"] = np.einsum('ij,ij->j', Y, Y)
+    _glm_worker_state["X"] = X
+    _glm_worker_state["C"] = C
+    _glm_worker_state["XtX_inv"] = np.linalg.pinv(X.T @ X)
+    _glm_worker_state["dof"] = dof
+    _glm_worker_state["mask_indices"] = mask_indices
+    _glm_worker_state["shape"] = shape
+    _glm_worker_state["observed_t"] = observed_t
+    _glm_worker_state["observed_tfce"] = observed_tfce
+    _glm_worker_state["tfce_kwargs"] = tfce_kwargs
+
+
+def _permutation_batch(rows, signs):
+    """
+    Computes the statistics of a batch of permuted designs X[rows] * signs as one matrix product over the voxels.
+
+    :return: Tuple (max_t, max_tfce, t_counts, tfce_counts): maxima of each permutation and contrast, and number of
+    permutations exceeding the observed statistic in each voxel.
+    """
+    state = _glm_worker_state
+    Y, X, C = state["Y"], state["X"], state["C"]
+    Xp = X[rows] * signs[..., None]
+    XtY = np.matmul(np.transpose(Xp, (0, 2, 1)), Y)
+    t = _tstat(XtY, state["YtY"], state["XtX_inv"], C, state["dof"])
+
+    max_t = t.max(axis=2)
+    t_counts = (t >= state["observed_t"][None] - 1e-10).sum(axis=0)
+    max_tfce = np.zeros_like(max_t)
+    tfce_counts = None
+    if state["tfce_kwargs"] is not None:
+        tfce_counts = np.zeros(t_counts.shape, dtype=np.int64)
+        volume = np.zeros(int(np.prod(state["shape"])), dtype=np.float64)
+        for b in range(t.shape[0]):
+            for c in range(t.shape[1]):
+                volume[state["mask_indices"]] = t[b, c]
+                enhanced = tfce(volume.reshape(state["shape"]), **state["tfce_kwargs"]).ravel()[state["mask_indices"]]
+                max_tfce[b, c] = enhanced.max()
+                tfce_counts[c] += enhanced >= state["observed_tfce"][c] - 1e-10
+    return max_t, max_tfce, t_counts, tfce_counts
+
+
+def _draw_designs(n_subjects, n_perm, sign_flip, seed):
+    """
+    Returns the rows and signs of the permuted designs, the first one being the unpermuted design.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.tile(np.arange(n_subjects), (n_perm, 1))
+    signs = np.ones((n_perm, n_subjects))
+    for i in range(1, n_perm):
+        if sign_flip:
+            signs[i] = rng.choice([-1.0, 1.0], size=n_subjects)
+        else:
+            rows[i] = rng.permutation(n_subjects)
+    return rows, signs
+
+
+def permutation_glm(data_file, mask_file, design_mat, design_con, output_prefix, n_perm=5000, use_tfce=True,
+                    tfce_H=2.0, tfce_E=0.5, connectivity=26, core_count=1, batch_size=50, seed=0, tmp_dir=None,
+                    subjects=None):
+    """
+    In-process replacement of FSL randomise for t contrasts: permutation inference on the GLM with voxel-wise and
+    TFCE statistics, uncorrected and family-wise error (max statistic) corrected. The outputs follow the randomise
+    naming, <output_prefix>_tstat<i>, _vox_p_tstat<i>, _vox_corrp_tstat<i>, _tfce_p_tstat<i> and _tfce_corrp_tstat<i>,
+    p-values being stored as 1-p.
+
+    The rows of the design are permuted (sign-flipped for one-sample designs) instead of the data, and the permutations
+    are processed by batches of matrix products over the masked voxels, in parallel across core_count processes.
+
+    :param data_file: Path to the 4-D NIfTI of the subjects (e.g. all_FA_skeletonised.nii.gz), or a GroupStack.
+    :param mask_file: Path to the 3-D NIfTI mask (e.g. mean_FA_skeleton_mask.nii.gz).
+    :param design_mat: Path to the design matrix (VEST format).
+    :param design_con: Path to the t contrasts (VEST format).
+    :param output_prefix: Prefix of the output files.
+    :param n_perm: Number of permutations, including the unpermuted design. default=5000
+    :param use_tfce: Compute the TFCE statistics. default=True
+    :param tfce_H: TFCE height exponent. default=2
+    :param tfce_E: TFCE extent exponent, 0.5 for 3-D data and 1 for skeletons (randomise --T2). default=0.5
+    :param connectivity: TFCE neighbourhood (6, 18 or 26), 6 as randomise -T and 26 as randomise --T2. default=26
+    :param core_count: Number of worker processes. default=1
+    :param batch_size: Number of permutations per matrix product. default=50
+    :param seed: Seed of the random permutations. default=0
+    :param tmp_dir: Directory of the shared memory-mapped data matrix. default=system temporary directory
+    :param subjects: Subjects of the GroupStack, in the order of the design. default=all the subjects of the stack
+    :return: Dictionary of the output arrays (n_contrasts, n_voxels) in the mask.
+    """
+    from elikopy.storage import load_nifti, save_nifti
+
+    if isinstance(data_file, GroupStack):
+        data, affine = None, data_file.affine
+        rows = data_file.rows(subjects)
+        n_subjects = len(rows)
+    else:
+        data, affine = load_nifti(data_file)
+        n_subjects = data.shape[-1]
+    mask, _ = load_nifti(mask_file)
+    mask = mask > 0
+    shape = mask.shape
+    mask_indices = np.flatnonzero(mask)
+    X = read_vest(design_mat)
+    C = read_vest(design_con)
+    assert n_subjects == X.shape[0], "The design matrix and the data do not have the same number of subjects"
+    assert C.shape[1] == X.shape[1], "The contrasts and the design matrix do not have the same number of regressors"
+
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    sign_flip = X.shape[1] == 1 or np.all(np.ptp(X, axis=0) == 0)
+    tfce_kwargs = {"H": tfce_H, "E": tfce_E, "connectivity": connectivity} if use_tfce else None
+
+    work_dir = tempfile.mkdtemp(prefix="elikopy_glm_", dir=tmp_dir)
+    try:
+        Y_path = os.path.join(work_dir, "Y.npy")
+        Y = np.lib.format.open_memmap(Y_path, mode='w+', dtype=np.float64, shape=(X.shape[0], len(mask_indices)))
+        if data is None:
+            stack = data_file.data()
+            for i, row in enumerate(rows):
+                Y[i] = stack[row][mask]
+            del stack
+        else:
+            Y[:] = data[mask].T
+        Y.flush()
+        del Y, data
+
+        # observed statistics
+        observed_t = glm_tstat(np.load(Y_path, mmap_mode='r'), X, C)
+        observed_tfce = None
+        if use_tfce:
+            observed_tfce = np.zeros_like(observed_t)
+            volume = np.zeros(int(np.prod(shape)), dtype=np.float64)
+            for c in range(C.shape[0]):
+                volume[mask_indices] = observed_t[c]
+                observed_tfce[c] = tfce(volume.reshape(shape), **tfce_kwargs).ravel()[mask_indices]
+
+        rows, signs = _draw_designs(X.shape[0], max(1, int(n_perm)), sign_flip, seed)
+        batches = [(rows[i:i + batch_size], signs[i:i + batch_size]) for i in range(0, len(rows), batch_size)]
+        initargs = (Y_path, X, C, dof, mask_indices, shape, observed_t, observed_tfce, tfce_kwargs)
+
+        if core_count > 1 and len(batches) > 1:
+            from elikopy.resources import process_pool
+            with process_pool(min(core_count, len(batches)), initializer=_init_glm_worker,
+                              initargs=initargs) as executor:
+                results = list(executor.map(_permutation_batch, *zip(*batches)))
+        else:
+            _init_glm_worker(*initargs)
+            try:
+                results = [_permutation_batch(batch_rows, batch_signs) for batch_rows, batch_signs in batches]
+            finally:
+                _glm_worker_state.clear()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    n_total = len(rows)
+    max_t = np.concatenate([r[0] for r in results])
+    outputs = {"tstat": observed_t,
+               "vox_p": sum(r[2] for r in results) / n_total,
+               "vox_corrp": (max_t[:, :, None] >= observed_t[None] - 1e-10).sum(axis=0) / n_total}
+    if use_tfce:
+        max_tfce = np.concatenate([r[1] for r in results])
+        outputs["tfce_p"] = sum(r[3] for r in results) / n_total
+        outputs["tfce_corrp"] = (max_tfce[:, :, None] >= observed_tfce[None] - 1e-10).sum(axis=0) / n_total
+
+    for name, values in outputs.items():
+        for c in range(C.shape[0]):
+            volume = np.zeros(shape, dtype=np.float32)
+            if name == "tstat":
+                volume[mask] = values[c]
+                save_nifti(output_prefix + "_tstat" + str(c + 1) + ".nii.gz", volume, affine)
+            else:
+                volume[mask] = 1 - values[c]
+                save_nifti(output_prefix + "_" + name + "_tstat" + str(c + 1) + ".nii.gz", volume, affine)
+    return outputs
+
+
+def check_permutation_glm(n_perm=5000, seed=0, tmp_dir=None, tolerance=0.03):
+    """
+    Checks permutation_glm on synthetic data with known statistics: two groups of three subjects on a 4x4x4 volume of
+    noise, with one voxel where the groups are perfectly separated. The t statistics are compared to the two-sample t
+    test of scipy (and their squares to the one-way ANOVA F), the uncorrected and family-wise error corrected voxel
+    p-values to the exact permutation distribution, obtained by enumerating the 20 splits of the subjects into two
+    groups. The separated voxel has the largest t of all the splits, its exact corrected p-value is therefore 1/20.
+
+    :param n_perm: Number of permutations of permutation_glm. default=5000
+    :param seed: Seed of the data and of the permutations. default=0
+    :param tmp_dir: Directory of the temporary files. default=system temporary directory
+    :param tolerance: Maximum difference between the Monte Carlo and the exact p-values. default=0.03
+    :return: Dictionary of the maximum absolute differences to the known values.
+    """
+    import itertools
+    from scipy import stats as sp_stats
+    from elikopy.storage import save_nifti
+
+    rng = np.random.default_rng(seed)
+    shape = (4, 4, 4)
+    data = rng.normal(size=shape + (6,))
+    data[1, 2, 3] = [20.0, 21.0, 19.0, 0.0, 1.0, -1.0]
+    X = np.array([[1, 0]] * 3 + [[0, 1]] * 3, dtype=np.float64)
+    C = np.array([[1, -1], [-1, 1]], dtype=np.float64)
+
+    work_dir = tempfile.mkdtemp(prefix="elikopy_glm_check_", dir=tmp_dir)
+    try:
+        save_nifti(work_dir + "/data.nii.gz", data, np.eye(4))
+        save_nifti(work_dir + "/mask.nii.gz", np.ones(shape, dtype=np.float32), np.eye(4))
+        for name, matrix in (("design.mat", X), ("design.con", C)):
+            with open(work_dir + "/" + name, "w") as f:
+                f.write("/NumWaves 2\n/Matrix\n")
+                f.writelines(" ".join(str(v) for v in row) + "\n" for row in matrix)
+        outputs = permutation_glm(work_dir + "/data.nii.gz", work_dir + "/mask.nii.gz", work_dir + "/design.mat",
+                                  work_dir + "/design.con", work_dir + "/check", n_perm=n_perm, use_tfce=False,
+                                  seed=seed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # the data are read back with the precision policy of the study
+    Y = data.astype(np.float32).astype(np.float64).reshape((-1, 6)).T
+    expected_t = sp_stats.ttest_ind(Y[:3], Y[3:], axis=0).statistic
+    expected_f = sp_stats.f_oneway(Y[:3], Y[3:], axis=0).statistic
+
+    # exact permutation distribution: t of every split of the subjects into two groups of three
+    split_t = []
+    for group in itertools.combinations(range(6), 3):
+        Xs = np.zeros_like(X)
+        Xs[list(group), 0] = 1
+        Xs[:, 1] = 1 - Xs[:, 0]
+        split_t.append(glm_tstat(Y, Xs, C))
+    split_t = np.array(split_t)
+    observed = glm_tstat(Y, X, C)
+    exact_p = (split_t >= observed[None] - 1e-10).mean(axis=0)
+    exact_corrp = (split_t.max(axis=2)[:, :, None] >= observed[None] - 1e-10).mean(axis=0)
+
+    errors = {"tstat": float(np.abs(outputs["tstat"][0] - expected_t).max()),
+              "fstat": float(np.abs(outputs["tstat"][0] ** 2 - expected_f).max() / expected_f.max()),
+              "vox_p": float(np.abs(outputs["vox_p"] - exact_p).max()),
+              "vox_corrp": float(np.abs(outputs["vox_corrp"] - exact_corrp).max()),
+              "separated_corrp": float(abs(outputs["vox_corrp"][0, np.ravel_multi_index((1, 2, 3), shape)] - 1 / 20))}
+    assert errors["tstat"] < 1e-6 and errors["fstat"] < 1e-6, "Wrong t statistics: " + str(errors)
+    assert max(errors["vox_p"], errors["vox_corrp"], errors["separated_corrp"]) < tolerance, \
+        "Wrong permutation p-values: " + str(errors)
+    return errors
+
+
+def _run_commands(commands, cwd, core_count=1, log=None):
+    """
+    Runs independent shell commands (e.g. one applywarp per subject) concurrently on core_count threads.
+
+    :return: List of the return codes.
+    """
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(command):
+        if log is not None:
+            log.write(command + "\n")
+            log.flush()
+        return subprocess.run(command, shell=True, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                              universal_newlines=True).returncode
+
+    with ThreadPoolExecutor(max_workers=max(1, core_count)) as executor:
+        return list(executor.map(run, commands))
+
+
+def skeleton_directions(mean_FA, mask, sigma=1.0):
+    """
+    Direction perpendicular to the tracts in each voxel of the mask. Away from a ridge of the smoothed mean FA, this is
+    the direction of the FA gradient, pointing to the ridge. Close to it (the Newton step to the ridge is shorter than
+    half a voxel), the gradient vanishes and the eigenvector of the most negative eigenvalue of the Hessian, across
+    which the FA falls off the fastest, is used instead.
+
+    :param mean_FA: 3-D array of the mean FA.
+    :param mask: 3-D boolean array of the voxels of interest.
+    :param sigma: Standard deviation (in voxels) of the Gaussian smoothing. default=1
+    :return: 2-D array (n_voxels, 3) of unit vectors, in the order of np.nonzero(mask).
+    """
+    from scipy import ndimage
+
+    fa = np.asarray(mean_FA, dtype=np.float64)
+    if sigma > 0:
+        fa = ndimage.gaussian_filter(fa, sigma)
+    n_voxels = int(np.count_nonzero(mask))
+    gradient = np.empty((n_voxels, 3))
+    hessian = np.empty((n_voxels, 3, 3))
+    gradients = np.gradient(fa)
+    for i in range(3):
+        gradient[:, i] = gradients[i][mask]
+        second = np.gradient(gradients[i])
+        for j in range(i, 3):
+            hessian[:, i, j] = second[j][mask]
+            hessian[:, j, i] = hessian[:, i, j]
+    del gradients
+    eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+    directions = eigenvectors[:, :, 0]
+    norm = np.linalg.norm(gradient, axis=1)
+    away = norm > 0.5 * np.abs(eigenvalues[:, 0])
+    directions[away] = gradient[away] / norm[away, None]
+    return directions
+
+
+def skeletonise(mean_FA, mask, sigma=1.0):
+    """
+    Thin skeleton of the mean FA: voxels that are a local maximum of the FA along their perpendicular direction (see
+    skeleton_directions), as tbss_skeleton -o.
+
+    :param mean_FA: 3-D array of the mean FA.
+    :param mask: 3-D boolean array of the voxels to consider (mean_FA_mask).
+    :param sigma: Standard deviation (in voxels) of the smoothing used for the directions. default=1
+    :return: 3-D boolean array of the skeleton.
+    """
+    from scipy import ndimage
+
+    mask = np.asarray(mask, dtype=bool)
+    mean_FA = np.asarray(mean_FA, dtype=np.float64)
+    coords = np.argwhere(mask).astype(np.float64)
+    directions = skeleton_directions(mean_FA, mask, sigma)
+    center = mean_FA[mask]
+    plus = ndimage.map_coordinates(mean_FA, (coords + directions).T, order=1, mode='constant')
+    minus = ndimage.map_coordinates(mean_FA, (coords - directions).T, order=1, mode='constant')
+    skeleton = np.zeros(mask.shape, dtype=bool)
+    skeleton[mask] = (center > 0) & (center >= plus) & (center >= minus) & ((center > plus) | (center > minus))
+    return skeleton
+
+
+def skeleton_search_index(mask, skeleton, directions, max_search=10):
+    """
+    Voxels searched for the projection of each skeleton voxel: the voxel itself and the voxels along its perpendicular
+    direction, on both sides, as long as they stay in the mask and keep moving away from the skeleton (the distance to
+    the skeleton and to the edge of the mask increases), so that a search never reaches the territory of another tract.
+
+    :param mask: 3-D boolean array (mean_FA_mask).
+    :param skeleton: 3-D boolean array of the thresholded skeleton.
+    :param directions: 2-D array (n_skeleton_voxels, 3) of the perpendicular directions, in the order of
+    np.nonzero(skeleton).
+    :param max_search: Maximum search distance in voxels on each side. default=10
+    :return: 2-D array (n_skeleton_voxels, 2*max_search+1) of flat voxel indices, -1 for unused entries.
+    """
+    from scipy import ndimage
+
+    shape = np.array(skeleton.shape)
+    distance = ndimage.distance_transform_edt(~(skeleton | ~mask)).ravel()
+    mask_flat = np.asarray(mask, dtype=bool).ravel()
+    coords = np.argwhere(skeleton).astype(np.float64)
+    candidates = np.full((len(coords), 2 * max_search + 1), -1, dtype=np.int64)
+    candidates[:, 0] = np.ravel_multi_index(coords.astype(np.int64).T, skeleton.shape)
+
+    column = 1
+    for sign in (1, -1):
+        alive = np.ones(len(coords), dtype=bool)
+        previous = np.zeros(len(coords))
+        for step in range(1, max_search + 1):
+            position = np.rint(coords + sign * step * directions).astype(np.int64)
+            inside = np.all((position >= 0) & (position < shape), axis=1)
+            flat = np.ravel_multi_index(np.clip(position, 0, shape - 1).T, skeleton.shape)
+            current = distance[flat]
+            alive &= inside & mask_flat[flat] & (current >= previous)
+            previous = np.where(alive, current, previous)
+            candidates[alive, column] = flat[alive]
+            column += 1
+    return candidates
+
+
+class TBSSSkeleton:
+    """
+    Thresholded mean FA skeleton with its projection search index, computed once for the study. Projecting a subject
+    picks, for each skeleton voxel, the maximum FA among its search candidates; the same voxels are then sampled in the
+    non-FA metrics of the subject (tbss_skeleton -a). The choices of every subject are kept with the index, so that
+    adding a metric costs one gather per subject and adding a subject one projection.
+    """
+
+    def __init__(self, shape, affine, candidates, subjects=None, choices=None):
+        self.shape = tuple(int(v) for v in shape)
+        self.affine = np.asarray(affine)
+        self.candidates = candidates
+        self.subjects = [] if subjects is None else list(subjects)
+        self.choices = np.zeros((0, len(candidates)), dtype=np.int64) if choices is None else choices
+
+    @classmethod
+    def from_mean_FA(cls, mean_FA, mask, affine, threshold=0.2, skeleton=None, sigma=1.0, max_search=10):
+        """
+        :param mean_FA: 3-D array of the mean FA.
+        :param mask: 3-D boolean array (mean_FA_mask).
+        :param affine: Affine of the standard space.
+        :param threshold: Threshold of the mean FA on the skeleton (tbss_4_prestats). default=0.2
+        :param skeleton: Precomputed skeleton (e.g. FMRIB58_FA-skeleton). default=skeletonise(mean_FA, mask)
+        :param sigma: Smoothing of the perpendicular directions. default=1
+        :param max_search: Maximum search distance in voxels. default=10
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if skeleton is None:
+            skeleton = skeletonise(mean_FA, mask, sigma)
+        skeleton = np.asarray(skeleton, dtype=bool) & mask & (np.asarray(mean_FA) > threshold)
+        directions = skeleton_directions(mean_FA, skeleton, sigma)
+        return cls(mean_FA.shape, affine, skeleton_search_index(mask, skeleton, directions, max_search))
+
+    @property
+    def indices(self):
+        """Flat indices of the skeleton voxels."""
+        return self.candidates[:, 0]
+
+    @property
+    def mask(self):
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[self.indices] = True
+        return mask.reshape(self.shape)
+
+    def project(self, fa):
+        """
+        Projects the FA of one subject onto the skeleton.
+
+        :param fa: 3-D array of the FA in the standard space.
+        :return: Tuple (values, choice) of the projected FA and of the flat index of the selected voxels.
+        """
+        fa = np.asarray(fa).ravel()
+        values = np.where(self.candidates >= 0, fa[np.maximum(self.candidates, 0)], -np.inf)
+        best = np.argmax(values, axis=1)
+        rows = np.arange(len(best))
+        return values[rows, best], self.candidates[rows, best]
+
+    def sample(self, volume, choice):
+        """
+        Samples a non-FA metric of one subject at the voxels selected by the projection of its FA.
+        """
+        return np.asarray(volume).ravel()[choice]
+
+    def add_subject(self, subject, choice):
+        if subject in self.subjects:
+            self.choices[self.subjects.index(subject)] = choice
+        else:
+            self.subjects.append(subject)
+            self.choices = np.vstack([self.choices, choice[None]])
+
+    def to_volume(self, values):
+        """
+        Scatters skeleton values (..., n_skeleton_voxels) back into volumes (x, y, z, ...).
+        """
+        values = np.atleast_2d(values)
+        volume = np.zeros((values.shape[0], int(np.prod(self.shape))), dtype=np.float32)
+        volume[:, self.indices] = values
+        volume = np.moveaxis(volume.reshape((values.shape[0],) + self.shape), 0, -1)
+        return volume[..., 0] if volume.shape[-1] == 1 else volume
+
+    def save(self, path):
+        np.savez(path, shape=np.array(self.shape), affine=self.affine, candidates=self.candidates,
+                 subjects=np.array(self.subjects, dtype=str), choices=self.choices)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["shape"], f["affine"], f["candidates"], [str(s) for s in f["subjects"]], f["choices"])
+
+
+def _tbss_subjects(folder_path):
+    """
+    Subjects of the TBSS registration, in the order of the 4-D stacks (sorted as the FSL image globs).
+    """
+    suffix = "_FA.nii.gz"
+    return sorted(f[:-len(suffix)] for f in os.listdir(folder_path + "/registration/origdata") if f.endswith(suffix))
+
+
+def _warp_outdated(commands_outputs, cwd, core_count=1, log=None):
+    """
+    Runs the applywarp commands whose output (relative to cwd) is missing or older than the warp and input files, so
+    that the subjects already warped are not warped again.
+
+    :param commands_outputs: List of tuples (command, output, inputs).
+    """
+    def outdated(output, inputs):
+        output = os.path.join(cwd, output)
+        if not os.path.isfile(output):
+            return True
+        return any(os.path.getmtime(os.path.join(cwd, f)) > os.path.getmtime(output) for f in inputs
+                   if os.path.isfile(os.path.join(cwd, f)))
+
+    _run_commands([command for command, output, inputs in commands_outputs if outdated(output, inputs)], cwd,
+                  core_count, log)
+
+
+def tbss_postreg(folder_path, postreg_type="-S", core_count=1, log=None):
+    """
+    In-process replacement of tbss_3_postreg: the FA of all the subjects are warped to the target concurrently and
+    stacked in the group stack registration/stats/all_FA.stack (see GroupStack), then the mean FA, its mask and its
+    skeleton are computed in registration/stats. Only the -T and -t registrations of tbss_2_reg (warps to
+    registration/FA/target) are supported. Subjects already warped and stacked are reused.
+
+    :param folder_path: Path to the root directory.
+    :param postreg_type: '-S' to derive the mean FA and skeleton from the study, '-T' to use FMRIB58_FA. default='-S'
+    :param core_count: Number of concurrent subjects. default=1
+    :param log: Opened log file. default=None
+    """
+    from elikopy.storage import save_nifti, load_nifti, load_image
+
+    fa_dir = folder_path + "/registration/FA"
+    stats_dir = folder_path + "/registration/stats"
+    assert os.path.isfile(fa_dir + "/target.nii.gz"), "The python TBSS engine requires a registration to a target (-T or -t)"
+    os.makedirs(stats_dir, exist_ok=True)
+    subjects = _tbss_subjects(folder_path)
+
+    _warp_outdated([("applywarp -i " + s + "_FA -o " + s + "_FA_to_target -r target -w " + s + "_FA_to_target_warp",
+                     s + "_FA_to_target.nii.gz", [s + "_FA.nii.gz", s + "_FA_to_target_warp.nii.gz"])
+                    for s in subjects], fa_dir, core_count, log)
+
+    files = [fa_dir + "/" + s + "_FA_to_target.nii.gz" for s in subjects]
+    target = load_image(files[0])
+    stack = GroupStack.create(stats_dir + "/all_FA.stack", target.shape, target.affine)
+    stack.add(subjects, files, core_count)
+    data = stack.data()
+    mask = np.ones(stack.shape, dtype=bool)
+    for row in stack.rows(subjects):
+        mask &= data[row] > 0
+    del data
+    stack.to_nifti(stats_dir + "/all_FA.nii.gz", subjects, mask=mask, hdr=target.header)
+
+    affine = stack.affine
+    if postreg_type == "-T":
+        standard = os.path.expandvars("${FSLDIR}/data/standard/")
+        mean_FA = load_nifti(standard + "FMRIB58_FA_1mm.nii.gz")[0] * mask
+        skeleton = (load_nifti(standard + "FMRIB58_FA-skeleton_1mm.nii.gz")[0] > 0) & mask
+    else:
+        mean_FA = stack.mean(subjects) * mask
+        skeleton = skeletonise(mean_FA, mask)
+    save_nifti(stats_dir + "/mean_FA_mask.nii.gz", mask.astype(np.uint8), affine)
+    save_nifti(stats_dir + "/mean_FA.nii.gz", mean_FA, affine)
+    save_nifti(stats_dir + "/mean_FA_skeleton.nii.gz", mean_FA * skeleton, affine)
+
+
+def tbss_prestats(folder_path, threshold=0.2, core_count=1, log=None):
+    """
+    In-process replacement of tbss_4_prestats: thresholds the mean FA skeleton, builds its projection search index once
+    (saved in registration/stats/tbss_index.npz for the other metrics) and projects the FA of all the subjects
+    concurrently, writing mean_FA_skeleton_mask and all_FA_skeletonised.
+
+    :param folder_path: Path to the root directory.
+    :param threshold: Threshold of the mean FA skeleton. default=0.2
+    :param core_count: Number of concurrent subjects. default=1
+    :param log: Opened log file. default=None
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from elikopy.storage import save_nifti, load_nifti, load_nifti_data
+
+    stats_dir = folder_path + "/registration/stats"
+    mean_FA, affine = load_nifti(stats_dir + "/mean_FA.nii.gz")
+    mask = load_nifti_data(stats_dir + "/mean_FA_mask.nii.gz") > 0
+    skeleton = load_nifti_data(stats_dir + "/mean_FA_skeleton.nii.gz") > 0
+    tbss_skeleton = TBSSSkeleton.from_mean_FA(mean_FA, mask, affine, threshold=threshold, skeleton=skeleton)
+    save_nifti(stats_dir + "/mean_FA_skeleton_mask.nii.gz", tbss_skeleton.mask.astype(np.uint8), affine)
+    if log is not None:
+        log.write("Skeleton of " + str(len(tbss_skeleton.indices)) + " voxels\n")
+        log.flush()
+
+    subjects = _tbss_subjects(folder_path)
+    stack = GroupStack(stats_dir + "/all_FA.stack")
+    data = stack.data()
+
+    def project(row):
+        return tbss_skeleton.project(data[row] * mask)
+
+    with ThreadPoolExecutor(max_workers=max(1, core_count)) as executor:
+        projections = list(executor.map(project, stack.rows(subjects)))
+    for subject, (_, choice) in zip(subjects, projections):
+        tbss_skeleton.add_subject(subject, choice)
+    tbss_skeleton.save(stats_dir + "/tbss_index.npz")
+    save_nifti(stats_dir + "/all_FA_skeletonised.nii.gz",
+               tbss_skeleton.to_volume(np.array([values for values, _ in projections])), affine)
+
+
+def tbss_non_FA(folder_path, key, core_count=1, log=None):
+    """
+    In-process replacement of tbss_non_FA: the metric of all the subjects (registration/<key>/<subject>.nii.gz) is
+    warped with the FA warps concurrently, stacked in registration/stats/all_<key>.stack and all_<key> with its mean,
+    and projected onto the skeleton with the FA projections stored by tbss_prestats.
+
+    :param folder_path: Path to the root directory.
+    :param key: Name of the metric.
+    :param core_count: Number of concurrent subjects. default=1
+    :param log: Opened log file. default=None
+    """
+    from elikopy.storage import save_nifti, load_nifti_data, load_image
+
+    reg_dir = folder_path + "/registration"
+    stats_dir = reg_dir + "/stats"
+    tbss_skeleton = TBSSSkeleton.load(stats_dir + "/tbss_index.npz")
+    subjects = tbss_skeleton.subjects
+    missing = [s for s in subjects if not os.path.isfile(reg_dir + "/" + key + "/" + s + ".nii.gz")]
+    assert len(missing) == 0, "Missing " + key + " for " + ", ".join(missing)
+
+    _warp_outdated([("applywarp -i ../" + key + "/" + s + " -o " + s + "_FA_to_target_" + key + " -r target -w " + s +
+                     "_FA_to_target_warp", s + "_FA_to_target_" + key + ".nii.gz",
+                     ["../" + key + "/" + s + ".nii.gz", s + "_FA_to_target_warp.nii.gz"])
+                    for s in subjects], reg_dir + "/FA", core_count, log)
+
+    mask = load_nifti_data(stats_dir + "/mean_FA_mask.nii.gz") > 0
+    files = [reg_dir + "/FA/" + s + "_FA_to_target_" + key + ".nii.gz" for s in subjects]
+    target = load_image(files[0])
+    stack = GroupStack.create(stats_dir + "/all_" + key + ".stack", target.shape, target.affine)
+    stack.add(subjects, files, core_count)
+    stack.to_nifti(stats_dir + "/all_" + key + ".nii.gz", subjects, mask=mask, hdr=target.header)
+    save_nifti(stats_dir + "/mean_" + key + ".nii.gz", stack.mean(subjects) * mask, stack.affine)
+
+    data = stack.data()
+    skeletonised = np.array([tbss_skeleton.sample(data[row] * mask, choice)
+                             for row, choice in zip(stack.rows(subjects), tbss_skeleton.choices)])
+    save_nifti(stats_dir + "/all_" + key + "_skeletonised.nii.gz", tbss_skeleton.to_volume(skeletonised),
+               stack.affine)
@@ -0,0 +1,565 @@
+"""
+ NIfTI input/output layer shared by all the processing steps of the package.
+"""
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+
+PRECISION_ENV = "ELIKOPY_PRECISION"
+OUTPUT_DTYPE_ENV = "ELIKOPY_OUTPUT_DTYPE"
+COMPRESSION_ENV = "ELIKOPY_COMPRESSION"
+COMPACT_ENV = "ELIKOPY_COMPACT_OUTPUTS"
+
+_PRECISIONS = ("float32", "float64", "native")
+_OUTPUT_DTYPES = ("float32", "float64")
+_CODECS = ("none", "gzip", "pigz")
+
+# Codec of the .nii.gz files written in each folder of the study. The most specific folder matching the path of a file
+# is used, '*' applies to every other file. The scratch folders of the preprocessing (deleted by clean_study) are stored
+# without compression, 'none' still writes a valid gzip stream so that the file names and the external tools are
+# unchanged.
+DEFAULT_COMPRESSION_POLICY = {
+    "*": "gzip:1",
+    "dMRI/preproc/bet/": "none",
+    "dMRI/preproc/eddy/": "none",
+    "dMRI/preproc/mppca/": "none",
+    "dMRI/preproc/topup/": "none",
+    "dMRI/preproc/patch2self/": "none",
+    "dMRI/preproc/gibbs/": "none",
+    "dMRI/preproc/reslice/": "none",
+    "dMRI/preproc/biasfield/": "none",
+}
+
+
+def get_precision_policy():
+    """
+    Returns the precision policy of the study. The policy is stored in environment variables so that it is inherited
+    by the Slurm jobs and by the worker processes.
+
+    :return: Tuple (precision, output_dtype). precision is the in-memory representation of the loaded images
+    ('float32', 'float64' or 'native' to keep the on-disk integer type when no scaling is defined) and output_dtype is
+    the on-disk dtype of the floating point maps written by the package.
+    """
+    precision = os.environ.get(PRECISION_ENV, "float32")
+    output_dtype = os.environ.get(OUTPUT_DTYPE_ENV, "float32")
+    return precision, output_dtype
+
+
+def set_precision_policy(precision=None, output_dtype=None):
+    """
+    Sets the precision policy of the study.
+
+    :param precision: In-memory representation of the loaded images, one of 'float32', 'float64' or 'native'.
+    default=None (unchanged)
+    :param output_dtype: On-disk dtype of the floating point maps written by the package, 'float32' or 'float64'.
+    default=None (unchanged)
+    """
+    if precision is not None:
+        assert precision in _PRECISIONS, "precision must be one of " + str(_PRECISIONS)
+        os.environ[PRECISION_ENV] = precision
+    if output_dtype is not None:
+        assert np.dtype(output_dtype).name in _OUTPUT_DTYPES, "output_dtype must be one of " + str(_OUTPUT_DTYPES)
+        os.environ[OUTPUT_DTYPE_ENV] = np.dtype(output_dtype).name
+
+
+def get_data(img, dtype=None):
+    """
+    Returns the data array of a nibabel image according to the precision policy. Unlike img.get_fdata(), float64 is
+    only used when requested.
+
+    :param img: nibabel image.
+    :param dtype: Overrides the precision policy ('float32', 'float64' or 'native'). default=None
+    """
+    precision = get_precision_policy()[0] if dtype is None else dtype
+    if precision == "native":
+        slope, inter = getattr(img.dataobj, "slope", None), getattr(img.dataobj, "inter", None)
+        if slope in (None, 1) and inter in (None, 0):
+            return np.asanyarray(img.dataobj)
+        precision = "float32"
+    return img.get_fdata(dtype=np.dtype(precision))
+
+
+def load_nifti(fname, return_img=False, return_voxsize=False, return_coords=False, dtype=None):
+    """
+    Drop-in replacement of dipy.io.image.load_nifti following the precision policy of the study.
+
+    :param fname: Path to the NIfTI file.
+    :param return_img: Also returns the nibabel image. default=False
+    :param return_voxsize: Also returns the voxel size. default=False
+    :param return_coords: Also returns the axis codes. default=False
+    :param dtype: Overrides the precision policy ('float32', 'float64' or 'native'). default=None
+    """
+    img = load_image(fname)
+    data = get_data(img, dtype=dtype)
+    vox_size = img.header.get_zooms()[:3]
+
+    ret_val = [data, img.affine]
+    if return_img:
+        ret_val.append(img)
+    if return_voxsize:
+        ret_val.append(vox_size)
+    if return_coords:
+        ret_val.append(nib.aff2axcodes(img.affine))
+    return tuple(ret_val)
+
+
+def load_nifti_data(fname, dtype=None):
+    """
+    Drop-in replacement of dipy.io.image.load_nifti_data following the precision policy of the study.
+    """
+    return get_data(load_image(fname), dtype=dtype)
+
+
+def load_image(fname):
+    """
+    Loads a NIfTI image. If fname was stored in the compact format (see CompactVolume), the dense image is rebuilt in
+    memory.
+    """
+    if not os.path.exists(fname) and os.path.isdir(compact_path(fname)):
+        return CompactVolume.load(compact_path(fname)).to_image()
+    return nib.load(fname)
+
+
+def save_nifti(fname, data, affine, hdr=None, dtype=None, mask=None):
+    """
+    Drop-in replacement of dipy.io.image.save_nifti. Floating point arrays are written with the output dtype of the
+    precision policy, integer arrays are written as is and boolean arrays as uint8.
+
+    :param fname: Path to the NIfTI file.
+    :param data: Array to save.
+    :param affine: Affine of the image.
+    :param hdr: Optional header to copy. default=None
+    :param dtype: Overrides the on-disk dtype. default=None
+    :param mask: Mask of the voxels holding information. If given and fname matches the compact outputs of the study
+    (see set_compact_outputs), only these voxels are stored. default=None
+    """
+    img = _make_image(data, affine, hdr, dtype)
+    if mask is not None and is_compact_output(fname):
+        save_compact(img, fname, mask)
+    else:
+        _save_dense(img, fname)
+
+
+def _make_image(data, affine, hdr=None, dtype=None):
+    data = np.asanyarray(data)
+    if dtype is None and data.dtype.kind == 'f':
+        dtype = get_precision_policy()[1]
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    elif data.dtype == bool:
+        data = data.astype(np.uint8)
+    img = nib.Nifti1Image(data, affine, hdr)
+    img.set_data_dtype(data.dtype)
+    return img
+
+
+def get_compression_policy():
+    """
+    Returns the compression policy of the study: the default policy updated with the folders set by
+    set_compression_policy (or by the ELIKOPY_COMPRESSION environment variable, in JSON).
+
+    :return: Dictionary mapping folders (relative to the subject folder, or '*') to a codec.
+    """
+    policy = dict(DEFAULT_COMPRESSION_POLICY)
+    if os.environ.get(COMPRESSION_ENV):
+        policy.update(json.loads(os.environ[COMPRESSION_ENV]))
+    return policy
+
+
+def set_compression_policy(policy=None, reset=False):
+    """
+    Sets the codec used to write the .nii.gz files of some folders of the study.
+    example : set_compression_policy({"dMRI/microstructure/": "pigz:6", "dMRI/ODF/": "gzip:1"})
+
+    :param policy: Dictionary mapping folders (relative to the subject folder, or '*' for all the other files) to a
+    codec: 'none' (gzip stream without compression), 'gzip' or 'gzip:<level>' (single-threaded) or 'pigz' or
+    'pigz:<level>' (multi-threaded, falls back to gzip if pigz is not installed). default=None
+    :param reset: Discards the folders previously set before applying policy. default=False
+    """
+    current = {} if reset or not os.environ.get(COMPRESSION_ENV) else json.loads(os.environ[COMPRESSION_ENV])
+    for folder, codec in (policy or {}).items():
+        _parse_codec(codec)
+        current[folder] = codec
+    os.environ[COMPRESSION_ENV] = json.dumps(current)
+
+
+def _parse_codec(codec):
+    name, _, level = codec.partition(":")
+    assert name in _CODECS, "codec must be one of " + str(_CODECS)
+    if name == "none":
+        return name, 0
+    level = int(level) if level else 6
+    assert 0 <= level <= 9, "The compression level must be between 0 and 9"
+    return name, level
+
+
+def get_codec(fname):
+    """
+    Returns the codec (name, level) used to write fname according to the compression policy.
+    """
+    path = os.path.abspath(fname).replace(os.sep, "/")
+    policy = get_compression_policy()
+    folders = [folder for folder in policy if folder != "*" and "/" + folder.strip("/") + "/" in path]
+    return _parse_codec(policy[max(folders, key=len)] if folders else policy.get("*", "gzip:1"))
+
+
+def save_image(img, fname):
+    """
+    Writes a nibabel image with the codec of its folder. Files that do not end with .gz are written uncompressed.
+    """
+    if not fname.endswith(".gz"):
+        img.to_filename(fname)
+        return
+
+    def write(fobj):
+        file_map = img.filespec_to_file_map(fname)
+        file_map["image"].fileobj = fobj
+        img.to_file_map(file_map)
+
+    _write_compressed(fname, write)
+
+
+def _write_compressed(fname, write):
+    """
+    Calls write(fobj) on a file object compressing to fname with the codec of its folder.
+    """
+    from nibabel.openers import ImageOpener
+
+    codec, level = get_codec(fname)
+    pigz = shutil.which("pigz") if codec == "pigz" else None
+    if pigz is None:
+        with ImageOpener(fname, "wb", compresslevel=level) as fobj:
+            write(fobj)
+        return
+
+    out_dir = os.path.dirname(os.path.abspath(fname))
+    fd, tmp_nii = tempfile.mkstemp(suffix=".nii", dir=out_dir)
+    os.close(fd)
+    try:
+        with open(tmp_nii, "wb") as fobj:
+            write(fobj)
+        with open(tmp_nii + ".gz", "wb") as out:
+            subprocess.run([pigz, "-" + str(level), "-p", str(len(os.sched_getaffinity(0))), "-c", tmp_nii],
+                           stdout=out, check=True)
+        os.replace(tmp_nii + ".gz", fname)
+    finally:
+        for path in (tmp_nii, tmp_nii + ".gz"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def save_nifti_volumes(fname, volumes, n_volumes, affine, hdr=None, dtype=None):
+    """
+    Streams 3-D volumes into a 4-D NIfTI file, one volume at a time, so that a group stack is written without holding
+    the 4-D array in memory.
+
+    :param fname: Path to the NIfTI file.
+    :param volumes: Iterable of n_volumes 3-D arrays of the same shape.
+    :param n_volumes: Number of volumes.
+    :param affine: Affine of the image.
+    :param hdr: Optional header to copy. default=None
+    :param dtype: On-disk dtype. default=output dtype of the precision policy
+    """
+    dtype = np.dtype(get_precision_policy()[1] if dtype is None else dtype)
+    volumes = iter(volumes)
+    first = np.asarray(next(volumes))
+    header = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=dtype), affine, hdr).header
+    header.set_data_shape(first.shape + (n_volumes,))
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(1, 0)
+    header_size = 352 + int(header.extensions.get_sizeondisk())
+    offset = int(np.ceil(header_size / 16.0) * 16)
+    header.set_data_offset(offset)
+    disk_dtype = dtype.newbyteorder(header.endianness)
+
+    def write(fobj):
+        header.write_to(fobj)
+        fobj.write(b"\0" * (offset - header_size))
+        fobj.write(np.asarray(first, dtype=disk_dtype).tobytes(order="F"))
+        for volume in volumes:
+            fobj.write(np.asarray(volume, dtype=disk_dtype).tobytes(order="F"))
+
+    if fname.endswith(".gz"):
+        _write_compressed(fname, write)
+    else:
+        with open(fname, "wb") as fobj:
+            write(fobj)
+
+
+def upcast(data):
+    """
+    Returns a float64 view (or copy) of an array for the numerically sensitive kernels (model fitting, optimisation).
+    The rest of the pipeline keeps the lighter precision of the policy.
+    """
+    return np.asarray(data, dtype=np.float64)
+
+
+class AsyncNiftiWriter:
+    r'''
+    Writes NIfTI files on a pool of background threads so that a processing step can continue (e.g. with its quality
+    control) while its outputs are compressed and written. zlib releases the GIL, several outputs are therefore
+    compressed concurrently. The header and the dtype of each output are fixed when it is queued, the data array must
+    not be modified afterwards. flush() must be called at the end of the step, it waits for all the queued outputs and
+    raises the first write error.
+
+    example : writer = AsyncNiftiWriter(max_workers=4)
+              writer.save_nifti(path_FA, FA, affine)
+              ...
+              writer.flush()
+
+    :param max_workers: Number of writer threads. default=2
+    '''
+
+    def __init__(self, max_workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="elikopy-writer")
+        self._futures = []
+
+    def save_nifti(self, fname, data, affine, hdr=None, dtype=None, mask=None):
+        """
+        Queues the output with the same arguments and conversions as save_nifti.
+        """
+        img = _make_image(data, affine, hdr, dtype)
+        if mask is not None and is_compact_output(fname):
+            self._futures.append(self._executor.submit(save_compact, img, fname, np.array(mask)))
+        else:
+            self._futures.append(self._executor.submit(_save_dense, img, fname))
+
+    def save_image(self, img, fname):
+        """
+        Queues a nibabel image, written with the codec of its folder.
+        """
+        self._futures.append(self._executor.submit(save_image, img, fname))
+
+    def flush(self):
+        """
+        Waits until all the queued outputs are written.
+        """
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_compact_outputs():
+    """
+    Returns the suffixes of the outputs stored in the compact format (see CompactVolume).
+    """
+    return json.loads(os.environ.get(COMPACT_ENV, "[]"))
+
+
+def set_compact_outputs(suffixes):
+    """
+    Sets the outputs that the processing steps store in the compact format (mask + voxel table) instead of a dense
+    NIfTI. The compact outputs are not visible to the external tools (FSL, MRtrix), it is therefore intended for the
+    large maps that are only read by the package, such as the residuals or the multi-compartment maps.
+    example : set_compact_outputs(["_residual.nii.gz", "_dtensor.nii.gz", "_pseudoTensor.nii.gz"])
+
+    :param suffixes: List of file name suffixes. An empty list disables the compact format.
+    """
+    os.environ[COMPACT_ENV] = json.dumps(list(suffixes))
+
+
+def is_compact_output(fname):
+    return any(fname.endswith(suffix) for suffix in get_compact_outputs())
+
+
+def compact_path(fname):
+    """
+    Returns the folder storing fname in the compact format: <name>.nii.gz is stored in <name>.cvox/.
+    """
+    for ext in (".nii.gz", ".nii"):
+        if fname.endswith(ext):
+            return fname[:-len(ext)] + ".cvox"
+    return fname + ".cvox"
+
+
+class CompactVolume:
+    r'''
+    Mask-compacted representation of a 3D or 4D (or more) volume: the flat indices of the N voxels of the mask and a
+    N x K table holding their values, K being the number of values per voxel. Both are stored as .npy files next to
+    the NIfTI header in a <name>.cvox folder and are memory-mapped when loaded, the voxel table can therefore be read
+    without building the dense volume (see voxels and load_voxels, used by the group stacks of the statistics).
+
+    :param shape: Shape of the dense volume.
+    :param indices: Flat (C order) indices of the voxels of the mask in the first three dimensions.
+    :param values: N x K table of the values of these voxels.
+    :param header: NIfTI header of the dense volume (holds the affine).
+    '''
+
+    def __init__(self, shape, indices, values, header):
+        self.shape = tuple(shape)
+        self.indices = indices
+        self.values = values
+        self.header = header
+
+    @classmethod
+    def from_image(cls, img, mask):
+        data = np.asanyarray(img.dataobj)
+        mask = np.asarray(mask)
+        assert mask.shape == data.shape[:3], "The mask " + str(mask.shape) + " does not match the volume " + \
+                                             str(data.shape[:3])
+        indices = np.flatnonzero(mask > 0)
+        values = data.reshape((-1, int(np.prod(data.shape[3:], dtype=int))))[indices]
+        return cls(data.shape, indices, values, img.header)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(path + "/volume.json") as f:
+            meta = json.load(f)
+        with open(path + "/header.bin", "rb") as f:
+            header = nib.Nifti1Header(binaryblock=f.read())
+        indices = np.load(path + "/indices.npy", mmap_mode=mmap_mode)
+        values = np.load(path + "/values.npy", mmap_mode=mmap_mode)
+        return cls(meta["shape"], indices, values, header)
+
+    @property
+    def affine(self):
+        return self.header.get_best_affine()
+
+    @property
+    def mask(self):
+        mask = np.zeros(int(np.prod(self.shape[:3], dtype=int)), dtype=bool)
+        mask[self.indices] = True
+        return mask.reshape(self.shape[:3])
+
+    def save(self, path):
+        """
+        Writes the volume in the folder path, replacing its previous content.
+        """
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(os.path.abspath(path)))
+        np.save(tmp_path + "/indices.npy", np.asarray(self.indices, dtype=np.int64))
+        np.save(tmp_path + "/values.npy", np.asarray(self.values))
+        with open(tmp_path + "/header.bin", "wb") as f:
+            f.write(self.header.binaryblock)
+        with open(tmp_path + "/volume.json", "w") as f:
+            json.dump({"shape": list(self.shape), "dtype": np.asarray(self.values).dtype.name}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    def voxels(self, mask=None, fill=0):
+        """
+        Returns the N x K table of the values of the voxels of mask (in C order), without building the dense volume.
+        The voxels of mask that are not stored take the value fill.
+
+        :param mask: 3D boolean array with the shape of the volume. default=None (the voxels of the compact volume, the
+            memory-mapped table is then returned as is)
+        """
+        if mask is None:
+            return self.values
+        mask = np.asarray(mask)
+        assert mask.shape == self.shape[:3], "The mask " + str(mask.shape) + " does not match the volume " + \
+                                             str(self.shape[:3])
+        wanted = np.flatnonzero(mask > 0)
+        pos = np.minimum(np.searchsorted(self.indices, wanted), max(len(self.indices) - 1, 0))
+        stored = np.zeros(len(wanted), dtype=bool) if len(self.indices) == 0 else self.indices[pos] == wanted
+        table = np.full((len(wanted), self.values.shape[1]), fill, dtype=self.values.dtype)
+        table[stored] = self.values[pos[stored]]
+        return table
+
+    def to_dense(self, fill=0):
+        dense = np.full((int(np.prod(self.shape[:3], dtype=int)), self.values.shape[1]), fill, dtype=self.values.dtype)
+        dense[self.indices] = self.values
+        return dense.reshape(self.shape)
+
+    def to_image(self):
+        return nib.Nifti1Image(self.to_dense(), self.affine, self.header)
+
+
+def image_exists(fname):
+    """
+    True if fname exists as a NIfTI file or in the compact format.
+    """
+    return os.path.exists(fname) or os.path.isdir(compact_path(fname))
+
+
+def image_mtime(fname):
+    """
+    Modification time of fname, or of its compact representation.
+    """
+    if not os.path.exists(fname) and os.path.isdir(compact_path(fname)):
+        return os.path.getmtime(compact_path(fname) + "/values.npy")
+    return os.path.getmtime(fname)
+
+
+def load_voxels(fname, mask=None, dtype=None):
+    """
+    Loads the values of the voxels of an image as an N x K table (see CompactVolume.voxels). A compact image is read
+    from its voxel table without building the dense volume.
+
+    :param fname: Path to the NIfTI file.
+    :param mask: 3D boolean array. default=None (the mask of the compact image, or every voxel of a NIfTI file)
+    :param dtype: Overrides the precision policy ('float32', 'float64' or 'native'). default=None
+    :return: voxel table, mask
+    """
+    if not os.path.exists(fname) and os.path.isdir(compact_path(fname)):
+        volume = CompactVolume.load(compact_path(fname))
+        table = volume.voxels(mask)
+        mask = volume.mask if mask is None else np.asarray(mask) > 0
+    else:
+        img = nib.load(fname)
+        data = get_data(img, dtype=dtype)
+        if mask is None:
+            mask = np.ones(data.shape[:3], dtype=bool)
+        mask = np.asarray(mask) > 0
+        assert mask.shape == data.shape[:3], "The mask " + str(mask.shape) + " does not match the volume " + \
+                                             str(data.shape[:3])
+        return data[mask].reshape((int(mask.sum()), -1)), mask
+    precision = get_precision_policy()[0] if dtype is None else dtype
+    if precision != "native":
+        table = np.asarray(table, dtype=np.dtype(precision))
+    return table, mask
+
+
+def _save_dense(img, fname):
+    save_image(img, fname)
+    if os.path.isdir(compact_path(fname)):
+        shutil.rmtree(compact_path(fname))
+
+
+def save_compact(img, fname, mask):
+    """
+    Stores a nibabel image in the compact format in the folder compact_path(fname) and removes a dense fname if any.
+    """
+    CompactVolume.from_image(img, mask).save(compact_path(fname))
+    if os.path.exists(fname):
+        os.remove(fname)
+
+
+def compact_existing(fname, mask):
+    """
+    Moves the dense NIfTI fname written by another library (e.g. unravel) to the compact format if it is one of the
+    compact outputs.
+    """
+    if is_compact_output(fname) and os.path.exists(fname):
+        save_compact(nib.load(fname), fname, mask)
+
+
+def export_dense(fname, remove_compact=False):
+    """
+    Exports the dense NIfTI fname from its compact representation, e.g. before running an external tool on it.
+
+    :param fname: Path of the dense NIfTI to write.
+    :param remove_compact: Removes the compact representation once the dense file is written. default=False
+    """
+    save_image(CompactVolume.load(compact_path(fname)).to_image(), fname)
+    if remove_compact:
+        shutil.rmtree(compact_path(fname))
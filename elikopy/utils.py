@@ -10,13 +10,15 @@ import time
 import os
 import json
 import shutil
+import functools
+import contextlib
 import matplotlib.pyplot
 
 from future.utils import iteritems
 import subprocess
 
 from dipy.data import get_sphere
-from dipy.reconst.shm import sh_to_sf, sf_to_sh
+from elikopy.resources import cpu_allowance, thread_exports
 
 
 def submit_job(job_info):
@@ -284,6 +286,120 @@ def makedir(dir_path, log_path, log_prefix):
             f.close()
 
 
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """
+    Context manager holding an exclusive lock on lock_path. The lock is shared between processes and Slurm jobs
+    running on the same file system, and is released when leaving the context (or when the process dies).
+
+    :param lock_path: The path to the lock file, created if needed.
+    """
+    import fcntl
+
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a+") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def run_command_graph(commands, core_count=1, log_dir=None, cwd=None, env=None, fail_fast=True, poll_interval=0.1):
+    """
+    Runs the external commands of a subject as a small dependency graph: every command whose dependencies have
+    completed is launched right away, as long as the threads of the running commands fit in core_count (capped by the
+    CPU budget, see elikopy.resources). Each command is limited to its threads through the thread environment variables
+    and its output is captured in its own log file. With fail_fast, the first failure kills the running commands and
+    raises, the commands not yet launched are skipped.
+
+    :param commands: Ordered dictionary name -> command, or name -> (command, dependencies) or
+        name -> (command, dependencies, threads). dependencies is a list of names of commands that must complete
+        successfully before the command is launched. threads is the number of cores used by the command. default=1
+    :param core_count: Number of cores shared by the commands. default=1
+    :param log_dir: If not None, the output of command name is written to <log_dir>/<name>_logs.txt. default=None
+    :param cwd: Working directory of the commands. default=None
+    :param env: Environment variables added to the environment of the commands, overriding the thread limits.
+        default=None
+    :param fail_fast: If true, raises subprocess.CalledProcessError as soon as a command fails. Otherwise, the commands
+        depending on a failed command are skipped and the others still run. default=True
+    :param poll_interval: Interval (in seconds) between two polls of the running commands. default=0.1
+    :return: Dictionary name -> return code (None for skipped commands).
+    """
+    from elikopy.resources import thread_env
+
+    core_count = cpu_allowance(core_count)
+    graph = {}
+    for name, spec in commands.items():
+        if isinstance(spec, str):
+            spec = (spec,)
+        spec = tuple(spec)
+        command = spec[0]
+        dependencies = spec[1] if len(spec) > 1 else ()
+        threads = spec[2] if len(spec) > 2 else 1
+        assert all(d in commands for d in dependencies), "Unknown dependency of command " + name
+        graph[name] = (command, tuple(dependencies), max(1, int(threads)))
+
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+
+    pending = list(graph)
+    running = {}
+    returncodes = {}
+    try:
+        while pending or running:
+            # Skip the commands depending on a failed or skipped command, wherever they are listed
+            skipped = True
+            while skipped:
+                skipped = [name for name in pending
+                           if any(d in returncodes and returncodes[d] != 0 for d in graph[name][1])]
+                for name in skipped:
+                    pending.remove(name)
+                    returncodes[name] = None
+            used = sum(graph[name][2] for name in running)
+            for name in list(pending):
+                command, dependencies, threads = graph[name]
+                if not all(returncodes.get(d) == 0 for d in dependencies):
+                    continue
+                if running and used + threads > core_count:
+                    continue
+                log = open(log_dir + "/" + name + "_logs.txt", "a+") if log_dir is not None else None
+                if log is not None:
+                    log.write(command + "\n")
+                    log.flush()
+                command_env = dict(os.environ)
+                command_env.update(thread_env(min(threads, core_count)))
+                if env is not None:
+                    command_env.update({k: str(v) for k, v in env.items()})
+                running[name] = (subprocess.Popen(command, universal_newlines=True, shell=True, cwd=cwd,
+                                                  env=command_env, stdout=log, stderr=subprocess.STDOUT), log)
+                pending.remove(name)
+                used += threads
+            if not running:
+                if pending:
+                    raise ValueError("Circular dependencies between the commands " + str(pending))
+                break
+
+            time.sleep(poll_interval)
+            for name, (process, log) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del running[name]
+                if log is not None:
+                    log.close()
+                returncodes[name] = returncode
+                if returncode != 0 and fail_fast:
+                    raise subprocess.CalledProcessError(returncode, graph[name][0])
+    finally:
+        for process, log in running.values():
+            process.kill()
+            process.wait()
+            if log is not None:
+                log.close()
+    return returncodes
+
+
 def tbss_utils(folder_path, grp1, grp2, starting_state=None, last_state=None, registration_type="-T", postreg_type="-S", prestats_treshold=0.2, randomise_numberofpermutation=5000):
     """
     [Legacy] Performs tract base spatial statistics (TBSS) between the data in grp1 and grp2. The data type of each subject is specified by the subj_type.json file generated during the call to the patient_list function. The data type corresponds to the original directory of the subject (e.g. a subject that was originally in the folder data_2 is of type 2).
@@ -613,7 +729,7 @@ def tbss_utils(folder_path, grp1, grp2, starting_state=None, last_state=None, re
     tbss_log.close()
 
 
-def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, starting_step=None, topup=True, gpu=True):
+def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, starting_step=None, topup=True, gpu=True, core_count=1):
     """
     synb0DISCO adapted from https://github.com/MASILab/Synb0-DISCO
 
@@ -623,12 +739,14 @@ def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, sta
     :param starting_step: Define the starting step, usefull if previous step had already been run.
     :param topup: If true, topup will be perfomed after synb0Disco.
     :param gpu: If true, torch will use the gpu.
+    :param core_count: Number of cores shared by the registration commands, the independent ones run concurrently. default=1
     :rtype: object
     """
     import torch
     import torch.nn as nn
     import torch.nn.functional as F
     import torch.optim as optim
+    from elikopy.storage import save_image
 
     assert starting_step in (None, "Registration",
                              "Inference", "Apply", "topup")
@@ -679,7 +797,7 @@ def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, sta
 
         # Skull strip T1
 
-        bet = shutil.copyfile(os.path.join(folder_path,"subjects",patient_path,"T1",f"{patient_path}_T1_brain.nii.gz"), synb0path + "/T1_mask.nii.gz")
+        shutil.copyfile(os.path.join(folder_path,"subjects",patient_path,"T1",f"{patient_path}_T1_brain.nii.gz"), synb0path + "/T1_mask.nii.gz")
 
         # epi_reg distorted b0 to T1; wont be perfect since B0 is distorted
 
@@ -693,9 +811,10 @@ def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, sta
             synb0path + "/epi_reg_d_ANTS.txt"
 
         # ANTs register T1 to atlas
+        ants_threads = max(1, core_count - 1)
         antsRegistrationSyNQuick = "antsRegistrationSyNQuick.sh -d 3 -f " + static_files_path + \
             "/atlases/mni_icbm152_t1_tal_nlin_asym_09c.nii.gz -m " + \
-            synb0path + "/T1.nii.gz -o " + synb0path + "/ANTS"
+            synb0path + "/T1.nii.gz -o " + synb0path + "/ANTS -n " + str(ants_threads)
 
         # Apply linear transform to normalized T1 to get it into atlas space
         antsApplyTransforms_lin_T1 = "antsApplyTransforms -d 3 -i " + synb0path + "/T1_norm.nii.gz -r " + static_files_path + \
@@ -718,17 +837,27 @@ def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, sta
             synb0path + "/epi_reg_d_ANTS.txt -o " + \
             synb0path + "/b0_d_nonlin_atlas_2_5.nii.gz"
 
-        bashCommand_step2 = bet + "; " + epi_reg_b0_dist + "; " + c3d_affine_tool + "; " + antsRegistrationSyNQuick + "; " + \
-            antsApplyTransforms_lin_T1 + "; " + antsApplyTransforms_lin_b0 + "; " + \
-            antsApplyTransforms_nonlin_T1 + "; " + antsApplyTransforms_nonlin_b0
+        # The T1 registration to the atlas does not depend on the b0 registration, and the four transforms only
+        # depend on the registrations they apply
+        step2_commands = {
+            "epi_reg": epi_reg_b0_dist,
+            "c3d_affine_tool": (c3d_affine_tool, ["epi_reg"]),
+            "antsRegistrationSyNQuick": (antsRegistrationSyNQuick, [], ants_threads),
+            "antsApplyTransforms_lin_T1": (antsApplyTransforms_lin_T1, ["antsRegistrationSyNQuick"]),
+            "antsApplyTransforms_lin_b0": (antsApplyTransforms_lin_b0, ["antsRegistrationSyNQuick", "c3d_affine_tool"]),
+            "antsApplyTransforms_nonlin_T1": (antsApplyTransforms_nonlin_T1, ["antsRegistrationSyNQuick"]),
+            "antsApplyTransforms_nonlin_b0": (antsApplyTransforms_nonlin_b0, ["antsRegistrationSyNQuick", "c3d_affine_tool"]),
+        }
         step2_log = open(synb0path + "/step2_logs.txt", "a+")
         step2_log.write(
             "[SynB0DISCO] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Beginning of step 2 \n\n")
         step2_log.flush()
-        process = subprocess.Popen(bashCommand_step2, universal_newlines=True, shell=True, stdout=step2_log,
-                                   stderr=subprocess.STDOUT)
-
-        output, error = process.communicate()
+        try:
+            run_command_graph(step2_commands, core_count=core_count, log_dir=synb0path)
+        except subprocess.CalledProcessError as e:
+            step2_log.write("[SynB0DISCO] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": Step 2 failed: " + str(e) + "\n\n")
+            step2_log.close()
+            raise
         step2_log.write(
             "[SynB0DISCO] " + datetime.datetime.now().strftime("%d.%b %Y %H:%M:%S") + ": End of step 2 \n\n")
         step2_log.close()
@@ -746,6 +875,7 @@ def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, sta
             device = torch.device("cuda")
         else:
             device = torch.device("cpu")
+            torch.set_num_threads(cpu_allowance(core_count))
 
         T1_input_path = synb0path + "/T1_norm_lin_atlas_2_5.nii.gz"
         b0_input_path = synb0path + "/b0_d_lin_atlas_2_5.nii.gz"
@@ -775,7 +905,7 @@ def synb0DisCo(folder_path, topuppath, patient_path, static_files_path=None, sta
             nii_template = nib.load(b0_input_path)
             nii = nib.Nifti1Image(util.torch2nii(
                 img_model.detach().cpu()), nii_template.affine, nii_template.header)
-            nib.save(nii, b0_output_path)
+            save_image(nii, b0_output_path)
 
         step3_log.write("[SynB0DISCO] " + datetime.datetime.now().strftime(
             "%d.%b %Y %H:%M:%S") + ": End of step 3 \n\n")
@@ -905,7 +1035,7 @@ def inference(T1_path, b0_d_path, model, device):
     return img_model
 
 
-def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_type="-S", prestats_treshold=0.2, core_count=1):
+def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_type="-S", prestats_treshold=0.2, core_count=1, engine="fsl"):
     """ Register all the subjects Fractional Anisotropy into a common space, skeletonisedd and non skeletonised. This is performed based on TBSS of FSL.
     It is mandatory to have performed DTI prior to regall_FA.
 
@@ -915,12 +1045,16 @@ def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_
     :param postreg_type: Define the argument used by the tbss command tbss_3_postreg. Could either by '-S' or '-T'. If you wish to use the FMRIB58_FA mean FA image and its derived skeleton, instead of the mean of your subjects in the study, use the '-T' option. Otherwise, use the '-S' option.
     :param prestats_treshold: Thresholds the mean FA skeleton image at the chosen threshold during prestats. default=0.2
     :param core_count: Define the number of available core. default=1
+    :param engine: Engine of the postreg and prestats steps, either 'fsl' (tbss_3_postreg and tbss_4_prestats) or 'python' (in-process skeletonisation and projection of the subjects in parallel, see elikopy.stats.tbss_postreg). The python engine requires the registration type '-T' or '-t'. default='fsl'
     """
+    core_count = cpu_allowance(core_count)
     starting_state = None if starting_state == "None" else starting_state
     assert starting_state in (None, "reg", "postreg",
                               "prestats"), 'invalid starting state!'
     assert registration_type in ("-T", "-t", "-n"), 'invalid registration type!'
     assert postreg_type in ("-S", "-T"), 'invalid postreg type!'
+    assert engine in ("fsl", "python"), 'invalid engine!'
+    assert engine == "fsl" or registration_type != "-n", 'the python engine requires the registration type -T or -t!'
 
     # create the output directory
     log_prefix = "registration"
@@ -996,8 +1130,7 @@ def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_
         registration_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
             "%d.%b %Y %H:%M:%S") + ": Beginning of reg\n")
 
-        bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(
-            core_count)+' ; cd ' + outputdir + ' && tbss_2_reg ' + registration_type
+        bashCommand = thread_exports(core_count) + 'cd ' + outputdir + ' && tbss_2_reg ' + registration_type
         bashcmd = bashCommand.split()
         print("Bash command is:\n{}\n".format(bashcmd))
         registration_log.write(bashCommand+"\n")
@@ -1015,15 +1148,18 @@ def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_
             "%d.%b %Y %H:%M:%S") + ": Beginning of postreg\n")
         registration_log.flush()
 
-        bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(
-            core_count)+' ; cd ' + outputdir + ' && tbss_3_postreg ' + postreg_type
-        bashcmd = bashCommand.split()
-        print("Bash command is:\n{}\n".format(bashcmd))
-        registration_log.write(bashCommand+"\n")
-        registration_log.flush()
-        process = subprocess.Popen(bashCommand, universal_newlines=True,
-                                   shell=True, stdout=registration_log, stderr=subprocess.STDOUT)
-        output, error = process.communicate()
+        if engine == "python":
+            from elikopy.stats import tbss_postreg
+            tbss_postreg(folder_path, postreg_type=postreg_type, core_count=core_count, log=registration_log)
+        else:
+            bashCommand = thread_exports(core_count) + 'cd ' + outputdir + ' && tbss_3_postreg ' + postreg_type
+            bashcmd = bashCommand.split()
+            print("Bash command is:\n{}\n".format(bashcmd))
+            registration_log.write(bashCommand+"\n")
+            registration_log.flush()
+            process = subprocess.Popen(bashCommand, universal_newlines=True,
+                                       shell=True, stdout=registration_log, stderr=subprocess.STDOUT)
+            output, error = process.communicate()
 
         registration_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
             "%d.%b %Y %H:%M:%S") + ": End of postreg\n")
@@ -1034,15 +1170,18 @@ def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_
             "%d.%b %Y %H:%M:%S") + ": Beginning of prestats\n")
         registration_log.flush()
 
-        bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(
-            core_count)+' ; cd ' + outputdir + ' && tbss_4_prestats ' + str(prestats_treshold) + '&& cd ' + outputdir + '/stats '
-        bashcmd = bashCommand.split()
-        print("Bash command is:\n{}\n".format(bashcmd))
-        registration_log.write(bashCommand+"\n")
-        registration_log.flush()
-        process = subprocess.Popen(bashCommand, universal_newlines=True, shell=True, stdout=registration_log,
-                                   stderr=subprocess.STDOUT)
-        output, error = process.communicate()
+        if engine == "python":
+            from elikopy.stats import tbss_prestats
+            tbss_prestats(folder_path, threshold=prestats_treshold, core_count=core_count, log=registration_log)
+        else:
+            bashCommand = thread_exports(core_count) + 'cd ' + outputdir + ' && tbss_4_prestats ' + str(prestats_treshold) + '&& cd ' + outputdir + '/stats '
+            bashcmd = bashCommand.split()
+            print("Bash command is:\n{}\n".format(bashcmd))
+            registration_log.write(bashCommand+"\n")
+            registration_log.flush()
+            process = subprocess.Popen(bashCommand, universal_newlines=True, shell=True, stdout=registration_log,
+                                       stderr=subprocess.STDOUT)
+            output, error = process.communicate()
 
         registration_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
             "%d.%b %Y %H:%M:%S") + ": End of prestats\n")
@@ -1053,15 +1192,18 @@ def regall_FA(folder_path, starting_state=None, registration_type="-T", postreg_
     registration_log.flush()
 
 
-def regall(folder_path, core_count=1, metrics_dic={'_noddi_odi': 'noddi', '_mf_fvf_tot': 'mf', '_diamond_kappa': 'diamond'}):
+def regall(folder_path, core_count=1, metrics_dic={'_noddi_odi': 'noddi', '_mf_fvf_tot': 'mf', '_diamond_kappa': 'diamond'}, engine="fsl"):
     """ Register all the subjects diffusion metrics specified in the argument metrics_dic into a common space using the transformation computed for the FA with the regall_FA function. This is performed based on TBSS of FSL.
     It is mandatory to have performed regall_FA prior to regall.
 
     :param folder_path: path to the root directory.
     :param metrics_dic: Dictionnary containing the diffusion metrics to register in a common space. For each diffusion metric, the metric name is the key and the metric's folder is the value. default={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'}
     :param core_count: Define the number of available core. default=1
+    :param engine: Either 'fsl' (tbss_non_FA) or 'python' (in-process projection reusing the skeleton projections of regall_FA, which must have been run with the python engine). default='fsl'
     """
+    core_count = cpu_allowance(core_count)
 
+    assert engine in ("fsl", "python"), 'invalid engine!'
     assert os.path.isdir(
         folder_path + "/registration/FA"), "No FA registration found! You first need to run regall_FA() before using this function!"
 
@@ -1101,9 +1243,11 @@ def regall(folder_path, core_count=1, metrics_dic={'_noddi_odi': 'noddi', '_mf_f
                     value + '/' + patient_path + key + ".nii.gz",
                     outputdir + "/" + key + "/" + patient_path + ".nii.gz")
 
-        if metric_bool:
-            bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(
-                core_count)+' ; cd ' + outputdir + ' && tbss_non_FA ' + key
+        if metric_bool and engine == "python":
+            from elikopy.stats import tbss_non_FA
+            tbss_non_FA(folder_path, key, core_count=core_count, log=registration_log)
+        elif metric_bool:
+            bashCommand = thread_exports(core_count) + 'cd ' + outputdir + ' && tbss_non_FA ' + key
             bashcmd = bashCommand.split()
             print("Bash command is:\n{}\n".format(bashcmd))
             registration_log.write(bashCommand + "\n")
@@ -1112,8 +1256,7 @@ def regall(folder_path, core_count=1, metrics_dic={'_noddi_odi': 'noddi', '_mf_f
                                        shell=True, stdout=registration_log, stderr=subprocess.STDOUT)
             output, error = process.communicate()
 
-            bashCommand = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(
-                core_count)+' ; cd ' + outputdir + ' && fslmaths stats/all_' + key + ' -Tmean stats/mean_' + key
+            bashCommand = thread_exports(core_count) + 'cd ' + outputdir + ' && fslmaths stats/all_' + key + ' -Tmean stats/mean_' + key
             bashcmd = bashCommand.split()
             print("Bash command is:\n{}\n".format(bashcmd))
             registration_log.write(bashCommand + "\n")
@@ -1148,7 +1291,7 @@ def regionWiseMean(folder_path, additional_atlases=None, metrics_dic={'_noddi_od
 
         import pandas as pd
         import lxml.etree as etree
-        from dipy.io.image import load_nifti
+        from elikopy.storage import load_nifti
 
         # path to the atlas directory of FSL
         fsldir = os.getenv('FSLDIR')
@@ -1198,7 +1341,7 @@ def regionWiseMean(folder_path, additional_atlases=None, metrics_dic={'_noddi_od
                       name[iteration] + key + '.csv')
 
 
-def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, skeletonised=True, metrics_dic={'FA': 'dti', '_noddi_odi': 'noddi', '_mf_fvf_tot': 'mf', '_diamond_kappa': 'diamond'}, core_count=1):
+def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, skeletonised=True, metrics_dic={'FA': 'dti', '_noddi_odi': 'noddi', '_mf_fvf_tot': 'mf', '_diamond_kappa': 'diamond'}, core_count=1, engine="randomise"):
     """ Performs tract base spatial statistics (TBSS) between the data in grp1 and grp2 (groups are specified during the call to regall_FA) for each diffusion metric specified in the argument metrics_dic.
     The mean value of the diffusion metrics across atlases regions can also be reported in CSV files using the regionWiseMean flag. The used atlases are : the Harvard-Oxford cortical and subcortical structural atlases, the JHU DTI-based white-matter atlases and the MNI structural atlas
     It is mandatory to have performed regall_FA prior to randomise_all.
@@ -1210,8 +1353,10 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
     :param skeletonised: If True, randomize will be using only the white matter skeleton instead of the whole brain. default=True
     :param metrics_dic: Dictionnary containing the diffusion metrics to register in a common space. For each diffusion metric, the metric name is the key and the metric's folder is the value. default={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'}
     :param core_count: Number of allocated cpu core. default=1
+    :param engine: Permutation engine, either "randomise" (FSL) or "python" (elikopy.stats.permutation_glm, same outputs). default="randomise"
     :param additional_atlases:  Define additional atlases to be used as segmentation template for csv generation (see regionWiseMean). Dictionary is in the form {'Atlas_name_1':["path to atlas 1 xml","path to atlas 1 nifti"],'Atlas_name_1':["path to atlas 2 xml","path to atlas 2 nifti"]}.
     """
+    core_count = cpu_allowance(core_count)
     outputdir = folder_path + "/registration"
     log_prefix = "randomise"
 
@@ -1243,28 +1388,27 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
     for key, value in metrics_dic.items():
         if skeletonised:
             outkey = key + '_skeletonised'
-            bashCommand1 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && ' + randomise_type + ' -i ../all_' + \
+            bashCommand1 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && ' + randomise_type + ' -i ../all_' + \
                 key + '_skeletonised -o ' + outkey + ' -m ../mean_FA_skeleton_mask -d design.mat -t design.con -n ' + \
                 str(randomise_numberofpermutation) + ' --T2 --uncorrp'
         else:
             outkey = key
-            bashCommand1 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && ' + randomise_type + \
+            bashCommand1 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && ' + randomise_type + \
                 ' -i ../all_' + key + ' -o ' + key + ' -m ../mean_FA_mask -d design.mat -t design.con -n ' + \
                 str(randomise_numberofpermutation) + ' --T2 --uncorrp'
 
         randomise_log_metrics = open(outputdir_group + "/randomise_log_" + outkey + "_g1" + str(
             tuple(grp1)).replace(" ", "") + "_g2" + str(tuple(grp2)).replace(" ", "") + ".txt", "a+")
 
-        bashCommand2 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_tfce_corrp_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_corrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_corrp_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
-            outkey + '_report2_corrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_corrp_tstat1 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + outkey + \
-            '_report1_corrected_cortical.txt && autoaq -i ' + outkey + \
-            '_tfce_corrp_tstat2 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + \
-            outkey + '_report2_corrected_cortical.txt'
-        bashCommand3 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_tfce_p_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_p_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
-            outkey + '_report2_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_p_tstat1 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + outkey + \
-            '_report1_uncorrected_cortical.txt && autoaq -i ' + outkey + \
-            '_tfce_p_tstat2 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + \
-            outkey + '_report2_uncorrected_cortical.txt'
+        # The eight autoaq reports are independent, they run concurrently on core_count cores
+        autoaq_commands = {}
+        for stat, correction in (("_tfce_corrp", "corrected"), ("_tfce_p", "uncorrected")):
+            for atlas, atlas_name in (("subcortical", "Harvard-Oxford Subcortical Structural Atlas"),
+                                      ("cortical", "Harvard-Oxford Cortical Structural Atlas")):
+                for t in (1, 2):
+                    report = outkey + '_report' + str(t) + '_' + correction + '_' + atlas
+                    autoaq_commands[report] = 'autoaq -i ' + outkey + stat + '_tstat' + str(t) + ' -a \"' + atlas_name + \
+                                              '\" -t 0.95 -o ' + report + '.txt'
 
         if randomise_numberofpermutation > 0:
             randomise_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
@@ -1273,6 +1417,7 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
 
             patient_error = False
             design_mat = []
+            design_subjects = []
             for p in ordered_patient_list:
                 patient_path = os.path.splitext(p)[0]
                 control_info = subj_type[patient_path]
@@ -1284,6 +1429,7 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
                               value + "does not exist for " + patient_path)
                     else:
                         design_mat.append("0 0\n")
+                        design_subjects.append(patient_path)
                 elif control_info in grp1:
                     if (not os.path.exists(outputdir + "/origdata/" + patient_path + "_FA.nii.gz") or
                             not True):
@@ -1291,6 +1437,7 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
                               value + "does not exist for " + patient_path)
                     else:
                         design_mat.append("1 0\n")
+                        design_subjects.append(patient_path)
                 elif control_info in grp2:
                     if (not os.path.exists(outputdir + "/origdata/" + patient_path + "_FA.nii.gz") or
                             not True):
@@ -1298,6 +1445,7 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
                               value + "does not exist for " + patient_path)
                     else:
                         design_mat.append("0 1\n")
+                        design_subjects.append(patient_path)
                 else:
                     print("ERROR, Aborting randomise for " + key + " " + value)
                     patient_error = True
@@ -1320,13 +1468,34 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
                     f.write("1 -1\n")
                     f.write("-1 1\n")
 
-                bashcmd1 = bashCommand1.split()
-                print("Bash command is:\n{}\n".format(bashcmd1))
-                randomise_log.write(bashCommand1+"\n")
-                randomise_log.flush()
-                process = subprocess.Popen(bashCommand1, universal_newlines=True, shell=True, stdout=randomise_log_metrics,
-                                           stderr=subprocess.STDOUT)
-                output, error = process.communicate()
+                if engine == "python":
+                    from elikopy.stats import permutation_glm
+                    if skeletonised:
+                        data_file = outputdir_group + '../all_' + key + '_skeletonised.nii.gz'
+                        mask_file = outputdir_group + '../mean_FA_skeleton_mask.nii.gz'
+                    else:
+                        data_file = outputdir_group + '../all_' + key + '.nii.gz'
+                        mask_file = outputdir_group + '../mean_FA_mask.nii.gz'
+                    randomise_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+                        "%d.%b %Y %H:%M:%S") + ": permutation_glm on " + data_file + "\n")
+                    randomise_log.flush()
+                    stack_path = outputdir_group + '../all_' + key + '.stack'
+                    if not skeletonised and os.path.isdir(stack_path):
+                        # group stack of the python TBSS engine, read without decompressing the 4-D file
+                        from elikopy.stats import GroupStack
+                        data_file = GroupStack(stack_path)
+                    permutation_glm(data_file, mask_file, outputdir_group + 'design.mat', outputdir_group + 'design.con',
+                                    outputdir_group + outkey, n_perm=randomise_numberofpermutation, tfce_E=1,
+                                    connectivity=26, core_count=core_count,
+                                    subjects=None if isinstance(data_file, str) else design_subjects)
+                else:
+                    bashcmd1 = bashCommand1.split()
+                    print("Bash command is:\n{}\n".format(bashcmd1))
+                    randomise_log.write(bashCommand1+"\n")
+                    randomise_log.flush()
+                    process = subprocess.Popen(bashCommand1, universal_newlines=True, shell=True, stdout=randomise_log_metrics,
+                                               stderr=subprocess.STDOUT)
+                    output, error = process.communicate()
 
                 randomise_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                     "%d.%b %Y %H:%M:%S") + ": End of randomise\n")
@@ -1336,21 +1505,16 @@ def randomise_all(folder_path, grp1, grp2, randomise_numberofpermutation=5000, s
                     "%d.%b %Y %H:%M:%S") + ": Beginning of autoaq\n")
                 randomise_log.flush()
 
-                bashcmd2 = bashCommand2.split()
-                print("Bash command is:\n{}\n".format(bashcmd2))
-                randomise_log.write(bashCommand2+"\n")
-                randomise_log.flush()
-                process = subprocess.Popen(bashCommand2, universal_newlines=True,
-                                           shell=True, stdout=randomise_log_metrics, stderr=subprocess.STDOUT)
-                output, error = process.communicate()
-
-                bashcmd3 = bashCommand3.split()
-                print("Bash command is:\n{}\n".format(bashcmd3))
-                randomise_log.write(bashCommand3 + "\n")
+                for command in autoaq_commands.values():
+                    randomise_log.write(command + "\n")
                 randomise_log.flush()
-                process = subprocess.Popen(bashCommand3, universal_newlines=True, shell=True, stdout=randomise_log_metrics,
-                                           stderr=subprocess.STDOUT)
-                output, error = process.communicate()
+                autoaq_returncodes = run_command_graph(autoaq_commands, core_count=core_count, cwd=outputdir_group,
+                                                       log_dir=outputdir_group + "/autoaq_logs",
+                                                       env={"OMP_NUM_THREADS": 1, "FSLPARALLEL": 1}, fail_fast=False)
+                for report, returncode in autoaq_returncodes.items():
+                    if returncode != 0:
+                        randomise_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+                            "%d.%b %Y %H:%M:%S") + ": autoaq failed for " + report + "\n")
 
                 randomise_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                     "%d.%b %Y %H:%M:%S") + ": End of autoaq\n")
@@ -1624,52 +1788,107 @@ def _flip_m_neg(sh, sh_order: int, full_basis: bool = False):
     return sh
 
 
-def dipy_fod_to_mrtrix(sh):
+@functools.lru_cache(maxsize=None)
+def sh_basis_conversion_matrix(sh_order: int, basis_in: str, basis_out: str):
     """
-    Converts spherical harmonics (sh) file from dipy format to mrtrix format.
-    Does not work with full basis, only symmetrical SH.
+    Returns the linear map converting symmetrical spherical harmonics coefficients from one basis to another.
+    The map is computed once per (sh_order, basis_in, basis_out) and cached for the lifetime of the process.
+    Both bases span the same space of even-degree functions on the sphere, the least-squares projection is
+    therefore exact (up to numerical precision) and independent of the sphere used to build it.
+
+    :param sh_order: int. Order of the spherical harmonics.
+    :param basis_in: str. Basis of the input coefficients, either 'descoteaux07' (dipy) or 'tournier07' (mrtrix).
+    :param basis_out: str. Basis of the output coefficients, either 'descoteaux07' (dipy) or 'tournier07' (mrtrix).
+    :return: 2-D array of shape (coeff, coeff) such that sh_out = sh_in @ M.T
+    """
+    from dipy.reconst.shm import sph_harm_lookup
+
+    sh_order = int(sh_order)
+    n_coeffs = (sh_order + 1) * (sh_order + 2) // 2
+    if basis_in == basis_out:
+        return np.eye(n_coeffs)
+
+    sphere = get_sphere('repulsion724')
+    B_in, _, _ = sph_harm_lookup[basis_in](sh_order, sphere.theta, sphere.phi, legacy=False)
+    B_out, _, _ = sph_harm_lookup[basis_out](sh_order, sphere.theta, sphere.phi, legacy=False)
+
+    M = np.linalg.pinv(B_out) @ B_in
+    M[np.abs(M) < 1e-12] = 0
+    M.setflags(write=False)
+
+    return M
+
+
+def _flip_m_neg_signs(sh_order: int):
+    """
+    Returns the sign vector applied by _flip_m_neg, so that it can be folded in a conversion matrix.
+
+    :param sh_order: int. Order of the spherical harmonics.
+    :return: 1-D array of shape (coeff,) containing +1 and -1.
+    """
+    n_coeffs = (int(sh_order) + 1) * (int(sh_order) + 2) // 2
+    signs = _flip_m_neg(np.ones((1, 1, 1, n_coeffs)), np.float64(sh_order))
+
+    return signs[0, 0, 0]
+
+
+def convert_sh_basis(sh, M, mask=None):
+    """
+    Applies a coefficient-space conversion matrix to the voxels of a spherical harmonics volume.
+    Voxels outside of the mask (by default, voxels where all coefficients are null) are left to zero.
 
     :param sh: 4-D array. Spherical harmonics coefficient array of shape (x,y,z,coeff).
+    :param M: 2-D array of shape (coeff, coeff). Conversion matrix, see sh_basis_conversion_matrix.
+    :param mask: 3-D array, optional. Voxels to convert. The default is None.
     :return: 4-D array. Spherical harmonics coefficient array of shape (x,y,z,coeff).
+    """
+    if mask is None:
+        mask = np.any(sh != 0, axis=-1)
+    else:
+        mask = mask.astype(bool)
+
+    out = np.zeros(sh.shape, dtype=np.result_type(sh.dtype, np.float32))
+    out[mask] = sh[mask] @ M.T.astype(out.dtype)
+
+    return out
 
+
+def dipy_fod_to_mrtrix(sh, mask=None):
     """
+    Converts spherical harmonics (sh) file from dipy format to mrtrix format.
+    Does not work with full basis, only symmetrical SH.
 
-    sh_order = (np.sqrt(sh.shape[3]*8+1)-3)/2
+    :param sh: 4-D array. Spherical harmonics coefficient array of shape (x,y,z,coeff).
+    :param mask: 3-D array, optional. Voxels to convert, other voxels are set to zero. The default is None.
+    :return: 4-D array. Spherical harmonics coefficient array of shape (x,y,z,coeff).
 
-    sh = _flip_m_neg(sh, sh_order)
+    """
 
-    default_sphere = get_sphere('repulsion724')
+    sh_order = int(round((np.sqrt(sh.shape[3]*8+1)-3)/2))
 
-    temp = sh_to_sf(sh, sphere=default_sphere, sh_order=sh_order,
-                    basis_type='descoteaux07', legacy=False)
-    sh = sf_to_sh(temp, sphere=default_sphere, sh_order=sh_order,
-                  basis_type='tournier07', legacy=False)
+    M = sh_basis_conversion_matrix(sh_order, 'descoteaux07', 'tournier07')
+    M = M * _flip_m_neg_signs(sh_order)[np.newaxis, :]
 
-    return sh
+    return convert_sh_basis(sh, M, mask=mask)
 
 
-def mrtrix_fod_to_dipy(sh):
+def mrtrix_fod_to_dipy(sh, mask=None):
     """
     Converts spherical harmonics (sh) file from mrtrix format to dipy format.
     Does not work with full basis, only symmetrical SH.
 
     :param sh: 4-D array. Spherical harmonics coefficient array of shape (x,y,z,coeff).
+    :param mask: 3-D array, optional. Voxels to convert, other voxels are set to zero. The default is None.
     :return: 4-D array. Spherical harmonics coefficient array of shape (x,y,z,coeff).
 
     """
 
-    sh_order = (np.sqrt(sh.shape[3]*8+1)-3)/2
+    sh_order = int(round((np.sqrt(sh.shape[3]*8+1)-3)/2))
 
-    default_sphere = get_sphere('repulsion724')
+    M = sh_basis_conversion_matrix(sh_order, 'tournier07', 'descoteaux07')
+    M = _flip_m_neg_signs(sh_order)[:, np.newaxis] * M
 
-    temp = sh_to_sf(sh, sphere=default_sphere, sh_order=sh_order,
-                    basis_type='tournier07', legacy=False)
-    sh = sf_to_sh(temp, sphere=default_sphere, sh_order=sh_order,
-                  basis_type='descoteaux07', legacy=False)
-
-    sh = _flip_m_neg(sh, sh_order)
-
-    return sh
+    return convert_sh_basis(sh, M, mask=mask)
 
 
 def clean_mask(mask):
@@ -1704,6 +1923,148 @@ def clean_mask(mask):
     return mask_cleaned
 
 
+def b0_reference(data, bvals=None, b0_threshold=50, max_volumes=None):
+    """
+    Computes the mean of the b0 volumes of a diffusion acquisition, accumulated volume by volume so that the selected
+    volumes are never copied into a new 4-D array.
+
+    :param data: 4-D array. Diffusion data of shape (x,y,z,n).
+    :param bvals: b-values of the volumes. If None or if no volume is below b0_threshold, all the volumes are used.
+    :param b0_threshold: Volumes with a b-value lower or equal to b0_threshold are b0 volumes. default=50
+    :param max_volumes: If not None, only up to max_volumes evenly spaced b0 volumes are averaged. default=None
+    :return: 3-D float32 array. Mean b0 image.
+    """
+    n_volumes = data.shape[-1]
+    vol_idx = np.arange(n_volumes)
+    if bvals is not None:
+        b0_idx = np.flatnonzero(np.asarray(bvals) <= b0_threshold)
+        if b0_idx.size > 0:
+            vol_idx = b0_idx
+    if max_volumes is not None and vol_idx.size > max_volumes:
+        vol_idx = vol_idx[np.linspace(0, vol_idx.size - 1, max_volumes).round().astype(int)]
+
+    reference = np.zeros(data.shape[:-1], dtype=np.float64)
+    for i in vol_idx:
+        reference += data[..., i]
+    reference /= vol_idx.size
+    return reference.astype(np.float32)
+
+
+def b0_median_otsu(data, bvals=None, median_radius=2, numpass=1, dilate=2, b0_threshold=50, max_volumes=None):
+    """
+    Fast brain extraction: median_otsu is only applied to the mean b0 image of the acquisition (see b0_reference)
+    instead of to the mean of every volume, and the masked 4-D volume returned by median_otsu is never built. The
+    resulting mask is cleaned with clean_mask.
+
+    :param data: 4-D array. Diffusion data of shape (x,y,z,n).
+    :param bvals: b-values of the volumes. default=None (all the volumes are used)
+    :param median_radius: Radius (in voxels) of the applied median filter. default=2
+    :param numpass: Number of pass of the median filter. default=1
+    :param dilate: Number of iterations for binary dilation. default=2
+    :param b0_threshold: Volumes with a b-value lower or equal to b0_threshold are b0 volumes. default=50
+    :param max_volumes: If not None, only up to max_volumes b0 volumes are averaged. default=None
+    :return: mask, reference. The cleaned binary mask and the mean b0 image.
+    """
+    from dipy.segment.mask import median_otsu
+
+    reference = b0_reference(data, bvals=bvals, b0_threshold=b0_threshold, max_volumes=max_volumes)
+    _, mask = median_otsu(reference, median_radius=median_radius, numpass=numpass, dilate=dilate)
+    return clean_mask(mask), reference
+
+
+def _iter_volumes(img, volumes):
+    """
+    Yields (volume, data) for the requested volumes of a 4-D nibabel image, in increasing order. The file is kept open
+    so that a compressed file is only decompressed once, whatever the number of volumes read.
+    """
+    for i in sorted(set(volumes)):
+        yield i, np.asanyarray(img.dataobj[..., i])
+
+
+def extract_topup_b0(dwi_path, bval_path, index_path, acqparams_path, b0_path, topup_acqparams_path,
+                     b0_threshold=None):
+    """
+    Builds the inputs of topup in-process. For each acquisition of index_path (in order of first appearance), the first
+    b0 volume of that acquisition is selected from the bval file (or its first volume if it has no b0). The selected
+    volumes are read in a single pass over dwi_path and written to b0_path, and the matching lines of acqparams_path are
+    written to topup_acqparams_path.
+
+    :param dwi_path: Path to the 4-D diffusion data.
+    :param bval_path: Path to the bval file of the data.
+    :param index_path: Path to the index file (acquisition of each volume, see eddy).
+    :param acqparams_path: Path to the acquisition parameters file.
+    :param b0_path: Output path of the merged b0 volumes.
+    :param topup_acqparams_path: Output path of the acquisition parameters of the merged b0 volumes.
+    :param b0_threshold: Volumes with a b-value lower or equal to b0_threshold are b0 volumes. default=max(50, min(bvals)+10)
+    :return: roi, the 1-based positions of the selected volumes in the diffusion data.
+    """
+    from dipy.io import read_bvals_bvecs
+    from elikopy.storage import save_nifti_volumes
+
+    bvals, _ = read_bvals_bvecs(bval_path, None)
+    if b0_threshold is None:
+        b0_threshold = max(50, np.min(bvals) + 10)
+    with open(index_path) as f:
+        topup_index = [int(s) for s in f.read().split()]
+    with open(acqparams_path) as f:
+        topup_acq = [line.split() for line in f if line.strip()]
+
+    roi = []
+    acquisitions = list(dict.fromkeys(topup_index))
+    for ind in acquisitions:
+        volumes = [i for i, v in enumerate(topup_index) if v == ind]
+        b0_volumes = [i for i in volumes if bvals[i] <= b0_threshold]
+        roi.append((b0_volumes if b0_volumes else volumes)[0] + 1)
+
+    img = nib.load(dwi_path, keep_file_open=True)
+    selected = dict(_iter_volumes(img, [r - 1 for r in roi]))
+    volumes = [selected[r - 1] for r in roi]
+    save_nifti_volumes(b0_path, volumes, len(volumes), img.affine, hdr=img.header, dtype=volumes[0].dtype)
+
+    with open(topup_acqparams_path, "w") as f:
+        f.writelines(" ".join(topup_acq[ind - 1]) + "\n" for ind in acquisitions)
+    return roi
+
+
+def append_volume(dwi_path, volume_path, volume=0, volume_out_path=None):
+    """
+    Appends one volume of volume_path at the end of the 4-D image dwi_path in-process, reading both files once and
+    streaming the result to disk (equivalent to fslroi followed by fslmerge -t).
+
+    :param dwi_path: Path to the 4-D image, overwritten by the merged image.
+    :param volume_path: Path to the image holding the volume to append.
+    :param volume: Index of the volume of volume_path to append. default=0
+    :param volume_out_path: If not None, the appended volume is also saved at this path. default=None
+    """
+    from elikopy.storage import save_nifti_volumes, save_nifti
+
+    extra_img = nib.load(volume_path)
+    if len(extra_img.shape) > 3:
+        extra = np.asanyarray(extra_img.dataobj[..., volume])
+    else:
+        extra = np.asanyarray(extra_img.dataobj)
+    if volume_out_path is not None:
+        save_nifti(volume_out_path, extra, extra_img.affine, hdr=extra_img.header, dtype=extra.dtype)
+
+    img = nib.load(dwi_path, keep_file_open=True)
+    n_volumes = img.shape[3] if len(img.shape) > 3 else 1
+    if len(img.shape) > 3:
+        volumes = (data for _, data in _iter_volumes(img, range(n_volumes)))
+    else:
+        volumes = iter([np.asanyarray(img.dataobj)])
+    first = next(volumes)
+
+    def all_volumes():
+        yield first
+        yield from volumes
+        yield extra
+
+    dtype = np.result_type(first.dtype, extra.dtype)
+    tmp_path = dwi_path[:-len(".nii.gz")] + "_tmp.nii.gz" if dwi_path.endswith(".nii.gz") else dwi_path + ".tmp.nii"
+    save_nifti_volumes(tmp_path, all_volumes(), n_volumes + 1, img.affine, hdr=img.header, dtype=dtype)
+    os.replace(tmp_path, dwi_path)
+
+
 def get_acquisition_view(affine) -> str:
     '''
     Returns the acquisition view corresponding to the affine.
@@ -1739,7 +2100,57 @@ def get_acquisition_view(affine) -> str:
     else:
         return "oblique"
 
-def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic={'FA': 'dti_CommonSpace_T1_AP'}, core_count=1, maskType="brain_mask_dilated"):
+def get_acquisition_scheme_key(bvals, bvecs, b0_threshold=50, bval_rounding=50, bvec_decimals=2, ordered=True,
+                               directions=True):
+    """
+    Returns a canonical hash of a gradient scheme. Two acquisitions sharing the same shells and gradient directions
+    (up to rounding and to the sign of the directions) obtain the same key, so that scheme dependent results can be
+    shared between subjects. The directions of preprocessed data are rotated by eddy for the motion of each subject:
+    results shared by all the subjects of a protocol must be keyed with directions=False.
+
+    :param bvals: 1-D array of the b-values.
+    :param bvecs: 2-D array of shape (n,3) or (3,n) of the gradient directions.
+    :param b0_threshold: b-values below this threshold are considered as b0. default=50
+    :param bval_rounding: b-values are rounded to a multiple of this value. default=50
+    :param bvec_decimals: number of decimals kept for the gradient directions. default=2
+    :param ordered: If False, the key does not depend on the order of the volumes. default=True
+    :param directions: If False, the key only depends on the shell structure (the rounded b-values and the number of
+        volumes of each shell), neither on the directions nor on the order of the volumes. default=True
+    :return: String of 16 hexadecimal characters.
+    """
+    import hashlib
+
+    bvals = np.asarray(bvals, dtype=np.float64).ravel()
+    bvecs = np.asarray(bvecs, dtype=np.float64)
+    if bvecs.shape[0] == 3 and bvecs.shape[1] != 3:
+        bvecs = bvecs.T
+    bvecs = bvecs.reshape((-1, 3))
+
+    b = np.round(bvals / bval_rounding) * bval_rounding
+    b[bvals <= b0_threshold] = 0
+
+    if not directions:
+        shells, counts = np.unique(b, return_counts=True)
+        rows = np.column_stack([shells, counts.astype(np.float64)])
+        return hashlib.sha1(np.ascontiguousarray(rows).tobytes()).hexdigest()[:16]
+
+    norms = np.linalg.norm(bvecs, axis=1)
+    v = np.divide(bvecs, norms[:, np.newaxis], out=np.zeros_like(bvecs), where=norms[:, np.newaxis] > 0)
+    v[b == 0] = 0
+    # Diffusion is antipodally symmetric, the first non-null component of each direction is made positive
+    first = np.argmax(np.abs(v) > 10 ** (-bvec_decimals), axis=1)
+    signs = np.sign(v[np.arange(len(v)), first])
+    signs[signs == 0] = 1
+    v = np.round(v * signs[:, np.newaxis], bvec_decimals) + 0.0
+
+    rows = np.column_stack([b, v])
+    if not ordered:
+        rows = rows[np.lexsort(rows.T[::-1])]
+
+    return hashlib.sha1(np.ascontiguousarray(rows).tobytes()).hexdigest()[:16]
+
+
+def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic={'FA': 'dti_CommonSpace_T1_AP'}, core_count=1, maskType="brain_mask_dilated", engine="randomise"):
     """
 
     :param folder_path: path to the root directory.
@@ -1748,11 +2159,13 @@ def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic
     :param randomise_numberofpermutation: Define the number of permutations. default=5000
     :param metrics_dic: Dictionnary containing the diffusion metrics to register in a common space. For each diffusion metric, the metric name is the key and the metric's folder is the value. default={'_noddi_odi':'noddi','_mf_fvf_tot':'mf','_diamond_kappa':'diamond'}
     :param core_count: Number of allocated cpu core. default=1
+    :param engine: Permutation engine, either "randomise" (FSL) or "python" (elikopy.stats.permutation_glm, same outputs). default="randomise"
     """
+    core_count = cpu_allowance(core_count)
     outputdir = folder_path + "/vbm"
     log_prefix = "vbm"
 
-    from dipy.io.image import load_nifti, save_nifti
+    from elikopy.storage import load_nifti, save_nifti
 
     outputdir_group = folder_path + "/vbm/stats/" + "G1" + \
         str(tuple(grp1)).replace(" ", "") + "_G2" + \
@@ -1787,31 +2200,31 @@ def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic
             regType = ""
 
         outkey = value + "_" + key
-        bashCommand1 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && ' + randomise_type + \
+        bashCommand1 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && ' + randomise_type + \
             ' -i all_' + value + "_" + key + '_smooth -o ' + value + "_" + key + ' -m mask_' + value + "_" + key +' -d design_' + value + "_" + key +'.mat -t design_' + value + "_" + key +'.con -n ' + \
             str(randomise_numberofpermutation) + ' -T -x --uncorrp'
 
         vbm_log_metrics = open(outputdir_group + "/vbm_log_" + outkey + "_g1" + str(
             tuple(grp1)).replace(" ", "") + "_g2" + str(tuple(grp2)).replace(" ", "") + ".txt", "a+")
 
-        bashCommand2 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_tfce_corrp_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_tfce_corrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_corrp_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
+        bashCommand2 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_tfce_corrp_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_tfce_corrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_corrp_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_tfce_corrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_corrp_tstat1 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + outkey + \
             '_report1_tfce_corrected_cortical.txt && autoaq -i ' + outkey + \
             '_tfce_corrp_tstat2 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_tfce_corrected_cortical.txt'
-        bashCommand3 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_tfce_p_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_tfce_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_p_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
+        bashCommand3 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_tfce_p_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_tfce_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_p_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_tfce_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_tfce_p_tstat1 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + outkey + \
             '_report1_tfce_uncorrected_cortical.txt && autoaq -i ' + outkey + \
             '_tfce_p_tstat2 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_tfce_uncorrected_cortical.txt'
 
 
-        bashCommand4 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_vox_corrp_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_vox_corrected_subcortical.txt && autoaq -i ' + outkey + '_vox_corrp_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
+        bashCommand4 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_vox_corrp_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_vox_corrected_subcortical.txt && autoaq -i ' + outkey + '_vox_corrp_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_vox_corrected_subcortical.txt && autoaq -i ' + outkey + '_vox_corrp_tstat1 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + outkey + \
             '_report1_vox_corrected_cortical.txt && autoaq -i ' + outkey + \
             '_vox_corrp_tstat2 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_vox_corrected_cortical.txt'
-        bashCommand5 = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_vox_p_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_vox_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_vox_p_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
+        bashCommand5 = thread_exports(core_count) + 'cd \"' + outputdir_group + '\" ' + ' && autoaq -i ' + outkey + '_vox_p_tstat1 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + outkey + '_report1_vox_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_vox_p_tstat2 -a \"Harvard-Oxford Subcortical Structural Atlas\" -t 0.95 -o ' + \
             outkey + '_report2_vox_uncorrected_subcortical.txt && autoaq -i ' + outkey + '_vox_p_tstat1 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + outkey + \
             '_report1_vox_uncorrected_cortical.txt && autoaq -i ' + outkey + \
             '_vox_p_tstat2 -a \"Harvard-Oxford Cortical Structural Atlas\" -t 0.95 -o ' + \
@@ -1824,7 +2237,8 @@ def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic
 
             patient_error = False
             design_mat = []
-            fslmerge_cmd = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + " && fslmerge -t all_" + value + "_" + key + ".nii.gz "
+            stack_subjects = []
+            stack_files = []
             mergedMask = None
             for p in ordered_patient_list:
                 patient_path = os.path.splitext(p)[0]
@@ -1841,7 +2255,8 @@ def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic
                         print("Error with " + metric_path)
                     else:
                         design_mat.append("1 0\n")
-                        fslmerge_cmd += metric_path + " "
+                        stack_subjects.append(patient_path)
+                        stack_files.append(metric_path)
                         mask, _ = load_nifti(mask_path)
                 elif control_info in grp2:
                     if (not os.path.exists(metric_path) or
@@ -1849,7 +2264,8 @@ def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic
                         print("Error with " + metric_path)
                     else:
                         design_mat.append("0 1\n")
-                        fslmerge_cmd += metric_path + " "
+                        stack_subjects.append(patient_path)
+                        stack_files.append(metric_path)
                         mask, _ = load_nifti(mask_path)
                 else:
                     print("ERROR, Aborting randomise for " + key + " " + value)
@@ -1881,29 +2297,41 @@ def vbm(folder_path, grp1, grp2, randomise_numberofpermutation=5000, metrics_dic
                     f.write("1 -1\n")
                     f.write("-1 1\n")
 
-                print("Bash command is:\n{}\n".format(fslmerge_cmd.split()))
-                vbm_log.write(fslmerge_cmd+"\n")
-                vbm_log.flush()
-                process = subprocess.Popen(fslmerge_cmd, universal_newlines=True, shell=True, stdout=vbm_log_metrics,
-                                           stderr=subprocess.STDOUT)
-                output, error = process.communicate()
-
-                mrfilter_cmd = 'export OMP_NUM_THREADS='+str(core_count)+' ; export FSLPARALLEL='+str(core_count)+' ; cd \"' + outputdir_group + '\" ' + \
-                               " && mrfilter -force -nthreads " + str(core_count) + " all_" + value + "_" + key + ".nii.gz smooth all_" + value + "_" + key + "_smooth.nii.gz ; "
-                print("Bash command is:\n{}\n".format(mrfilter_cmd.split()))
-                vbm_log.write(mrfilter_cmd+"\n")
+                # the subjects are stacked once for all the group comparisons of the study (only new or modified maps
+                # are loaded and smoothed), then the smoothed stack is restricted to the subjects of the design
+                from elikopy.stats import GroupStack
+                from elikopy.storage import load_image
+                first = load_image(stack_files[0])
+                stack = GroupStack.create(outputdir + "/stats/all_" + value + "_" + key + ".stack", first.shape, first.affine)
+                n_added = stack.add(stack_subjects, stack_files, core_count=core_count)
+                smooth_stack = stack.smooth(outputdir + "/stats/all_" + value + "_" + key + "_smooth.stack", sigma=1.0,
+                                            core_count=core_count)
+                vbm_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+                    "%d.%b %Y %H:%M:%S") + ": " + str(n_added) + " maps loaded in " + stack.path + "\n")
                 vbm_log.flush()
-                process = subprocess.Popen(mrfilter_cmd, universal_newlines=True, shell=True, stdout=vbm_log_metrics,
-                                           stderr=subprocess.STDOUT)
-                output, error = process.communicate()
 
-                bashcmd1 = bashCommand1.split()
-                print("Bash command is:\n{}\n".format(bashcmd1))
-                vbm_log.write(bashCommand1+"\n")
-                vbm_log.flush()
-                process = subprocess.Popen(bashCommand1, universal_newlines=True, shell=True, stdout=vbm_log_metrics,
-                                           stderr=subprocess.STDOUT)
-                output, error = process.communicate()
+                if engine == "python":
+                    from elikopy.stats import permutation_glm
+                    vbm_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
+                        "%d.%b %Y %H:%M:%S") + ": permutation_glm on all_" + value + "_" + key + "_smooth\n")
+                    vbm_log.flush()
+                    permutation_glm(smooth_stack,
+                                    outputdir_group + "mask_" + value + "_" + key + ".nii.gz",
+                                    outputdir_group + "design_" + value + "_" + key + ".mat",
+                                    outputdir_group + "design_" + value + "_" + key + ".con",
+                                    outputdir_group + outkey, n_perm=randomise_numberofpermutation, tfce_E=0.5,
+                                    connectivity=6, core_count=core_count, subjects=stack_subjects)
+                else:
+                    smooth_stack.to_nifti(outputdir_group + "all_" + value + "_" + key + "_smooth.nii.gz",
+                                          stack_subjects, hdr=first.header)
+
+                    bashcmd1 = bashCommand1.split()
+                    print("Bash command is:\n{}\n".format(bashcmd1))
+                    vbm_log.write(bashCommand1+"\n")
+                    vbm_log.flush()
+                    process = subprocess.Popen(bashCommand1, universal_newlines=True, shell=True, stdout=vbm_log_metrics,
+                                               stderr=subprocess.STDOUT)
+                    output, error = process.communicate()
 
                 vbm_log.write("[" + log_prefix + "] " + datetime.datetime.now().strftime(
                     "%d.%b %Y %H:%M:%S") + ": End of randomise\n")
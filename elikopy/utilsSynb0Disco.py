@@ -1,5 +1,4 @@
 import numpy as np
-import nibabel as nib
 import scipy.ndimage
 
 
@@ -21,8 +20,8 @@ def unnormalize_img(img, max_img, min_img, max, min):
 
 
 def get_nii_img(path_nii):
-    nii = nib.load(path_nii)
-    nii_img = nii.get_fdata()
+    from elikopy.storage import load_nifti_data
+    nii_img = load_nifti_data(path_nii)
 
     return nii_img
 